@@ -0,0 +1,575 @@
+"""
+The module resolves many names concurrently with asyncio.
+All queries share one UDP socket and replies are matched by id and question.
+"""
+__author__ = 'Skipper'
+DEFAULT_MAX_IN_FLIGHT = 4096
+DEFAULT_JOBS = 256
+RECEIVE_BUFFER = 4 * 1024 * 1024
+
+import asyncio
+import collections
+import ipaddress
+import random
+import socket
+from cache import ResolverCache
+from instrument import Instrumentation
+from packet import QueryPacket, ReceivedPacket
+from ratelimit import AsyncRateLimiter
+from singleflight import AsyncSingleFlight
+from resolver import DEFAULT_NUM_OF_RETRIES, DEFAULT_PORT, DEFAULT_SERVER,\
+    DEFAULT_TIMEOUT, MAX_DEPTH, NoResponseException, Resolver,\
+    address_records, closest_servers, is_referral, parse_referral,\
+    store_answers
+from serverstats import ServerStats
+from transport import DEFAULT_PIPELINE, DEFAULT_TCP_CONNECTIONS, LENGTH,\
+    matches_query
+
+
+async def iterate(names):
+    """
+    The function iterates over iterable or async iterable
+    :param names: iterable or async iterable
+    :return: async generator
+    """
+    if hasattr(names, '__aiter__'):
+        async for name in names:
+            yield name
+    else:
+        for name in names:
+            yield name
+
+
+class DatagramMultiplexer(asyncio.DatagramProtocol):
+    """
+    Protocol which hands every reply to the future waiting for it
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        identifier = (data[0] << 8) + data[1]
+        if identifier not in self.pending:
+            return
+        expected_addr, query, future = self.pending[identifier]
+        if future.done() or addr[:2] != expected_addr:
+            return
+        if not matches_query(query, data):
+            return
+        try:
+            future.set_result(ReceivedPacket(data))
+        except ReceivedPacket.NotFoundException as error:
+            future.set_exception(error)
+        except Exception:
+            return
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        for _, _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(NoResponseException())
+
+
+class StreamMultiplexer:
+    """
+    Persistent TCP connection with pipelined queries.
+    Replies may come in any order, they are matched by id and question.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.closed = False
+        self.reading = asyncio.ensure_future(self._read_loop_())
+
+    @staticmethod
+    async def connect(server_address, timeout):
+        """
+        The method opens connection to server
+        :param server_address: tuple
+        :param timeout: float
+        :return: StreamMultiplexer
+        """
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(*server_address), timeout)
+        return StreamMultiplexer(reader, writer)
+
+    async def query(self, packet, timeout):
+        """
+        The method sends packet and waits for reply
+        :param packet: bytes
+        :param timeout: float
+        :return: bytes
+        """
+        identifier = packet[0:2]
+        future = asyncio.get_running_loop().create_future()
+        self.pending[identifier] = (packet, future)
+        try:
+            self.writer.write(LENGTH.pack(len(packet)) + packet)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(identifier, None)
+
+    async def _read_loop_(self):
+        try:
+            while True:
+                length = LENGTH.unpack(await self.reader.readexactly(2))[0]
+                reply = await self.reader.readexactly(length)
+                query, future = self.pending.get(reply[0:2], (None, None))
+                if future is not None and not future.done()\
+                        and matches_query(query, reply):
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.closed = True
+            for _, future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError())
+
+    def close(self):
+        """
+        The method closes connection
+        :return: None
+        """
+        self.closed = True
+        self.writer.close()
+        self.reading.cancel()
+
+
+class AsyncResolver:
+    """
+    The class resolves names like Resolver, but without blocking:
+    thousands of lookups can be in flight over one datagram endpoint.
+    Like Resolver it begins with the closest cached zone cut and adapts
+    timeouts to latency of servers, delegations and server_stats may be
+    shared with Resolver.
+    """
+
+    NAME_NOT_FOUND = Resolver.NAME_NOT_FOUND
+    NO_RESPONSE = Resolver.NO_RESPONSE
+    TYPES = Resolver.TYPES
+
+    def __init__(self, server=DEFAULT_SERVER, port=DEFAULT_PORT,
+                 num_of_retries=DEFAULT_NUM_OF_RETRIES,
+                 waiting=DEFAULT_TIMEOUT,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, cache=None,
+                 edns_payload=None, limiter=None, flights=None,
+                 delegations=None, server_stats=None, instrument=None,
+                 prefetcher=None):
+        self.server = server
+        self.port = port
+        self.num_of_retries = num_of_retries
+        self.timeout = waiting
+        self.max_in_flight = min(max_in_flight, 65535)
+        self.cache = ResolverCache() if cache is None else cache
+        self.edns_payload = edns_payload
+        # queries to every server wait for its rate and in-flight limits
+        self.limiter = AsyncRateLimiter() if limiter is None else limiter
+        # concurrent lookups of one name and type are done once
+        self.flights = AsyncSingleFlight() if flights is None else flights
+        # zone -> addresses of its nameservers, lives for TTL of NS records
+        self.delegations = ResolverCache() if delegations is None\
+            else delegations
+        # timeouts adapt to latency of servers, waiting is the upper bound
+        self.server_stats = ServerStats() if server_stats is None\
+            else server_stats
+        # events of lookups go to sinks of instrument, traces are kept
+        # for every task
+        self.instrument = Instrumentation() if instrument is None\
+            else instrument
+        # hot answers are refreshed by AsyncPrefetcher before they expire
+        self.prefetcher = prefetcher
+        self.protocol = None
+        # address of server given by name is found once when endpoint
+        # is opened, other servers are given by addresses
+        self.server_address = None
+        self.tcp_connections = {}
+        self._tcp_locks_ = {}
+        self._in_flight_ = None
+        self._opening_ = None
+
+    async def open(self):
+        """
+        The method creates datagram endpoint if it is not created yet
+        :return: None
+        """
+        if self.protocol is not None:
+            return
+        if self._opening_ is None:
+            self._opening_ = asyncio.ensure_future(self._open_())
+        await self._opening_
+
+    async def _open_(self):
+        loop = asyncio.get_running_loop()
+        self.server_address = await self._find_server_address_()
+        self._in_flight_ = asyncio.Semaphore(self.max_in_flight)
+        transport, protocol = await loop.create_datagram_endpoint(
+            DatagramMultiplexer, local_addr=('0.0.0.0', 0),
+            family=socket.AF_INET)
+        # replies to thousands of queries in flight may come at once
+        transport.get_extra_info('socket').setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        self.protocol = protocol
+
+    async def close(self):
+        """
+        The method closes datagram endpoint
+        :return: None
+        """
+        if self.protocol is not None:
+            self.protocol.transport.close()
+            self.protocol = None
+            self._opening_ = None
+        for connections in self.tcp_connections.values():
+            for connection in connections:
+                connection.close()
+        self.tcp_connections.clear()
+        self._tcp_locks_.clear()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def resolve(self, address, query_type=QueryPacket.QU_A):
+        """
+        The method resolves records of address
+        :param address: str
+        :param query_type: int
+        :return: list
+        """
+        self.instrument.lookup_started(address)
+        entry = self.cache.get(address, query_type)
+        if entry is not None:
+            self.instrument.cache_hit(address, entry.negative)
+            self.prefetch(address, query_type, entry)
+            result = self.NAME_NOT_FOUND if entry.negative\
+                else entry.records
+        else:
+            await self.open()
+            result = await self.flights.do(
+                self.cache.make_key(address, query_type), self._lookup_,
+                address, query_type)
+        self.instrument.lookup_finished(address, result)
+        return result
+
+    async def lookup(self, address, query_type=QueryPacket.QU_A):
+        """
+        The method resolves address without looking into cache,
+        answer is cached
+        :param address: str
+        :param query_type: int
+        :return: list
+        """
+        await self.open()
+        return await self._lookup_(address, query_type)
+
+    def prefetch(self, address, query_type, entry):
+        """
+        The method starts refresh of cached entry by prefetcher
+        if entry is hot and is going to expire
+        :param address: str
+        :param query_type: int
+        :param entry: CacheEntry
+        :return: None
+        """
+        if self.prefetcher is not None\
+                and self.prefetcher.is_due(entry, self.cache.clock()):
+            self.prefetcher.schedule(self, address, query_type)
+
+    async def _lookup_(self, address, query_type):
+        async with self._in_flight_:
+            return await self._resolve_(address, query_type)
+
+    async def resolve_types(self, address, query_types):
+        """
+        The method resolves records of several types of address.
+        Delegations are followed only once by lookup of the first type,
+        so lookups of other types begin with cached zone cut and are
+        done concurrently.
+        :param address: str
+        :param query_types: list of int
+        :return: dict type -> list
+        """
+        query_types = list(dict.fromkeys(query_types))
+        if not query_types:
+            return {}
+        first = await self.resolve(address, query_types[0])
+        if first == self.NAME_NOT_FOUND:
+            # name does not exist whatever type is asked
+            for query_type in query_types[1:]:
+                self.cache.put_negative(address, query_type)
+            return dict.fromkeys(query_types, self.NAME_NOT_FOUND)
+        results = await asyncio.gather(*(self.resolve(address, query_type)
+                                         for query_type in query_types[1:]))
+        return dict(zip(query_types, [first] + results))
+
+    async def resolve_many(self, names):
+        """
+        The method resolves all names concurrently
+        :param names: iterable
+        :return: list of results in order of names
+        """
+        await self.open()
+        return await asyncio.gather(*(self.resolve(name) for name in names))
+
+    async def resolve_iter(self, names, jobs=DEFAULT_JOBS, ordered=False,
+                           query_types=None):
+        """
+        The method resolves names with at most jobs lookups at once and
+        yields (name, result) as soon as they are ready. Names are taken
+        from iterable lazily, so it may be endless; async iterable lets
+        names be read without blocking lookups in flight. With query_types
+        result is dict type -> list like in resolve_types.
+        :param names: iterable or async iterable
+        :param jobs: int
+        :param ordered: bool - yield results in order of names
+        :param query_types: list of int or None for A records
+        :return: async generator
+        """
+        await self.open()
+        jobs = max(1, jobs)
+        if ordered:
+            window = collections.deque()
+            async for name in iterate(names):
+                window.append(asyncio.ensure_future(
+                    self._named_(name, query_types)))
+                if len(window) >= jobs:
+                    yield await window.popleft()
+            while window:
+                yield await window.popleft()
+        else:
+            pending = set()
+            async for name in iterate(names):
+                pending.add(asyncio.ensure_future(
+                    self._named_(name, query_types)))
+                if len(pending) >= jobs:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+
+    async def _named_(self, name, query_types):
+        if query_types is None:
+            return name, await self.resolve(name)
+        return name, await self.resolve_types(name, query_types)
+
+    async def _resolve_(self, address, query_type, depth=0):
+        servers = closest_servers(self.delegations, address, self.server)
+        visited = []
+        received_packet = None
+        result = self.NO_RESPONSE
+        failed = False
+        while servers:
+            servers = self.server_stats.order(servers)
+            server = servers.pop(0)
+            visited.append(server)
+            try:
+                received_packet = await self._query_(address, query_type,
+                                                     server)
+            except ReceivedPacket.NotFoundException:
+                self.cache.put_negative(address, query_type)
+                return self.NAME_NOT_FOUND
+            except NoResponseException:
+                # referral to servers which do not answer is a failure
+                failed = True
+                if not servers and received_packet is None\
+                        and self.server not in visited:
+                    # servers of cached zone cut are dead, begin from scratch
+                    servers = [self.server]
+                continue
+            failed = False
+            result = store_answers(self.cache, address, query_type,
+                                   received_packet)
+            if received_packet.answers\
+                    or (received_packet.aa and not received_packet.rcode):
+                return result
+            referral = await self._follow_referral_(address, received_packet,
+                                                    visited, depth)
+            if referral:
+                servers = referral
+            elif is_referral(received_packet):
+                failed = True
+        return self.NO_RESPONSE if failed else result
+
+    async def _follow_referral_(self, address, packet, visited, depth):
+        """
+        The method takes servers of delegated zone from referral
+        and caches their addresses with the TTL of NS records.
+        Nameservers without glue are resolved like in Resolver.
+        :param address: str
+        :param packet: ReceivedPacket
+        :param visited: list - servers asked during lookup
+        :param depth: int - number of lookups of nameservers this one
+        is nested in
+        :return: list of servers not visited yet
+        """
+        referral = parse_referral(address, packet)
+        if referral is None:
+            return []
+        zone, names, glue, ttl = referral
+        if not glue:
+            glue = await self._resolve_nameservers_(names, depth)
+        servers = [server for name in names for server in glue.get(name, [])]
+        if servers:
+            self.delegations.put(zone, QueryPacket.QU_NS, servers, ttl)
+        return [server for server in servers if server not in visited]
+
+    async def _resolve_nameservers_(self, names, depth):
+        """
+        The method finds addresses of nameservers without glue by
+        concurrent lookups of this resolver and takes the first one with
+        addresses, others go on in background and fill cache.
+        :param names: list
+        :param depth: int - depth of lookup which follows referral
+        :return: dict name -> list of addresses
+        """
+        addresses = {}
+        for name in names:
+            entry = self.cache.get(name, QueryPacket.QU_A)
+            if entry is not None and not entry.negative:
+                addresses[name] = address_records(entry.records)
+        if any(addresses.values()) or depth >= MAX_DEPTH:
+            return addresses
+        lookups = {asyncio.ensure_future(self._resolve_(
+            name, QueryPacket.QU_A, depth + 1)): name
+            for name in names if name not in addresses}
+        pending = set(lookups)
+        while pending and not any(addresses.values()):
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for lookup in done:
+                found = address_records(lookup.result())
+                if found:
+                    addresses[lookups[lookup]] = found
+        return addresses
+
+    async def _query_(self, address, query_type, server, edns=True):
+        server_address = self._server_address_(server)
+        loop = asyncio.get_running_loop()
+        pending = self.protocol.pending
+        identifier = random.randrange(65536)
+        while identifier in pending:
+            identifier = random.randrange(65536)
+        packet = QueryPacket(identifier)
+        packet.add_question(address, query_type)
+        packet.set_edns(self.edns_payload if edns else None)
+        raw_packet = packet.get_packet()
+        future = loop.create_future()
+        pending[identifier] = (server_address, raw_packet, future)
+        host = server_address[0]
+        # server in penalty box gets only one probe
+        retries = 1 if self.server_stats.is_penalized(host)\
+            else self.num_of_retries
+        try:
+            for attempt in range(retries):
+                async with self.limiter.slot(host):
+                    sent = loop.time()
+                    self.instrument.send_packet(host, identifier, attempt)
+                    self.protocol.transport.sendto(raw_packet,
+                                                   server_address)
+                    try:
+                        received_packet = await asyncio.wait_for(
+                            asyncio.shield(future), self.server_stats.timeout(
+                                host, attempt, self.timeout))
+                    except asyncio.TimeoutError:
+                        self.server_stats.add_timeout(host)
+                        self.instrument.timeout(host)
+                        continue
+                    except ReceivedPacket.NotFoundException:
+                        self.instrument.name_error(host, identifier,
+                                                   loop.time() - sent)
+                        raise
+                rtt = loop.time() - sent
+                # rtt of retransmitted query is ambiguous (Karn's rule)
+                if attempt == 0:
+                    self.server_stats.add_rtt(host, rtt)
+                self.instrument.receive_packet(received_packet, host,
+                                               identifier, rtt)
+                if received_packet.tc:
+                    self.instrument.truncated(host)
+                    self.instrument.send_packet(host, identifier, tcp=True)
+                    received_packet = await self._query_tcp_(
+                        raw_packet, server_address, received_packet)
+                break
+            else:
+                self.instrument.no_response(host)
+                raise NoResponseException
+        finally:
+            del pending[identifier]
+            if not future.done():
+                future.cancel()
+        if Resolver._rejects_edns_(packet, received_packet):
+            return await self._query_(address, query_type, server, False)
+        return received_packet
+
+    async def _query_tcp_(self, raw_packet, server_address, truncated):
+        # truncated reply is better than nothing if TCP fails
+        for _ in range(2):
+            try:
+                connection = await self._tcp_connection_(server_address)
+                async with self.limiter.slot(server_address[0]):
+                    raw_received = await connection.query(raw_packet,
+                                                          self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                continue
+            return ReceivedPacket(raw_received)
+        return truncated
+
+    async def _tcp_connection_(self, server_address):
+        # lookups truncated at once must share connection, not open many
+        lock = self._tcp_locks_.setdefault(server_address, asyncio.Lock())
+        async with lock:
+            connections = self.tcp_connections.setdefault(server_address, [])
+            connections[:] = [connection for connection in connections
+                              if not connection.closed]
+            if connections:
+                connection = min(connections,
+                                 key=lambda item: len(item.pending))
+                if len(connection.pending) < DEFAULT_PIPELINE\
+                        or len(connections) >= DEFAULT_TCP_CONNECTIONS:
+                    return connection
+            connection = await StreamMultiplexer.connect(server_address,
+                                                         self.timeout)
+            connections.append(connection)
+            return connection
+
+    def _server_address_(self, server):
+        if server == self.server:
+            if self.server_address is None:
+                raise NoResponseException
+            return self.server_address
+        return server, self.port
+
+    async def _find_server_address_(self):
+        try:
+            ipaddress.IPv4Address(self.server)
+            return self.server, self.port
+        except ValueError:
+            pass
+        loop = asyncio.get_running_loop()
+        try:
+            info = await loop.getaddrinfo(self.server, self.port,
+                                          family=socket.AF_INET,
+                                          type=socket.SOCK_DGRAM)
+        except socket.gaierror:
+            return None
+        return info[0][4][0], self.port
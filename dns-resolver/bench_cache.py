@@ -0,0 +1,91 @@
+"""
+Benchmark of memory taken by decoded records and cache entries.
+Records of parsed responses are kept after their packets are dropped,
+as resolver keeps answers, and the same answers are put into
+ResolverCache. Memory is measured by tracemalloc and is scaled to
+one million records and entries.
+Target: a record takes at most RECORD_BUDGET bytes and an entry
+with its key takes at most ENTRY_BUDGET bytes.
+usage: python bench_cache.py [count]
+"""
+__author__ = 'Skipper'
+RECORD_BUDGET = 320
+ENTRY_BUDGET = 600
+MILLION = 1000000
+
+import gc
+import struct
+import sys
+import tracemalloc
+from cache import ResolverCache
+from packet import ReceivedPacket
+from resolver import Resolver
+
+
+def make_response(index):
+    """
+    The function builds response to A query for host<index>.example.com:
+    CNAME to one of few shared targets and A record of the target
+    :param index: int
+    :return: bytes
+    """
+    owner = 'host{}'.format(index).encode()
+    question = bytes((len(owner),)) + owner + b'\x07example\x03com\x00'\
+        + b'\x00\x01\x00\x01'
+    target = 'edge{}'.format(index % 16).encode()
+    data = bytes((len(target),)) + target + b'\xc0' + bytes((13 + len(owner),))
+    cname = b'\xc0\x0c' + struct.pack('!HHIH', 5, 1, 300, len(data)) + data
+    address = struct.pack('!HHIH', 1, 1, 60, 4)\
+        + bytes((192, 0, 2, index % 256))
+    header = struct.pack('!HBBHHHH', 1, 0x81, 0x80, 1, 2, 0, 0)
+    return header + question + cname + b'\xc0' + bytes((24 + len(question),))\
+        + address
+
+
+def measure(build, count):
+    """
+    The function measures memory kept by objects built for count responses
+    :param build: callable - takes ReceivedPacket, returns kept object
+    :param count: int
+    :return: bytes per response
+    """
+    responses = [make_response(index) for index in range(count)]
+    kept = [None] * count
+    gc.collect()
+    tracemalloc.start()
+    for index, raw_packet in enumerate(responses):
+        kept[index] = build(ReceivedPacket(raw_packet))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size / count
+
+
+def keep_records(packet):
+    records = packet.get_answers()
+    for record in records:
+        record.get_data()
+    return records
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    cache = ResolverCache(max_size=count)
+
+    def put(packet):
+        cache.put(packet.queries[0].query_name, 1,
+                  Resolver._format_result_(packet.answers), 300)
+    record = measure(keep_records, count) / 2
+    entry = measure(put, count)
+    print('{:>8} {:>10} {:>12} {:>8}'.format('kind', 'bytes', 'MB per 1M',
+                                             'target'))
+    for kind, size, target in (('record', record, RECORD_BUDGET),
+                               ('entry', entry, ENTRY_BUDGET)):
+        print('{:>8} {:>10.0f} {:>12.0f} {:>8} {}'.format(
+            kind, size, size * MILLION / 2 ** 20, target,
+            'ok' if size <= target else 'BIG'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark of ReceivedPacket parser on responses of realistic sizes.
+Target: parse (without decoding data) at least TARGET_PPS packets
+per second for every size on a single core.
+usage: python bench_packet.py [seconds per size]
+"""
+__author__ = 'Skipper'
+TARGET_PPS = {512: 14000, 1500: 5000, 4096: 1700}
+
+import struct
+import sys
+import time
+from packet import ReceivedPacket
+
+
+def make_response(size):
+    """
+    The function builds response to A query for example.com:
+    answers, referral to NS records and AAAA records
+    until packet grows to size
+    :param size: int
+    :return: bytes
+    """
+    question = b'\x07example\x03com\x00\x00\x01\x00\x01'
+    records = []
+    length = 12 + len(question)
+    index = 0
+    while True:
+        kind = index % 3
+        if kind == 0:
+            record = b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, 300, 4)\
+                + bytes((192, 0, 2, index % 256))
+        elif kind == 1:
+            target = 'ns{}'.format(index).encode()
+            data = bytes((len(target),)) + target + b'\xc0\x14'
+            record = b'\xc0\x14' + struct.pack('!HHIH', 2, 1, 172800,
+                                               len(data)) + data
+        else:
+            record = b'\xc0\x0c' + struct.pack('!HHIH', 28, 1, 300, 16)\
+                + bytes(range(16))
+        if length + len(record) > size:
+            break
+        records.append((kind, record))
+        length += len(record)
+        index += 1
+    answers = [record for kind, record in records if kind != 1]
+    authority = [record for kind, record in records if kind == 1]
+    header = struct.pack('!HBBHHHH', 1, 0x81, 0x80, 1, len(answers),
+                         len(authority), 0)
+    return header + question + b''.join(answers) + b''.join(authority)
+
+
+def measure(raw_packet, seconds, decode):
+    """
+    The function parses raw_packet for given time
+    :param raw_packet: bytes
+    :param seconds: float
+    :param decode: bool - also decode data of every record
+    :return: packets per second
+    """
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            packet = ReceivedPacket(raw_packet)
+            if decode:
+                for record in packet.answers:
+                    record.get_data()
+                for record in packet.authoritative_nameservers:
+                    record.get_data()
+        count += 100
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    print('{:>6} {:>8} {:>12} {:>12} {:>8}'.format(
+        'size', 'records', 'parse pps', 'decode pps', 'target'))
+    for size, target in sorted(TARGET_PPS.items()):
+        raw_packet = make_response(size)
+        packet = ReceivedPacket(raw_packet)
+        records = len(packet.answers) + len(packet.authoritative_nameservers)
+        parse = measure(raw_packet, seconds, False)
+        decode = measure(raw_packet, seconds, True)
+        print('{:>6} {:>8} {:>12.0f} {:>12.0f} {:>8} {}'.format(
+            len(raw_packet), records, parse, decode, target,
+            'ok' if parse >= target else 'SLOW'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+End-to-end benchmark of resolvers against fake DNS hierarchy on localhost.
+Reports lookups per second and p50/p99 latency of lookups for scenarios:
+cold  - sequential lookups by Resolver with empty caches, from root
+warm  - the same lookups again, answers are cached
+async - concurrent lookups by AsyncResolver with empty cache
+serve - queries of clients to StubServer, answers are cached,
+        it should keep up with stubserver.TARGET_QPS
+repeat - the same queries again, answered from wire cache
+usage: python bench_resolver.py [-n NAMES] [-l LATENCY] [--loss LOSS]
+                                [-j JOBS] [--serve]
+"""
+__author__ = 'Skipper'
+
+import argparse
+import asyncio
+import random
+import time
+from asyncresolver import AsyncResolver
+from fakedns import make_hierarchy
+from packet import QueryPacket, ReceivedPacket
+from resolver import Resolver
+from stubserver import StubServer
+
+
+def percentile(latencies, fraction):
+    """
+    The function returns percentile of sorted latencies
+    :param latencies: list
+    :param fraction: float
+    :return: float
+    """
+    return latencies[int(fraction * (len(latencies) - 1))]
+
+
+def report(scenario, elapsed, latencies, failures):
+    """
+    The function prints one line of results
+    :return: None
+    """
+    latencies.sort()
+    print('{:<6} {:>8} {:>10.0f} {:>10.2f} {:>10.2f} {:>8}'.format(
+        scenario, len(latencies), len(latencies) / elapsed,
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000, failures))
+
+
+def run_sync(resolver, names):
+    """
+    The function resolves names one by one
+    :return: elapsed time, latencies, number of failures
+    """
+    latencies = []
+    failures = 0
+    started = time.perf_counter()
+    for name in names:
+        lookup_started = time.perf_counter()
+        result = resolver.resolve(name)
+        latencies.append(time.perf_counter() - lookup_started)
+        if result in (Resolver.NO_RESPONSE, Resolver.NAME_NOT_FOUND):
+            failures += 1
+    return time.perf_counter() - started, latencies, failures
+
+
+async def run_async(resolver, names, jobs):
+    """
+    The function resolves names concurrently
+    :return: elapsed time, latencies, number of failures
+    """
+    latencies = []
+    failures = 0
+    window = asyncio.Semaphore(jobs)
+
+    async def lookup(name):
+        nonlocal failures
+        async with window:
+            lookup_started = time.perf_counter()
+            result = await resolver.resolve(name)
+            latencies.append(time.perf_counter() - lookup_started)
+            if result in (Resolver.NO_RESPONSE, Resolver.NAME_NOT_FOUND):
+                failures += 1
+    started = time.perf_counter()
+    await resolver.open()
+    await asyncio.gather(*(lookup(name) for name in names))
+    return time.perf_counter() - started, latencies, failures
+
+
+class StubClient(asyncio.DatagramProtocol):
+    """
+    Client sending queries to StubServer, replies are matched by id
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        future = self.pending.pop((data[0] << 8) + data[1], None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+
+async def run_serve(hierarchy, names, jobs):
+    """
+    The function asks StubServer for cached names concurrently, twice:
+    the first answers are made from resolver cache, repeated ones
+    are taken from wire cache
+    :return: list of (elapsed time, latencies, number of failures)
+    """
+    loop = asyncio.get_running_loop()
+    resolver = AsyncResolver(hierarchy.root, hierarchy.port, waiting=1)
+    async with StubServer(resolver, port=0) as server:
+        await resolver.resolve_many(names)
+        _, client = await loop.create_datagram_endpoint(
+            StubClient, remote_addr=(server.address, server.port))
+        window = asyncio.Semaphore(jobs)
+
+        async def ask(name, identifier, latencies):
+            async with window:
+                query = QueryPacket(identifier)
+                query.add_question(name, QueryPacket.QU_A)
+                future = loop.create_future()
+                client.pending[query.identifier] = future
+                lookup_started = time.perf_counter()
+                client.transport.sendto(query.get_packet())
+                try:
+                    reply = await asyncio.wait_for(future, 1)
+                    failed = not ReceivedPacket(reply).answers
+                except Exception:
+                    failed = True
+                latencies.append(time.perf_counter() - lookup_started)
+                return failed
+        rounds = []
+        for _ in range(2):
+            latencies = []
+            identifiers = random.sample(range(65536), len(names))
+            started = time.perf_counter()
+            failed = await asyncio.gather(*(
+                ask(name, identifier, latencies)
+                for name, identifier in zip(names, identifiers)))
+            rounds.append((time.perf_counter() - started, latencies,
+                           sum(failed)))
+        client.transport.close()
+    await resolver.close()
+    return rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resolver benchmark')
+    parser.add_argument('-n', '--names', type=int, default=2000,
+                        help='number of names to resolve')
+    parser.add_argument('-l', '--latency', type=float, default=0.001,
+                        help='latency of every fake server, seconds')
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='probability to lose UDP query')
+    parser.add_argument('-j', '--jobs', type=int, default=256,
+                        help='concurrent lookups of async scenario')
+    parser.add_argument('--serve', action='store_true',
+                        help='also measure queries per second of '
+                             'StubServer, at most 65536 names')
+    args = parser.parse_args()
+
+    hierarchy, names = make_hierarchy(args.names, latency=args.latency,
+                                      loss=args.loss)
+    with hierarchy:
+        print('{:<6} {:>8} {:>10} {:>10} {:>10} {:>8}'.format(
+            'mode', 'lookups', 'per sec', 'p50 ms', 'p99 ms', 'failed'))
+        with Resolver(hierarchy.root, port=hierarchy.port,
+                      waiting=1) as resolver:
+            report('cold', *run_sync(resolver, names))
+            report('warm', *run_sync(resolver, names))
+
+        async def concurrent():
+            async with AsyncResolver(hierarchy.root, hierarchy.port,
+                                     waiting=1) as resolver:
+                return await run_async(resolver, names, args.jobs)
+        report('async', *asyncio.run(concurrent()))
+        if args.serve:
+            first, repeated = asyncio.run(run_serve(
+                hierarchy, names[:65536], args.jobs))
+            report('serve', *first)
+            report('repeat', *repeated)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+The module keeps resolved answers in memory with respect to their TTL.
+Names of keys and strings of records are interned, so a name kept by
+many entries is stored once. Entry with a CNAME and an A record takes
+less than 600 bytes with its key, so a cache of one million entries
+fits into 600 MB (measured by "python bench_cache.py").
+"""
+__author__ = 'Skipper'
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_NEGATIVE_TTL = 60
+DEFAULT_MAX_TTL = 86400
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def intern_records(records):
+    """
+    The function interns strings of formatted records and of lists
+    and tuples in them
+    :param records: list, tuple, str or None
+    :return: the same structure with interned strings
+    """
+    if isinstance(records, str):
+        return sys.intern(records)
+    if isinstance(records, (list, tuple)):
+        return type(records)(intern_records(item) for item in records)
+    return records
+
+
+class CacheEntry:
+    """
+    Single cached answer: formatted records or negative mark.
+    ttl is lifetime given to entry and hits counts how often it was used.
+    """
+
+    __slots__ = ('records', 'expires', 'negative', 'ttl', 'hits')
+
+    def __init__(self, records, expires, negative=False, ttl=None):
+        self.records = records
+        self.expires = expires
+        self.negative = negative
+        self.ttl = ttl
+        self.hits = 0
+
+
+class ResolverCache:
+    """
+    Bounded LRU cache of answers keyed by (name, query type).
+    Positive answers live for the minimal TTL of their records,
+    NXDOMAIN answers live for negative_ttl seconds.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, max_ttl=DEFAULT_MAX_TTL,
+                 clock=time.monotonic):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(name, query_type):
+        """
+        The method normalizes name and forms key of entry
+        :param name: str
+        :param query_type: int
+        :return: tuple
+        """
+        return sys.intern(name.lower().rstrip('.')), query_type
+
+    def get(self, name, query_type):
+        """
+        The method returns alive cache entry or None
+        :param name: str
+        :param query_type: int
+        :return: CacheEntry
+        """
+        key = self.make_key(name, query_type)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self._load_(key)
+                if entry is None:
+                    self.misses += 1
+                    return None
+                self._keep_(key, entry)
+            if entry.expires <= self.clock():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            entry.hits += 1
+            return entry
+
+    def _load_(self, key):
+        # entries which are not in memory may be kept by subclasses
+        return None
+
+    def put(self, name, query_type, records, ttl):
+        """
+        The method caches formatted records for ttl seconds
+        :param name: str
+        :param query_type: int
+        :param records: list
+        :param ttl: int
+        :return: None
+        """
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0:
+            return
+        self._store_(self.make_key(name, query_type),
+                     CacheEntry(intern_records(records), self.clock() + ttl,
+                                ttl=ttl))
+
+    def put_negative(self, name, query_type):
+        """
+        The method caches the fact that name does not exist
+        :param name: str
+        :param query_type: int
+        :return: None
+        """
+        if self.negative_ttl <= 0:
+            return
+        self._store_(self.make_key(name, query_type),
+                     CacheEntry(None, self.clock() + self.negative_ttl,
+                                negative=True, ttl=self.negative_ttl))
+
+    def _store_(self, key, entry):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self._keep_(key, entry)
+
+    def _keep_(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        The method drops every entry, counters stay untouched
+        :return: None
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        """
+        The method returns counters of cache
+        :return: dict
+        """
+        return {'size': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations}
+
+    def __len__(self):
+        return len(self.entries)
@@ -3,13 +3,16 @@ The module add some debugging features
 """
 __author__ = 'Skipper'
 
+from instrument import Sink
 
-class Debugger:
+
+class Debugger(Sink):
     """
-    The class add some debugging features
+    The class add some debugging features: text sink of Instrumentation
     """
     def __init__(self, activated):
         self.activated = activated
+        self.hops = 0
 
     @staticmethod
     def _log_(text, identifier=-1):
@@ -26,29 +29,50 @@ class Debugger:
                                             name, types[packet_type], data)
             print('\t\t{}'.format(text))
 
-    def send_packet(self, server, identifier):
+    def lookup_started(self, name):
+        """
+        The method starts counting of recursive iterations
+        :param name: str
+        :return: None
+        """
+        self.hops = 0
+
+    def send_packet(self, server, identifier, attempt=0, tcp=False):
         """
         The method logs the sending of packet
         :param server: str
         :param identifier: int
+        :param attempt: int
+        :param tcp: bool
         :return: None
         """
         if self.activated:
-            if identifier > 1:
-                self._log_('Recursive iteration #{}'.format(identifier-1))
-            self._log_('Recursion-desired A query sent to {}'.format(server),
-                       identifier)
+            if not attempt and not tcp:
+                self.hops += 1
+                if self.hops > 1:
+                    self._log_('Recursive iteration #{}'.format(
+                        self.hops - 1))
+            how = ''
+            if tcp:
+                how = ' over TCP'
+            elif attempt:
+                how = ', retry #{}'.format(attempt)
+            self._log_('Recursion-desired A query sent to {}{}'.format(
+                server, how), identifier)
 
-    def receive_packet(self, packet, server, identifier):
+    def receive_packet(self, packet, server, identifier, rtt=None):
         """
         The method logs the receiving of packet
         :param packet: ReceivedPacket
         :param server: str
         :param identifier: id
+        :param rtt: float
         :return: None
         """
         if self.activated:
-            self._log_('Response received from {}'.format(server), identifier)
+            self._log_('Response received from {}{}'.format(
+                server, '' if rtt is None else
+                ' in {:.1f} ms'.format(rtt * 1000)), identifier)
             self._print_hexdump_(packet)
             self._log_('Server is {}authoritative'.format(
                 '' if packet.aa else 'not '))
@@ -71,6 +95,18 @@ class Debugger:
                     self._log_rr_(record.global_shift, record.name,
                                   record.record_type, record.data)
 
+    def name_error(self, server, identifier, rtt=None):
+        """
+        The method logs NXDOMAIN response
+        :param server: str
+        :param identifier: int
+        :param rtt: float
+        :return: None
+        """
+        if self.activated:
+            self._log_('Response received from {}'.format(server), identifier)
+            self._log_('Reply code: Name not found')
+
     def timeout(self, server):
         """
         The method logs the timeout of request
@@ -90,21 +126,20 @@ class Debugger:
             self._log_('The server {} does not response'.format(server))
             self._log_('Try to connect to another server')
 
+    def truncated(self, server):
+        """
+        The method logs that response is truncated
+        :param server: str
+        :return: None
+        """
+        if self.activated:
+            self._log_('Response from {} is truncated, retry over TCP'
+                       .format(server))
+
     def _print_hexdump_(self, packet):
         self._log_('Hexdump:')
-        block_size_counter = 0
-        blocks_in_line_counter = 0
-        string = '\t'
-        for byte in packet.raw_packet:
-            if (blocks_in_line_counter == 4) and (block_size_counter == 4):
-                self._log_(string)
-                string = '\t'
-                block_size_counter = 0
-                blocks_in_line_counter = 0
-
-            if block_size_counter == 4:
-                string += ' '
-                blocks_in_line_counter += 1
-                block_size_counter = 0
-            string += '{:0>2}'.format(hex(byte)[2:])
-            block_size_counter += 1
+        raw_packet = packet.raw_packet
+        for start in range(0, len(raw_packet), 16):
+            line = raw_packet[start:start+16]
+            self._log_('\t' + ' '.join(line[i:i+4].hex()
+                                       for i in range(0, len(line), 4)))
@@ -0,0 +1,147 @@
+"""
+The module keeps ResolverCache in SQLite file, so answers and
+delegations survive restart of resolver. Expiry is stored as wall
+clock time. Entries are read from file when they are asked for the first
+time. Written entries are buffered and stored in one transaction every
+commit_every writes and on flush or close, so file is locked only
+while buffer is written.
+"""
+__author__ = 'Skipper'
+DEFAULT_COMMIT_EVERY = 100
+
+import json
+import sqlite3
+import time
+from cache import DEFAULT_CACHE_SIZE, DEFAULT_MAX_TTL, DEFAULT_NEGATIVE_TTL,\
+    CacheEntry, ResolverCache, intern_records
+
+
+class PersistentCache(ResolverCache):
+    """
+    ResolverCache backed by table of SQLite file. Several caches,
+    e.g. answers and delegations, may share one file with own tables.
+    """
+
+    def __init__(self, path, table='answers', max_size=DEFAULT_CACHE_SIZE,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, max_ttl=DEFAULT_MAX_TTL,
+                 clock=time.monotonic, wall_clock=time.time,
+                 commit_every=DEFAULT_COMMIT_EVERY):
+        super().__init__(max_size, negative_ttl, max_ttl, clock)
+        if not table.isidentifier():
+            raise Exception('Bad table name {}'.format(table))
+        self.path = path
+        self.table = table
+        self.wall_clock = wall_clock
+        self.commit_every = commit_every
+        self.connection = None
+        self.pending = {}
+        self.loaded = 0
+
+    def _connect_(self):
+        # file is opened on the first access, expired rows are dropped then
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path,
+                                              check_same_thread=False)
+            # readers of other processes do not wait for writer
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS {} (name TEXT, type INTEGER, '
+                'records TEXT, expires REAL, PRIMARY KEY (name, type))'
+                .format(self.table))
+            with self.connection:
+                self.connection.execute(
+                    'DELETE FROM {} WHERE expires <= ?'.format(self.table),
+                    (self.wall_clock(),))
+        return self.connection
+
+    def _load_(self, key):
+        with self.lock:
+            row = self.pending.get(key)
+            if row is None:
+                row = self._connect_().execute(
+                    'SELECT records, expires FROM {} '
+                    'WHERE name = ? AND type = ?'.format(self.table),
+                    key).fetchone()
+        if row is None:
+            return None
+        records, expires = row
+        remaining = expires - self.wall_clock()
+        if remaining <= 0:
+            return None
+        self.loaded += 1
+        records = json.loads(records)
+        if records is None:
+            return CacheEntry(None, self.clock() + remaining, negative=True,
+                              ttl=remaining)
+        return CacheEntry(self._decode_records_(records),
+                          self.clock() + remaining, ttl=remaining)
+
+    @staticmethod
+    def _decode_records_(records):
+        # JSON has no tuples: (type, data) and MX data are restored
+        return intern_records(
+            [tuple(tuple(item) if isinstance(item, list) else item
+                   for item in record) if isinstance(record, list)
+             else record for record in records])
+
+    def _store_(self, key, entry):
+        if self.max_size <= 0:
+            return
+        expires = self.wall_clock() + entry.expires - self.clock()
+        with self.lock:
+            self._keep_(key, entry)
+            self.pending[key] = (json.dumps(entry.records), expires)
+            if len(self.pending) >= self.commit_every:
+                self._write_()
+
+    def _write_(self):
+        connection = self._connect_()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?)'
+                .format(self.table),
+                [key + row for key, row in self.pending.items()])
+        self.pending.clear()
+
+    def flush(self):
+        """
+        The method writes buffered entries to file
+        :return: None
+        """
+        with self.lock:
+            if self.pending:
+                self._write_()
+
+    def clear(self):
+        """
+        The method drops every entry in memory and in file
+        :return: None
+        """
+        super().clear()
+        with self.lock:
+            self.pending.clear()
+            connection = self._connect_()
+            with connection:
+                connection.execute('DELETE FROM {}'.format(self.table))
+
+    def close(self):
+        """
+        The method writes buffered entries and closes file
+        :return: None
+        """
+        self.flush()
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['loaded'] = self.loaded
+        return stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -6,15 +6,325 @@ DEFAULT_PORT = 53
 DEFAULT_SERVER = '8.8.8.8'
 DEFAULT_TIMEOUT = 5
 DEFAULT_NUM_OF_RETRIES = 4
+DEFAULT_JOBS = 256
 import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+from asyncresolver import AsyncResolver
+from cache import ResolverCache
+from diskcache import PersistentCache
+from instrument import Instrumentation, JsonLinesSink, MetricsSink
+from packet import CLASSIC_PAYLOAD
+from prefetch import AsyncPrefetcher, Prefetcher
+from ratelimit import AsyncRateLimiter, RateLimiter
+from replay import TrafficRecorder, TrafficReplay
 from resolver import Resolver
+from sharedcache import SharedCache
+from stubserver import DEFAULT_LISTEN_ADDRESS, DEFAULT_LISTEN_PORT,\
+    StubServer
+
+
+def read_names(args):
+    """
+    The function yields names from arguments and then from input file.
+    Stdin is used when neither names nor file are given.
+    :param args: Namespace
+    :return: generator
+    """
+    yield from args.address
+    source = args.input
+    if source is None and not args.address:
+        source = '-'
+    if source is None:
+        return
+    stream = sys.stdin if source == '-' else open(source, encoding='utf-8')
+    try:
+        for line in stream:
+            name = line.strip()
+            if name and not name.startswith('#'):
+                yield name
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+async def read_names_async(names):
+    """
+    The function yields names of generator made by read_names,
+    every name is taken in default executor, so reading of slow input
+    does not block lookups in flight
+    :param names: generator
+    :return: async generator
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        name = await loop.run_in_executor(None, next, names, None)
+        if name is None:
+            return
+        yield name
+
+
+def print_result(address, received):
+    """
+    The function prints result of one lookup
+    :param address: str
+    :param received: list
+    :return: None
+    """
+    if received == Resolver.NO_RESPONSE:
+        print('\tNo response: {}'.format(address))
+    elif received == Resolver.NAME_NOT_FOUND:
+        print('\t\tName {} does not exist'.format(address))
+    else:
+        print('\tDomain: ' + address)
+        print('\tResponses:')
+        for response in received:
+            print('\t\t{}\t{}'.format(Resolver.TYPES[response[0]],
+                                      response[1]))
+
+
+def print_types(address, results):
+    """
+    The function prints results of lookup of several types
+    :param address: str
+    :param results: dict type -> list
+    :return: None
+    """
+    for query_type, received in results.items():
+        print('{} records:'.format(Resolver.TYPES[query_type]))
+        print_result(address, received)
+
+
+def parse_types(value):
+    """
+    The function converts comma separated names of types to numbers
+    :param value: str, e.g. 'A,AAAA,MX'
+    :return: list
+    """
+    numbers = {name: number for number, name in Resolver.TYPES.items()}
+    try:
+        return [numbers[name.strip().upper()] for name in value.split(',')]
+    except KeyError as error:
+        raise argparse.ArgumentTypeError(
+            'unknown type {}, known: {}'.format(error, ', '.join(numbers)))
+
+
+def print_stats(metrics, limiter):
+    """
+    The function prints counters, latency percentiles and throttling
+    of servers
+    :param metrics: MetricsSink
+    :param limiter: RateLimiter
+    :return: None
+    """
+    print('Statistics:')
+    for counter, value in metrics.counters.items():
+        print('\t{:<14}{}'.format(counter, value))
+    for server in sorted(metrics.histograms):
+        print('\t{:<16} p50 <= {} s, p99 <= {} s'.format(
+            server, metrics.percentile(server, 0.5),
+            metrics.percentile(server, 0.99)))
+    for server, stats in sorted(limiter.get_stats().items()):
+        if stats['throttled']:
+            print('\t{:<16} throttled {} of {} queries for {:.3f} s'.format(
+                server, stats['throttled'], stats['queries'],
+                stats['throttle_time']))
+
+
+def make_instrument(args):
+    """
+    The function attaches sinks asked by --trace and --stats
+    :param args: Namespace
+    :return: tuple (Instrumentation, MetricsSink or None, trace file
+    or None)
+    """
+    instrument = Instrumentation()
+    trace = None
+    if args.trace:
+        trace = sys.stderr if args.trace == '-'\
+            else open(args.trace, 'w', encoding='utf-8')
+        instrument.add_sink(JsonLinesSink(trace))
+    metrics = instrument.add_sink(MetricsSink()) if args.stats else None
+    return instrument, metrics, trace
+
+
+def finish_instrument(metrics, trace, limiter):
+    """
+    The function closes trace file and prints statistics
+    :param metrics: MetricsSink or None
+    :param trace: file or None
+    :param limiter: RateLimiter
+    :return: None
+    """
+    if trace is not None and trace is not sys.stderr:
+        trace.close()
+    if metrics is not None:
+        print_stats(metrics, limiter)
+
+
+def resolve_sequentially(args, names, cache, delegations):
+    """
+    The function resolves names one by one with Resolver
+    :param args: Namespace
+    :param names: iterable
+    :param cache: ResolverCache
+    :param delegations: ResolverCache
+    :return: None
+    """
+    instrument, metrics, trace = make_instrument(args)
+    limiter = RateLimiter(args.qps, args.burst, args.window)
+    recorder = TrafficRecorder(args.record) if args.record else None
+    replay = TrafficReplay(args.replay, not args.no_delay)\
+        if args.replay else None
+    prefetcher = Prefetcher(args.prefetch) if args.prefetch else None
+    with Resolver(args.server, args.debug, args.port, args.num,
+                  args.waiting, cache, delegations=delegations,
+                  edns_payload=args.edns, recorder=recorder,
+                  replay=replay, instrument=instrument,
+                  limiter=limiter, prefetcher=prefetcher) as resolver:
+        for address in names:
+            if args.types:
+                print_types(address, resolver.resolve_types(address,
+                                                            args.types))
+            else:
+                print_result(address, resolver.resolve(address))
+    if prefetcher is not None:
+        prefetcher.close()
+    if recorder is not None:
+        recorder.close()
+    finish_instrument(metrics, trace, limiter)
+
+
+async def resolve_batch(args, names, cache, delegations):
+    """
+    The function resolves names concurrently and prints results
+    as they are ready
+    :param args: Namespace
+    :param names: generator made by read_names
+    :param cache: ResolverCache
+    :param delegations: ResolverCache
+    :return: None
+    """
+    instrument, metrics, trace = make_instrument(args)
+    limiter = AsyncRateLimiter(args.qps, args.burst, args.window)
+    prefetcher = AsyncPrefetcher(args.prefetch) if args.prefetch else None
+    try:
+        async with AsyncResolver(args.server, args.port, args.num,
+                                 args.waiting, cache=cache,
+                                 edns_payload=args.edns, limiter=limiter,
+                                 delegations=delegations,
+                                 instrument=instrument,
+                                 prefetcher=prefetcher) as resolver:
+            async for address, received in resolver.resolve_iter(
+                    read_names_async(names), args.jobs, args.ordered,
+                    args.types):
+                if args.types:
+                    print_types(address, received)
+                else:
+                    print_result(address, received)
+            if prefetcher is not None:
+                await prefetcher.close()
+    finally:
+        finish_instrument(metrics, trace, limiter)
+
+
+def parse_listen(value):
+    """
+    The function splits address of --serve
+    :param value: str, e.g. '127.0.0.1:5353', ':53' or '5353'
+    :return: tuple (address, port)
+    """
+    address, _, port = value.rpartition(':')
+    try:
+        return address or DEFAULT_LISTEN_ADDRESS, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError('bad port {}'.format(port))
+
+
+async def serve(args, cache, delegations=None):
+    """
+    The function answers queries of clients until it is interrupted.
+    Lookups are done by AsyncResolver only, which stores answers,
+    NXDOMAIN and NODATA in cache and zone cuts in delegations.
+    :param args: Namespace
+    :param cache: ResolverCache
+    :param delegations: ResolverCache
+    :return: None
+    """
+    instrument, metrics, trace = make_instrument(args)
+    limiter = AsyncRateLimiter(args.qps, args.burst, args.window)
+    prefetcher = AsyncPrefetcher(args.prefetch) if args.prefetch else None
+    resolver = AsyncResolver(args.server, args.port, args.num, args.waiting,
+                             cache=cache, edns_payload=args.edns,
+                             limiter=limiter, delegations=delegations,
+                             instrument=instrument, prefetcher=prefetcher)
+    server = StubServer(resolver, *args.serve,
+                        reuse_port=args.workers > 1)
+    try:
+        await server.start()
+        print('Serving on {}:{}, pid {}'.format(server.address, server.port,
+                                                os.getpid()),
+              file=sys.stderr)
+        await server.serve_forever()
+    finally:
+        if prefetcher is not None:
+            await prefetcher.close()
+        await resolver.close()
+        # statistics of server are printed when it is interrupted
+        finish_instrument(metrics, trace, limiter)
+
+
+def serve_worker(args, cache):
+    """
+    The function runs server in worker process
+    :param args: Namespace
+    :param cache: ResolverCache
+    :return: None
+    """
+    try:
+        asyncio.run(serve(args, cache))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_workers(args):
+    """
+    The function runs args.workers server processes on one port,
+    they share answers in shared memory. SharedCache gets what
+    AsyncResolver of workers stores: answers, NXDOMAIN and NODATA.
+    Delegations and statistics of servers stay in every worker,
+    so each of them learns zone cuts by itself.
+    :param args: Namespace
+    :return: None
+    """
+    cache = SharedCache()
+    # workers inherit shared memory and its locks
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=serve_worker, args=(args, cache),
+                               daemon=True)
+               for _ in range(args.workers)]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        cache.unlink()
 
 
 def main():
     parser = argparse.ArgumentParser(description='YOBAdns-resolver')
     parser.add_argument(
-        "address", metavar="Address", nargs="+", type=str,
-        help='Address that you need to resolve')
+        "address", metavar="Address", nargs="*", type=str,
+        help='Address that you need to resolve, stdin is read if omitted')
     parser.add_argument(
         "--server", "-s", metavar="Server", nargs="?", type=str,
         default=DEFAULT_SERVER,
@@ -33,23 +343,89 @@ def main():
     parser.add_argument("-w", "--waiting", nargs="?", type=int,
                         default=DEFAULT_TIMEOUT,
                         help="waiting time of request")
+    parser.add_argument("-e", "--edns", metavar="SIZE", type=int,
+                        help="advertise UDP payload size with EDNS0, "
+                             "at least 512, e.g. 1232 or 4096")
+    parser.add_argument("-i", "--input", metavar="FILE", type=str,
+                        help="file with names to resolve, one per line, "
+                             "'-' for stdin")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help="number of concurrent lookups in batch mode")
+    parser.add_argument("--ordered", action="store_true",
+                        help="print batch results in order of input")
+    parser.add_argument("--record", metavar="FILE", type=str,
+                        help="record traffic with servers to file")
+    parser.add_argument("--replay", metavar="FILE", type=str,
+                        help="answer queries from recorded file "
+                             "instead of network")
+    parser.add_argument("--no-delay", action="store_true",
+                        help="replay without recorded latency")
+    parser.add_argument("--trace", metavar="FILE", type=str,
+                        help="write events and traces of lookups to file "
+                             "as JSON lines, '-' for stderr")
+    parser.add_argument("--stats", action="store_true",
+                        help="print counters and latency of servers")
+    parser.add_argument("--qps", type=float,
+                        help="maximum rate of queries to every server")
+    parser.add_argument("--burst", type=int,
+                        help="queries which may be sent at once over --qps, "
+                             "default: one second of queries")
+    parser.add_argument("--window", type=int,
+                        help="maximum number of queries to every server "
+                             "waiting for reply")
+    parser.add_argument("-c", "--cache-file", metavar="FILE", type=str,
+                        help="keep cached answers and delegations in SQLite "
+                             "file between runs")
+    parser.add_argument("--prefetch", metavar="WORKERS", type=int,
+                        help="refresh popular answers in background before "
+                             "they expire, at most WORKERS at once")
+    parser.add_argument("--serve", metavar="[ADDRESS:]PORT", nargs="?",
+                        type=parse_listen,
+                        const=(DEFAULT_LISTEN_ADDRESS,
+                               DEFAULT_LISTEN_PORT),
+                        help="answer DNS queries of other processes over "
+                             "UDP and TCP, default: 127.0.0.1:5353")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of server processes listening on one "
+                             "port with shared cache")
+    parser.add_argument("-t", "--types", metavar="TYPES", type=parse_types,
+                        help="resolve records of several types at once, "
+                             "e.g. A,AAAA,MX")
 
     args = parser.parse_args()
+    if args.workers > 1 and args.cache_file:
+        parser.error('--cache-file does not work with --workers')
+    if args.edns is not None and args.edns < CLASSIC_PAYLOAD:
+        parser.error('--edns must be at least {}'.format(CLASSIC_PAYLOAD))
+    if args.qps is not None and args.qps <= 0:
+        parser.error('--qps must be positive')
+    if args.window is not None and args.window < 1:
+        parser.error('--window must be at least 1')
     ##############################################
-    resolver = Resolver(args.server, args.debug,
-                        args.port, args.num, args.waiting)
-    received = resolver.resolve(args.address[0])
-    if received == resolver.NO_RESPONSE:
-        print('\tNo response')
-    else:
-        if received == resolver.NAME_NOT_FOUND:
-            print('\t\tName {} does not exist'.format(args.address[0]))
+    names = read_names(args)
+    cache = ResolverCache()
+    delegations = ResolverCache()
+    if args.cache_file:
+        cache = PersistentCache(args.cache_file)
+        delegations = PersistentCache(args.cache_file, 'delegations')
+    try:
+        if args.serve and args.workers > 1:
+            serve_workers(args)
+        elif args.serve:
+            try:
+                asyncio.run(serve(args, cache, delegations))
+            except KeyboardInterrupt:
+                pass
+        elif args.debug or args.record or args.replay:
+            # debug output of concurrent lookups would be mixed up,
+            # recording and replay work with sequential lookups
+            resolve_sequentially(args, names, cache, delegations)
         else:
-            print('\tDomain: ' + args.address[0])
-            print('\tResponses:')
-            for response in received:
-                print('\t\t{}\t{}'.format(resolver.TYPES[response[0]],
-                                          response[1]))
+            asyncio.run(resolve_batch(args, names, cache, delegations))
+    finally:
+        if args.cache_file:
+            cache.close()
+            delegations.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,443 @@
+"""
+The module runs fake DNS hierarchy on localhost: root, TLD and
+authoritative servers answering over UDP and TCP.
+Servers may be slow, lose queries and truncate responses, so resolver
+can be tested and benchmarked without internet.
+"""
+__author__ = 'Skipper'
+DEFAULT_TTL = 300
+DELEGATION_TTL = 3600
+SOA_MINIMUM = 30
+ROOT_ADDRESS = '127.0.0.1'
+RECEIVE_BUFFER = 4 * 1024 * 1024
+
+import asyncio
+import random
+import socket
+import struct
+import threading
+from packet import CLASSIC_PAYLOAD, QueryPacket, ResponsePacket
+from ratelimit import TokenBucket
+from transport import LENGTH
+
+RCODE_FORMAT_ERROR = 1
+RCODE_NAME_ERROR = 3
+RCODE_REFUSED = 5
+
+
+class FakeZone:
+    """
+    Records and delegations of one zone
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.records = {}
+        self.owners = {name}
+        self.delegations = {}
+
+    def add_record(self, owner, record_type, data, ttl=DEFAULT_TTL):
+        """
+        The method adds record to zone
+        :param owner: str
+        :param record_type: int
+        :param data: str or tuple for MX
+        :param ttl: int
+        :return: None
+        """
+        self.records.setdefault((owner, record_type), []).append((ttl, data))
+        self.owners.add(owner)
+
+    def delegate(self, child, nameservers, ttl=DELEGATION_TTL):
+        """
+        The method delegates child zone to nameservers
+        :param child: str
+        :param nameservers: list of (name, address), address is None
+        for nameserver without glue
+        :param ttl: int
+        :return: None
+        """
+        self.delegations[child] = (nameservers, ttl)
+
+    def answer(self, response, name, query_type):
+        """
+        The method fills response to question about name
+        :param response: ResponsePacket
+        :param name: str - lower case without trailing dot
+        :param query_type: int
+        :return: None
+        """
+        child = None
+        for zone in self.delegations:
+            if in_zone(name, zone) and (child is None
+                                        or len(zone) > len(child)):
+                child = zone
+        if child is not None:
+            nameservers, ttl = self.delegations[child]
+            for ns_name, address in nameservers:
+                response.add_authority(child, QueryPacket.QU_NS, ttl, ns_name)
+                if address is not None:
+                    response.add_additional(ns_name, QueryPacket.QU_A, ttl,
+                                            address)
+            return
+        response.aa = 1
+        found = self._add_records_(response, name, query_type)
+        if not found and query_type != QueryPacket.QU_CNAME:
+            for ttl, target in self.records.get((name, QueryPacket.QU_CNAME),
+                                                []):
+                response.add_answer(name, QueryPacket.QU_CNAME, ttl, target)
+                self._add_records_(response, target, query_type)
+                found = True
+        if not found and name not in self.owners:
+            response.rcode = RCODE_NAME_ERROR
+        if not found:
+            # negative answers are cached for SOA_MINIMUM seconds
+            response.add_authority(self.name, QueryPacket.QU_SOA,
+                                   DEFAULT_TTL, self._soa_())
+
+    def _soa_(self):
+        # SOA data is kept uncompressed: mname, rname, serial, refresh,
+        # retry, expire and minimum
+        names = b''
+        for name in ('ns.' + self.name, 'hostmaster.' + self.name):
+            names += b''.join(bytes((len(label),)) + label.encode()
+                              for label in name.strip('.').split('.'))\
+                + b'\x00'
+        return names + struct.pack('!IIIII', 1, 3600, 600, 86400,
+                                   SOA_MINIMUM)
+
+    def _add_records_(self, response, name, query_type):
+        records = self.records.get((name, query_type), [])
+        for ttl, data in records:
+            response.add_answer(name, query_type, ttl, data)
+        return bool(records)
+
+
+def in_zone(name, zone):
+    """
+    The function checks that name belongs to zone
+    :param name: str
+    :param zone: str
+    :return: bool
+    """
+    return zone == '' or name == zone or name.endswith('.' + zone)
+
+
+class FakeServer:
+    """
+    Server answering for its zones over UDP and TCP.
+    latency - delay of every reply in seconds, loss - probability
+    to ignore UDP query, truncate - answer every UDP query with TC flag,
+    max_qps - UDP queries over this rate are dropped like by rate limiting,
+    edns - False makes server answer queries with OPT record by FORMERR
+    like old servers do.
+    """
+
+    def __init__(self, address, latency=0.0, loss=0.0, truncate=False,
+                 max_qps=None):
+        self.address = address
+        self.latency = latency
+        self.loss = loss
+        self.truncate = truncate
+        self.edns = True
+        self.zones = {}
+        self.received = 0
+        self.tcp_received = 0
+        self.dropped = 0
+        self.bucket = None
+        if max_qps is not None:
+            self.set_max_qps(max_qps)
+        self.transport = None
+        self.tcp_server = None
+
+    def set_max_qps(self, max_qps, burst=1):
+        """
+        The method limits rate of answered UDP queries
+        :param max_qps: float
+        :param burst: int
+        :return: None
+        """
+        self.bucket = TokenBucket(max_qps, burst)
+
+    def find_zone(self, name):
+        """
+        The method finds the deepest zone of server containing name
+        :param name: str
+        :return: FakeZone
+        """
+        found = None
+        for zone in self.zones.values():
+            if in_zone(name, zone.name) and (found is None or
+                                             len(zone.name) > len(found.name)):
+                found = zone
+        return found
+
+    def handle(self, raw_query, udp):
+        """
+        The method makes response to raw query. UDP response is limited
+        by payload size of query.
+        :param raw_query: bytes
+        :param udp: bool
+        :return: bytes or None if query is malformed
+        """
+        try:
+            query = QueryPacket.query_packet_from_bytes(raw_query)
+        except Exception:
+            return None
+        response = ResponsePacket(query)
+        if not self.edns and query.edns_payload is not None:
+            response.edns_payload = None
+            response.rcode = RCODE_FORMAT_ERROR
+        elif query.questions:
+            question = query.questions[0]
+            name = question.query_name.lower().rstrip('.')
+            zone = self.find_zone(name)
+            if zone is None:
+                response.rcode = RCODE_REFUSED
+            else:
+                zone.answer(response, name, question.query_type)
+        max_size = None
+        if udp:
+            max_size = max(query.edns_payload or 0, CLASSIC_PAYLOAD)
+            if self.truncate:
+                max_size = 12
+        return response.get_packet(max_size)
+
+    async def start(self, port):
+        """
+        The method starts listening on (address, port)
+        :param port: int
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: FakeDatagramProtocol(self), local_addr=(self.address,
+                                                            port))
+        # bursts of queries must not be lost in socket buffer
+        self.transport.get_extra_info('socket').setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        self.tcp_server = await asyncio.start_server(
+            self._serve_tcp_, self.address, port, reuse_address=True)
+
+    async def _serve_tcp_(self, reader, writer):
+        try:
+            while True:
+                length = LENGTH.unpack(await reader.readexactly(2))[0]
+                raw_query = await reader.readexactly(length)
+                self.tcp_received += 1
+                asyncio.ensure_future(self._reply_tcp_(writer, raw_query))
+        except (asyncio.IncompleteReadError, OSError):
+            writer.close()
+
+    async def _reply_tcp_(self, writer, raw_query):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        reply = self.handle(raw_query, False)
+        if reply is not None and not writer.is_closing():
+            writer.write(LENGTH.pack(len(reply)) + reply)
+
+    def close(self):
+        """
+        The method stops server
+        :return: None
+        """
+        if self.transport is not None:
+            self.transport.close()
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+
+
+class FakeDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    UDP side of FakeServer
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        server = self.server
+        server.received += 1
+        if server.loss and random.random() < server.loss:
+            return
+        if server.bucket is not None and server.bucket.reserve() > 0:
+            # tokens lent in advance are given back, query is dropped
+            server.bucket.tokens += 1
+            server.dropped += 1
+            return
+        reply = server.handle(data, True)
+        if reply is None:
+            return
+        if server.latency:
+            asyncio.get_running_loop().call_later(
+                server.latency, self.transport.sendto, reply, addr)
+        else:
+            self.transport.sendto(reply, addr)
+
+
+class FakeHierarchy:
+    """
+    The class builds and runs tree of FakeServers on loopback addresses
+    127.0.0.1 (root), 127.0.0.2, ... which listen on one port.
+    Every zone is served by its own server unless address is given.
+    """
+
+    def __init__(self, port=0, latency=0.0, loss=0.0):
+        self.port = port
+        self.latency = latency
+        self.loss = loss
+        self.servers = {}
+        self.zones = {}
+        self.loop = None
+        self.thread = None
+        self.add_zone('', ROOT_ADDRESS)
+
+    @property
+    def root(self):
+        """
+        Address of root server
+        :return: str
+        """
+        return ROOT_ADDRESS
+
+    def add_zone(self, name, address=None):
+        """
+        The method creates zone and delegates it from its parent zone
+        :param name: str
+        :param address: str - address of server, new one if omitted
+        :return: FakeZone
+        """
+        name = name.lower().rstrip('.')
+        if address is None:
+            address = '127.0.0.{}'.format(len(self.servers) + 1)
+        server = self.servers.get(address)
+        if server is None:
+            server = FakeServer(address, self.latency, self.loss)
+            self.servers[address] = server
+        zone = FakeZone(name)
+        server.zones[name] = zone
+        self.zones[name] = zone
+        parent = self._parent_zone_(name)
+        if parent is not None:
+            ns_name = 'ns.' + name
+            parent.delegate(name, [(ns_name, address)])
+            zone.add_record(ns_name, QueryPacket.QU_A, address,
+                            DELEGATION_TTL)
+        return zone
+
+    def _parent_zone_(self, name):
+        if name == '':
+            return None
+        labels = name.split('.')
+        for i in range(1, len(labels) + 1):
+            parent = self.zones.get('.'.join(labels[i:]))
+            if parent is not None:
+                return parent
+        return None
+
+    def add_record(self, owner, record_type, data, ttl=DEFAULT_TTL):
+        """
+        The method adds record to the deepest zone containing owner,
+        zones of parents are created if they do not exist
+        :param owner: str
+        :param record_type: int
+        :param data: str or tuple
+        :param ttl: int
+        :return: None
+        """
+        owner = owner.lower().rstrip('.')
+        labels = owner.split('.')
+        for i in range(len(labels) - 1, 0, -1):
+            zone = '.'.join(labels[i:])
+            if zone not in self.zones:
+                self.add_zone(zone)
+        zone = self._parent_zone_(owner) if owner not in self.zones \
+            else self.zones[owner]
+        zone.add_record(owner, record_type, data, ttl)
+
+    def server_of(self, zone):
+        """
+        The method returns server which serves zone
+        :param zone: str
+        :return: FakeServer
+        """
+        for server in self.servers.values():
+            if zone in server.zones:
+                return server
+        return None
+
+    def start(self):
+        """
+        The method starts all servers in background thread
+        :return: FakeHierarchy
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_(), self.loop).result()
+        return self
+
+    async def _start_(self):
+        root = self.servers[ROOT_ADDRESS]
+        await root.start(self.port)
+        self.port = root.transport.get_extra_info('sockname')[1]
+        for server in self.servers.values():
+            if server is not root:
+                await server.start(self.port)
+
+    def stop(self):
+        """
+        The method stops servers and their thread
+        :return: None
+        """
+        if self.loop is None:
+            return
+
+        async def close():
+            for server in self.servers.values():
+                server.close()
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def make_hierarchy(count, tlds=('com', 'net', 'org', 'ru'), domains=50,
+                   latency=0.0, loss=0.0):
+    """
+    The function builds hierarchy with count hosts spread over
+    domains second level zones of tlds
+    :param count: int
+    :param tlds: tuple
+    :param domains: int - number of second level zones
+    :param latency: float
+    :param loss: float
+    :return: FakeHierarchy, list of host names
+    """
+    hierarchy = FakeHierarchy(latency=latency, loss=loss)
+    for tld in tlds:
+        hierarchy.add_zone(tld)
+    zones = []
+    for i in range(domains):
+        zone = 'domain{}.{}'.format(i, tlds[i % len(tlds)])
+        hierarchy.add_zone(zone)
+        zones.append(zone)
+    names = []
+    for i in range(count):
+        name = 'host{}.{}'.format(i, zones[i % len(zones)])
+        hierarchy.add_record(name, QueryPacket.QU_A,
+                             socket.inet_ntoa(i.to_bytes(4, 'big')))
+        names.append(name)
+    return hierarchy, names
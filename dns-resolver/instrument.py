@@ -0,0 +1,399 @@
+"""
+The module collects events of Resolver: queries, replies, timeouts and
+lookups, and passes them to attached sinks. Without sinks every event
+costs one method call. Per-lookup trace of recursion hops is kept in
+context variable, so every thread and every asyncio task builds its
+own trace, which is given to sinks when lookup is finished.
+"""
+__author__ = 'Skipper'
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1, 2, 5)
+
+import bisect
+import contextvars
+import json
+import threading
+import time
+
+
+class Sink:
+    """
+    Receiver of events, all methods do nothing by default
+    """
+
+    def lookup_started(self, name):
+        pass
+
+    def cache_hit(self, name, negative):
+        pass
+
+    def send_packet(self, server, identifier, attempt=0, tcp=False):
+        pass
+
+    def receive_packet(self, packet, server, identifier, rtt=None):
+        pass
+
+    def name_error(self, server, identifier, rtt=None):
+        pass
+
+    def timeout(self, server):
+        pass
+
+    def no_response(self, server):
+        pass
+
+    def truncated(self, server):
+        pass
+
+    def lookup_finished(self, trace):
+        pass
+
+
+class Instrumentation:
+    """
+    The class dispatches events of resolver to sinks and keeps traces
+    of lookups in progress
+    """
+
+    def __init__(self, sinks=(), clock=time.perf_counter):
+        self.sinks = list(sinks)
+        self.clock = clock
+        self._trace_ = contextvars.ContextVar('trace', default=None)
+
+    def add_sink(self, sink):
+        """
+        The method attaches sink
+        :param sink: Sink
+        :return: Sink
+        """
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        """
+        The method detaches sink
+        :param sink: Sink
+        :return: None
+        """
+        self.sinks.remove(sink)
+
+    def lookup_started(self, name):
+        """
+        The method begins trace of lookup
+        :param name: str
+        :return: None
+        """
+        if not self.sinks:
+            return
+        self._trace_.set({'name': name, 'started': time.time(),
+                          'clock': self.clock(), 'hops': []})
+        for sink in self.sinks:
+            sink.lookup_started(name)
+
+    def cache_hit(self, name, negative):
+        """
+        The method registers answer from cache
+        :param name: str
+        :param negative: bool
+        :return: None
+        """
+        if not self.sinks:
+            return
+        trace = self._trace_.get()
+        if trace is not None:
+            trace['cached'] = True
+        for sink in self.sinks:
+            sink.cache_hit(name, negative)
+
+    def send_packet(self, server, identifier, attempt=0, tcp=False):
+        """
+        The method registers query sent to server
+        :param server: str
+        :param identifier: int
+        :param attempt: int - number of retry, 0 for the first query
+        :param tcp: bool
+        :return: None
+        """
+        if not self.sinks:
+            return
+        trace = self._trace_.get()
+        if trace is not None:
+            trace['hops'].append({
+                'server': server, 'id': identifier, 'attempt': attempt,
+                'tcp': tcp, 'sent': self.clock() - trace['clock'],
+                'rtt': None, 'outcome': None})
+        for sink in self.sinks:
+            sink.send_packet(server, identifier, attempt, tcp)
+
+    def receive_packet(self, packet, server, identifier, rtt=None):
+        """
+        The method registers reply of server
+        :param packet: ReceivedPacket
+        :param server: str
+        :param identifier: int
+        :param rtt: float - seconds since query was sent
+        :return: None
+        """
+        if not self.sinks:
+            return
+        if packet.answer_quantity:
+            outcome = 'answer'
+        elif packet.rcode:
+            outcome = 'rcode {}'.format(packet.rcode)
+        else:
+            outcome = 'referral'
+        self._finish_hop_(server, rtt, outcome)
+        for sink in self.sinks:
+            sink.receive_packet(packet, server, identifier, rtt)
+
+    def name_error(self, server, identifier, rtt=None):
+        """
+        The method registers NXDOMAIN reply of server
+        :param server: str
+        :param identifier: int
+        :param rtt: float
+        :return: None
+        """
+        if not self.sinks:
+            return
+        self._finish_hop_(server, rtt, 'nxdomain')
+        for sink in self.sinks:
+            sink.name_error(server, identifier, rtt)
+
+    def timeout(self, server):
+        """
+        The method registers query left without reply
+        :param server: str
+        :return: None
+        """
+        if not self.sinks:
+            return
+        self._finish_hop_(server, None, 'timeout')
+        for sink in self.sinks:
+            sink.timeout(server)
+
+    def no_response(self, server):
+        """
+        The method registers server given up
+        :param server: str
+        :return: None
+        """
+        if not self.sinks:
+            return
+        for sink in self.sinks:
+            sink.no_response(server)
+
+    def truncated(self, server):
+        """
+        The method registers truncated reply
+        :param server: str
+        :return: None
+        """
+        if not self.sinks:
+            return
+        for sink in self.sinks:
+            sink.truncated(server)
+
+    def lookup_finished(self, name, result):
+        """
+        The method completes trace of lookup and passes it to sinks
+        :param name: str
+        :param result: list
+        :return: None
+        """
+        if not self.sinks:
+            return
+        trace = self._trace_.get()
+        self._trace_.set(None)
+        if trace is None or trace['name'] != name:
+            trace = {'name': name, 'started': time.time(),
+                     'clock': self.clock(), 'hops': []}
+        trace['elapsed'] = self.clock() - trace.pop('clock')
+        if result and result[0][0] == -1:
+            trace['result'] = 'nxdomain'
+        elif result and result[0][0] == -2:
+            trace['result'] = 'no response'
+        else:
+            trace['result'] = 'answer'
+        trace.setdefault('cached', False)
+        for sink in self.sinks:
+            sink.lookup_finished(trace)
+
+    def _finish_hop_(self, server, rtt, outcome):
+        trace = self._trace_.get()
+        if trace is None:
+            return
+        for hop in reversed(trace['hops']):
+            if hop['server'] == server and hop['outcome'] is None:
+                hop['rtt'] = rtt
+                hop['outcome'] = outcome
+                return
+
+
+class MetricsSink(Sink):
+    """
+    The sink counts events and keeps histogram of latency of every server.
+    Bucket i of histogram counts replies faster than LATENCY_BUCKETS[i],
+    the last bucket counts slower ones.
+    """
+
+    COUNTERS = ('lookups', 'cache_hits', 'queries', 'retries',
+                'tcp_queries', 'replies', 'timeouts', 'no_responses',
+                'truncated', 'nxdomain', 'failures')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def _count_(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _add_latency_(self, server, rtt):
+        with self.lock:
+            self.counters['replies'] += 1
+            if rtt is None:
+                return
+            histogram = self.histograms.get(server)
+            if histogram is None:
+                histogram = self.histograms[server] = \
+                    [0] * (len(self.buckets) + 1)
+            histogram[bisect.bisect_left(self.buckets, rtt)] += 1
+
+    def cache_hit(self, name, negative):
+        self._count_('cache_hits')
+
+    def send_packet(self, server, identifier, attempt=0, tcp=False):
+        self._count_('tcp_queries' if tcp else 'queries')
+        if attempt:
+            self._count_('retries')
+
+    def receive_packet(self, packet, server, identifier, rtt=None):
+        self._add_latency_(server, rtt)
+
+    def name_error(self, server, identifier, rtt=None):
+        self._add_latency_(server, rtt)
+
+    def timeout(self, server):
+        self._count_('timeouts')
+
+    def no_response(self, server):
+        self._count_('no_responses')
+
+    def truncated(self, server):
+        self._count_('truncated')
+
+    def lookup_finished(self, trace):
+        self._count_('lookups')
+        if trace['result'] == 'nxdomain':
+            self._count_('nxdomain')
+        elif trace['result'] == 'no response':
+            self._count_('failures')
+
+    def percentile(self, server, fraction):
+        """
+        The method estimates percentile of latency of server by upper
+        bound of its bucket
+        :param server: str
+        :param fraction: float
+        :return: float or None if there are no replies
+        """
+        histogram = self.histograms.get(server)
+        if not histogram:
+            return None
+        rank = fraction * sum(histogram)
+        total = 0
+        for i, count in enumerate(histogram):
+            total += count
+            if count and total >= rank:
+                return self.buckets[i] if i < len(self.buckets)\
+                    else float('inf')
+        return float('inf')
+
+    def get_stats(self):
+        """
+        The method returns copy of counters and histograms
+        :return: dict
+        """
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'latency': {server: list(histogram) for server, histogram
+                                in self.histograms.items()},
+                    'buckets': list(self.buckets)}
+
+
+class EventSink(Sink):
+    """
+    The sink turns every event into (event, fields) and gives it to emit,
+    which does nothing by default like other hooks of Sink
+    """
+
+    def emit(self, event, fields):
+        pass
+
+    def lookup_started(self, name):
+        self.emit('lookup_started', {'name': name})
+
+    def cache_hit(self, name, negative):
+        self.emit('cache_hit', {'name': name, 'negative': negative})
+
+    def send_packet(self, server, identifier, attempt=0, tcp=False):
+        self.emit('send', {'server': server, 'id': identifier,
+                           'attempt': attempt, 'tcp': tcp})
+
+    def receive_packet(self, packet, server, identifier, rtt=None):
+        self.emit('receive', {
+            'server': server, 'id': identifier, 'rtt': rtt,
+            'rcode': packet.rcode, 'aa': packet.aa, 'tc': packet.tc,
+            'answers': packet.answer_quantity,
+            'authority': packet.authority_quantity,
+            'additional': packet.additional_info_quantity,
+            'size': len(packet.raw_packet)})
+
+    def name_error(self, server, identifier, rtt=None):
+        self.emit('nxdomain', {'server': server, 'id': identifier,
+                               'rtt': rtt})
+
+    def timeout(self, server):
+        self.emit('timeout', {'server': server})
+
+    def no_response(self, server):
+        self.emit('no_response', {'server': server})
+
+    def truncated(self, server):
+        self.emit('truncated', {'server': server})
+
+    def lookup_finished(self, trace):
+        self.emit('lookup', trace)
+
+
+class JsonLinesSink(EventSink):
+    """
+    The sink writes every event as JSON object on its own line
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def emit(self, event, fields):
+        line = json.dumps(dict(fields, event=event, time=time.time()))
+        with self.lock:
+            self.stream.write(line + '\n')
+
+
+class MemorySink(EventSink):
+    """
+    The sink keeps events and finished traces in lists
+    """
+
+    def __init__(self):
+        self.events = []
+        self.traces = []
+
+    def emit(self, event, fields):
+        self.events.append((event, fields))
+        if event == 'lookup':
+            self.traces.append(fields)
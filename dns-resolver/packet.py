@@ -3,13 +3,49 @@ The module works with DNS-protocol's packets: can make and parse it.
 """
 __author__ = 'Skipper'
 
-import copy
+import functools
+import socket
+import struct
+import sys
+
+HEADER = struct.Struct('!HBBHHHH')
+IDENTIFIER = struct.Struct('!H')
+TTL = struct.Struct('!I')
+QUESTION_TAIL = struct.Struct('!HH')
+RECORD_HEADER = struct.Struct('!HHIH')
+MAX_NAME_LENGTH = 255
+QUESTION_CACHE_SIZE = 65536
+CLASSIC_PAYLOAD = 512
+
+
+@functools.lru_cache(maxsize=QUESTION_CACHE_SIZE)
+def encode_question(name, query_type, query_class=1):
+    """
+    The function encodes question section entry, results are cached
+    :param name: str
+    :param query_type: int
+    :param query_class: int
+    :return: bytes
+    """
+    question = bytearray()
+    for part in name.split('.'):
+        label = part.encode('utf8')
+        if len(label) > 63:
+            raise Exception('Too long label in name')
+        if label:
+            question.append(len(label))
+            question.extend(label)
+    question.append(0)
+    if len(question) > MAX_NAME_LENGTH:
+        raise Exception('Too long name')
+    question.extend(QUESTION_TAIL.pack(query_type, query_class))
+    return bytes(question)
 
 
 class Query:
     """
     Class for queries in QueryPacket and ReceivedPacket.
-    Can form bytearray query.
+    Can form bytes of query.
     """
 
     def __init__(self, address, query_type, query_class=1):
@@ -20,35 +56,28 @@ class Query:
     def form_question(self):
         """
         This method form question packet
-        :return: bytearray
-        """
-        question = ''
-        question.encode('utf8')
-        parts = self.query_name.split('.')
-        for part in parts:
-            question += chr(len(bytearray(part, 'utf8')))
-            question += part
-        bquestion = bytearray(question, 'utf8')
-        bquestion.extend((0, 0, self.query_type, 0, self.query_class))
-        return bquestion
+        :return: bytes
+        """
+        return encode_question(self.query_name, self.query_type,
+                               self.query_class)
 
     @staticmethod
-    def query_from_bytes(answer: bytearray):
+    def query_from_bytes(answer: bytes, pointer=0):
         """
         The method initialize Query-object from raw packet
-        :param answer: bytearray
-        :return: Query
+        :param answer: bytes
+        :param pointer: int - offset of question in answer
+        :return: Query, offset of the end of question
         """
-        pointer = 0
-        query_name = ''  # одинаковый код - исправить
+        labels = []
         while answer[pointer] != 0:
-            for j in range(answer[pointer]):
-                query_name += chr(answer[pointer+j+1])
-            query_name += '.'
-            pointer += answer[pointer] + 1
+            length = answer[pointer]
+            labels.append(bytes(answer[pointer+1:pointer+1+length])
+                          .decode('latin-1'))
+            pointer += length + 1
         pointer += 1
-        query_type = (answer[pointer] << 8) + answer[pointer+1]
-        query_class = (answer[pointer+2] << 8) + answer[pointer+3]
+        query_type, query_class = QUESTION_TAIL.unpack_from(answer, pointer)
+        query_name = ''.join(label + '.' for label in labels)
         return Query(query_name, query_type, query_class), pointer+4
 
 
@@ -56,10 +85,17 @@ class ResourceRecord:
     """
     Class for resource records in ReceivedPacket.
     May be initialized from bytearray and can parse data.
+    Record refers to its packet only until data is decoded, then it keeps
+    copy of its own data, so kept records do not keep whole packets.
+    Owner and target names are interned and shared by every record.
     """
 
+    __slots__ = ('global_shift', 'name', 'record_type', 'query_class', 'ttl',
+                 'length', 'raw_data', 'packet', 'data_offset', '_data_',
+                 '_decoded_')
+
     def __init__(self, global_shift, name, record_type,
-                 query_class, ttl, length, data: bytearray, packet):
+                 query_class, ttl, length, data, packet, data_offset):
         self.global_shift = global_shift
         self.name = name
         self.record_type = record_type
@@ -68,28 +104,46 @@ class ResourceRecord:
         self.length = length
         self.raw_data = data
         self.packet = packet
-        self.data = self._decode_data_()
+        self.data_offset = data_offset
+        self._data_ = None
+        self._decoded_ = False
+
+    @property
+    def data(self):
+        """
+        Data of record, it is decoded on first access
+        :return: str
+        """
+        if not self._decoded_:
+            self._data_ = self._decode_data_()
+            self._decoded_ = True
+            self.raw_data = bytes(self.raw_data)
+            self.packet = None
+        return self._data_
 
     @staticmethod
-    def resource_record_from_bytes(global_shift, name,
-                                   raw_record: bytearray, packet):
+    def resource_record_from_bytes(global_shift, name, raw_packet, pointer,
+                                   packet):
         """
         The method initialize ResourceRecord-object from raw packet
+        without copying its data
         :param global_shift: int
         :param name: str
-        :param raw_record: bytearray
+        :param raw_packet: memoryview
+        :param pointer: int - offset of record type in raw_packet
         :param packet: ReceivedPacket
-        :return: ResourceRecord
-        """
-        record_type = (raw_record[0] << 8) + raw_record[1]
-        query_class = (raw_record[2] << 8) + raw_record[3]
-        ttl = (raw_record[4] << 24) + (raw_record[5] << 16)\
-            + (raw_record[6] << 8) + raw_record[7]
-        length = (raw_record[8] << 8) + raw_record[9]
-        data = raw_record[10:(10+length)]
+        :return: ResourceRecord, offset of the end of record
+        """
+        record_type, query_class, ttl, length = RECORD_HEADER.unpack_from(
+            raw_packet, pointer)
+        pointer += 10
+        if pointer + length > len(raw_packet):
+            raise Exception('Record is out of packet')
+        data = raw_packet[pointer:pointer+length]
         record = ResourceRecord(global_shift, name, record_type,
-                                query_class, ttl, length, data, packet)
-        return record, 10+length
+                                query_class, ttl, length, data, packet,
+                                pointer)
+        return record, pointer+length
 
     def _decode_data_(self):
         switch = {QueryPacket.QU_A: self._decode_a_,
@@ -103,31 +157,25 @@ class ResourceRecord:
             return ''
 
     def _decode_a_(self):
-        data = ".".join(map(str, self.raw_data[0:4]))
+        data = '{}.{}.{}.{}'.format(*self.raw_data[0:4])
         return data
 
     def _decode_cname_(self):
-        data = self.packet.get_string(self.raw_data, 0)[0]
+        data = sys.intern(self.packet.get_string(self.data_offset)[0])
         return data
 
     def _decode_mx_(self):
-        preference = self.raw_data[0] << 8 + self.raw_data[1]
-        mail_exchange = self.packet.get_string(self.raw_data, 2)[0]
+        preference = (self.raw_data[0] << 8) + self.raw_data[1]
+        mail_exchange = sys.intern(
+            self.packet.get_string(self.data_offset + 2)[0])
         return preference, mail_exchange
 
     def _decode_aaaa_(self):
-        ipv6_address = ''
-        hex_data = []
-        for block in self.raw_data:
-            hex_data.append('{:0>2}'.format(str(hex(block))[2:]))
-        for index, block in enumerate(hex_data):
-            ipv6_address += block
-            if (index % 2) == 1:
-                ipv6_address += ':'
-        return ipv6_address[:-1]
+        return ':'.join('{:04x}'.format(block) for block
+                        in struct.unpack('!8H', self.raw_data))
 
     def _decode_ns_(self):
-        data = self.packet.get_string(self.raw_data, 0)[0]
+        data = sys.intern(self.packet.get_string(self.data_offset)[0])
         return data
 
     def get_data(self):
@@ -151,10 +199,12 @@ class QueryPacket:
     QU_A = 1  # A query
     QU_NS = 2  # NS query
     QU_CNAME = 5  # canonical name query
+    QU_SOA = 6  # start of authority
     QU_PTR = 12  # pointer record
     QU_HINFO = 13  # host information
     QU_MX = 15  # MX query
     QU_AAAA = 28  # A query
+    QU_OPT = 41  # EDNS0 pseudo-record
     QU_AXFR = 252  # запрос на передачу зоны
     QU_ANY = 255  # запрос всех записей
 
@@ -169,6 +219,9 @@ class QueryPacket:
         self.ra = 0  # только для ответа
         self.rcode = 0  # только для ответа
         self.questions = []
+        self.edns_payload = None
+        self.dnssec_ok = 0
+        self._template_ = None
 
     def add_question(self, address, query_type, query_class=1):
         """
@@ -181,38 +234,49 @@ class QueryPacket:
         # query_class равен 1 для интернета.
         # остальное нинужна
         self.questions.append(Query(address, query_type, query_class))
+        self._template_ = None
+
+    def set_edns(self, payload_size, dnssec_ok=False):
+        """
+        The method adds EDNS0 OPT record advertising UDP payload size,
+        sizes below CLASSIC_PAYLOAD mean CLASSIC_PAYLOAD (RFC 6891)
+        :param payload_size: int - None removes OPT record
+        :param dnssec_ok: bool
+        :return: None
+        """
+        self.edns_payload = None if payload_size is None\
+            else max(payload_size, CLASSIC_PAYLOAD)
+        self.dnssec_ok = int(dnssec_ok)
+        self._template_ = None
 
     def _form_header_(self):
-        header = bytearray()
-        # id
-        header.extend([self.identifier // 256, self.identifier % 256])
-        # flags
-        flag = self.qr
-        flag <<= 4
-        flag += self.opcode
-        flag <<= 2
-        flag += self.rd
-        header.extend([flag, 0, len(self.questions) // 256,
-                       len(self.questions) % 256, 0, 0, 0, 0, 0, 0])
-        return header
+        flag = (self.qr << 7) + (self.opcode << 3) + self.rd
+        additional = 0 if self.edns_payload is None else 1
+        return HEADER.pack(self.identifier & 0xffff, flag, 0,
+                           len(self.questions), 0, 0, additional)
+
+    def _form_opt_(self):
+        if self.edns_payload is None:
+            return b''
+        return b'\x00' + RECORD_HEADER.pack(
+            self.QU_OPT, self.edns_payload, self.dnssec_ok << 15, 0)
 
     def _form_questions_(self):
         if len(self.questions) == 0:
             raise Exception('there is no questions')
-        questions = bytearray()
-        for question in self.questions:
-            questions.extend(question.form_question())
-        return questions
+        return b''.join(question.form_question()
+                        for question in self.questions)
 
     def get_packet(self):
         """
-        The method return complete packet for request
-        :return: bytearray
+        The method return complete packet for request.
+        Packet is assembled once, later only identifier is changed.
+        :return: bytes
         """
-        packet = bytearray()
-        packet.extend(self._form_header_())
-        packet.extend(self._form_questions_())
-        return packet
+        if self._template_ is None:
+            self._template_ = self._form_header_()[2:] \
+                + self._form_questions_() + self._form_opt_()
+        return IDENTIFIER.pack(self.identifier & 0xffff) + self._template_
 
     def increment_id(self):
         """
@@ -221,6 +285,155 @@ class QueryPacket:
         """
         self.identifier += 1
 
+    @staticmethod
+    def query_packet_from_bytes(received: bytes):
+        """
+        The method initialize QueryPacket-object from query sent by client
+        :param received: bytes
+        :return: QueryPacket
+        """
+        if len(received) < 12:
+            raise Exception('To small packet')
+        (identifier, flags, _, query_quantity, _, _,
+         additional_quantity) = HEADER.unpack_from(received)
+        if flags >> 7:
+            raise Exception('It is response packet')
+        packet = QueryPacket(identifier, (flags >> 3) & 15, flags & 1)
+        pointer = 12
+        for _ in range(query_quantity):
+            query, pointer = Query.query_from_bytes(received, pointer)
+            packet.questions.append(query)
+        if additional_quantity and received[pointer:pointer+1] == b'\x00':
+            record_type, payload_size, ttl, _ = RECORD_HEADER.unpack_from(
+                received, pointer + 1)
+            if record_type == QueryPacket.QU_OPT:
+                packet.set_edns(payload_size, (ttl >> 15) & 1)
+        return packet
+
+
+class ResponsePacket:
+    """
+    The class form response to QueryPacket, names are compressed.
+    Data of records is given in the same form as ResourceRecord decodes it.
+    Offsets of TTL fields of the last formed packet are kept in ttl_offsets.
+    """
+
+    def __init__(self, query: QueryPacket):
+        self.identifier = query.identifier
+        self.opcode = query.opcode
+        self.aa = 0
+        self.tc = 0
+        self.rd = query.rd
+        self.ra = 0
+        self.rcode = 0
+        self.questions = query.questions
+        self.edns_payload = query.edns_payload
+        self.answers = []
+        self.authoritative_nameservers = []
+        self.additional_records = []
+        self.ttl_offsets = []
+
+    def add_answer(self, name, record_type, ttl, data, query_class=1):
+        """
+        The method add record to answer section
+        :param name: str
+        :param record_type: int
+        :param ttl: int
+        :param data: str, tuple for MX or bytes
+        :param query_class: int
+        :return: None
+        """
+        self.answers.append((name, record_type, query_class, ttl, data))
+
+    def add_authority(self, name, record_type, ttl, data, query_class=1):
+        """
+        The method add record to authority section
+        :return: None
+        """
+        self.authoritative_nameservers.append(
+            (name, record_type, query_class, ttl, data))
+
+    def add_additional(self, name, record_type, ttl, data, query_class=1):
+        """
+        The method add record to additional section
+        :return: None
+        """
+        self.additional_records.append(
+            (name, record_type, query_class, ttl, data))
+
+    def get_packet(self, max_size=None):
+        """
+        The method return complete response. Response longer than max_size
+        is replaced by empty one with TC flag.
+        :param max_size: int
+        :return: bytes
+        """
+        packet = self._form_packet_(self.answers,
+                                    self.authoritative_nameservers,
+                                    self.additional_records, self.tc)
+        if max_size is not None and len(packet) > max_size:
+            packet = self._form_packet_([], [], [], 1)
+        return packet
+
+    def _form_packet_(self, answers, authority, additional, tc):
+        flags = (1 << 7) + (self.opcode << 3) + (self.aa << 2) + (tc << 1)\
+            + self.rd
+        flags_low = (self.ra << 7) + (self.rcode & 15)
+        additional_quantity = len(additional)
+        if self.edns_payload is not None:
+            additional_quantity += 1
+        packet = bytearray(HEADER.pack(
+            self.identifier & 0xffff, flags, flags_low, len(self.questions),
+            len(answers), len(authority), additional_quantity))
+        self.ttl_offsets = []
+        offsets = {}
+        for question in self.questions:
+            self._encode_name_(packet, question.query_name, offsets)
+            packet.extend(QUESTION_TAIL.pack(question.query_type,
+                                             question.query_class))
+        for record in answers + authority + additional:
+            self._encode_record_(packet, record, offsets)
+        if self.edns_payload is not None:
+            packet.extend(b'\x00' + RECORD_HEADER.pack(
+                QueryPacket.QU_OPT, max(self.edns_payload, CLASSIC_PAYLOAD),
+                (self.rcode >> 4) << 24, 0))
+        return bytes(packet)
+
+    def _encode_record_(self, packet, record, offsets):
+        name, record_type, query_class, ttl, data = record
+        self._encode_name_(packet, name, offsets)
+        header = len(packet)
+        self.ttl_offsets.append(header + 4)
+        packet.extend(RECORD_HEADER.pack(record_type, query_class, ttl, 0))
+        if record_type == QueryPacket.QU_A:
+            packet.extend(socket.inet_aton(data))
+        elif record_type == QueryPacket.QU_AAAA:
+            packet.extend(socket.inet_pton(socket.AF_INET6, data))
+        elif record_type in (QueryPacket.QU_NS, QueryPacket.QU_CNAME):
+            self._encode_name_(packet, data, offsets)
+        elif record_type == QueryPacket.QU_MX:
+            packet.extend(IDENTIFIER.pack(data[0]))
+            self._encode_name_(packet, data[1], offsets)
+        else:
+            packet.extend(data)
+        length = len(packet) - header - 10
+        packet[header+8:header+10] = IDENTIFIER.pack(length)
+
+    @staticmethod
+    def _encode_name_(packet, name, offsets):
+        labels = [label for label in name.rstrip('.').split('.') if label]
+        for i in range(len(labels)):
+            suffix = '.'.join(labels[i:]).lower()
+            if suffix in offsets:
+                packet.extend(IDENTIFIER.pack(0xc000 + offsets[suffix]))
+                return
+            if len(packet) < 0x4000:
+                offsets[suffix] = len(packet)
+            label = labels[i].encode('utf8')
+            packet.append(len(label))
+            packet.extend(label)
+        packet.append(0)
+
 
 class ReceivedPacket:
     """
@@ -233,76 +446,117 @@ class ReceivedPacket:
         """
         pass
 
-    def __init__(self, received: bytearray):
-        self.raw_packet = copy.deepcopy(received)
+    def __init__(self, received: bytes):
         if len(received) < 12:
             raise Exception('To small packet')
-        self.identifier = (received[0] << 8) + received[1]
-        self.qr = received[2] // 128  # 0 - запрос, 1 - ответ
+        self.raw_packet = bytes(received)
+        (self.identifier, flags, flags_low, self.query_quantity,
+         self.answer_quantity, self.authority_quantity,
+         self.additional_info_quantity) = HEADER.unpack_from(self.raw_packet)
+        self.qr = flags >> 7  # 0 - запрос, 1 - ответ
         if self.qr != 1:
             raise Exception('It is query packet')
-        self.opcode = (received[2] % 128) // 8
+        self.opcode = (flags >> 3) & 15
         # 0 - прямой, 1 - инверсный, 2 - запрос статуса сервера
-        self.aa = (received[2] % 8) // 4  # только для ответа
-        self.tc = (received[2] % 4) // 2  # только для ответа
-        self.rd = received[2] % 2  # требуется рекурсия 0/1
-        self.ra = received[3] // 128  # только для ответа
-        self.rcode = received[3] % 16  # только для ответа
+        self.aa = (flags >> 2) & 1  # только для ответа
+        self.tc = (flags >> 1) & 1  # только для ответа
+        self.rd = flags & 1  # требуется рекурсия 0/1
+        self.ra = flags_low >> 7  # только для ответа
+        self.rcode = flags_low & 15  # только для ответа
         if self.rcode == 3:
             raise self.NotFoundException
-        self.query_quantity = (received[4] << 8) + received[5]
-        self.answer_quantity = (received[6] << 8) + received[7]
-        self.authority_quantity = (received[8] << 8) + received[9]
-        self.additional_info_quantity = (received[10] << 8) + received[11]
         self.answers = []
         self.queries = []
         self.authoritative_nameservers = []
+        self.additional_records = []
+        self._names_ = {}
         self._parse_answers_()
-        pass
+        self.edns_payload = None
+        self.edns_version = None
+        self.dnssec_ok = 0
+        for record in self.additional_records:
+            if record.record_type == QueryPacket.QU_OPT:
+                self.edns_payload = record.query_class
+                self.rcode += (record.ttl >> 24) << 4
+                self.edns_version = (record.ttl >> 16) & 255
+                self.dnssec_ok = (record.ttl >> 15) & 1
 
     def _parse_answers_(self):
+        view = memoryview(self.raw_packet)
         pointer = 12
         for i in range(self.query_quantity):
-            query, length = Query.query_from_bytes(self.raw_packet[pointer:])
-            pointer += length
+            query, pointer = Query.query_from_bytes(view, pointer)
             self.queries.append(query)
-        for i in range(self.answer_quantity + self.authority_quantity):
-            rr_start_pointer = pointer
-            name, real_length = self.get_string(self.raw_packet, pointer)
-            pointer += real_length
-            record, record_length = ResourceRecord.resource_record_from_bytes(
-                rr_start_pointer, name, self.raw_packet[pointer:], self)
-            if i < self.answer_quantity:
-                self.answers.append(record)
-            else:
-                self.authoritative_nameservers.append(record)
-            pointer += record_length
-
-    def get_string(self, data: bytearray, position):
-        """
-        The method find string by pointer in DNS-type strings
-        :param data: bytearray
-        :param position: int
-        :return: str
+        sections = [(self.answer_quantity, self.answers),
+                    (self.authority_quantity, self.authoritative_nameservers),
+                    (self.additional_info_quantity, self.additional_records)]
+        for quantity, section in sections:
+            for i in range(quantity):
+                rr_start_pointer = pointer
+                name, real_length = self.get_string(pointer)
+                pointer += real_length
+                record, pointer = ResourceRecord.resource_record_from_bytes(
+                    rr_start_pointer, sys.intern(name), view, pointer, self)
+                section.append(record)
+
+    def get_string(self, position):
+        """
+        The method find string by pointer in DNS-type strings.
+        Every decoded suffix is remembered by its offset, so names sharing
+        a suffix are decoded once per packet.
+        :param position: int - offset of name in raw_packet
+        :return: str, length of name in place
         """
+        names = self._names_
+        if position in names:
+            return names[position]
+        data = self.raw_packet
+        segment = []  # offsets and labels of name read in place
+        segments = []
         pointer = position
-        string = ''
-        real_length = 0
-        while data[pointer] != 0:
-            if (data[pointer] >> 6) == 3:
-                real_length = pointer - position + 2
-                string += self.get_string(self.raw_packet,
-                                          ((data[pointer] - 192) << 8)
-                                          + data[pointer+1])[0]
+        wire_length = 0
+        while True:
+            if pointer in names:
+                tail = names[pointer][0]
+                # remembered suffix counts too: every its label takes
+                # one byte more than its text with dot
+                if tail:
+                    wire_length += len(tail) + 1
+                    if wire_length > MAX_NAME_LENGTH:
+                        raise Exception('Too long name')
+                segments.append((segment, pointer + names[pointer][1]))
+                break
+            length = data[pointer]
+            if length == 0:
+                tail = ''
+                segment.append((pointer, None))
+                segments.append((segment, pointer + 1))
                 break
-            for i in range(data[pointer]):
-                string += chr(data[pointer+i+1])
-            string += '.'
-            pointer += data[pointer] + 1
-            real_length += 1
-        if string[-1:] == '.':
-            string = string[:-1]
-        return string, real_length
+            if length >= 192:
+                target = ((length - 192) << 8) + data[pointer+1]
+                if target >= pointer:
+                    raise Exception('Bad compression pointer in name')
+                segment.append((pointer, None))
+                segments.append((segment, pointer + 2))
+                segment = []
+                pointer = target
+                continue
+            if length > 63:
+                raise Exception('Unknown label type in name')
+            wire_length += length + 1
+            if wire_length > MAX_NAME_LENGTH:
+                raise Exception('Too long name')
+            label = data[pointer+1:pointer+1+length].decode('latin-1')
+            segment.append((pointer, label))
+            pointer += length + 1
+        # suffixes are built from the end and stored for every offset
+        string = tail
+        for segment, end in reversed(segments):
+            for offset, label in reversed(segment):
+                if label is not None:
+                    string = label + '.' + string if string else label
+                names[offset] = (string, end - offset)
+        return names[position]
 
     def get_answers(self):
         """
@@ -0,0 +1,185 @@
+"""
+The module refreshes popular cache entries in background before they
+expire, so lookups of hot names are answered from cache all the time.
+Entry is refreshed when it was used at least min_hits times and less than
+fraction of its TTL is left. Prefetcher refreshes entries of Resolver on
+threads, AsyncPrefetcher refreshes entries of AsyncResolver in tasks.
+"""
+__author__ = 'Skipper'
+DEFAULT_PREFETCH_WORKERS = 2
+DEFAULT_MIN_HITS = 3
+DEFAULT_FRACTION = 0.1
+DEFAULT_MAX_PENDING = 64
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """
+    The class runs refreshes of cache entries on workers threads.
+    Every refresh is done by new resolver made by resolver.spawn,
+    so it does not share sockets with lookups of caller.
+    """
+
+    def __init__(self, workers=DEFAULT_PREFETCH_WORKERS,
+                 min_hits=DEFAULT_MIN_HITS, fraction=DEFAULT_FRACTION,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.workers = workers
+        self.min_hits = min_hits
+        self.fraction = fraction
+        self.max_pending = max_pending
+        self.executor = None
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.scheduled = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def is_due(self, entry, now):
+        """
+        The method checks that entry is hot and is going to expire
+        :param entry: CacheEntry
+        :param now: float - time of cache clock
+        :return: bool
+        """
+        return not entry.negative and entry.ttl is not None\
+            and entry.hits >= self.min_hits\
+            and entry.expires - now <= entry.ttl * self.fraction
+
+    def schedule(self, resolver, name, query_type):
+        """
+        The method starts refresh of entry unless it is refreshed already
+        :param resolver: Resolver
+        :param name: str
+        :param query_type: int
+        :return: bool - True if refresh is started
+        """
+        key = resolver.cache.make_key(name, query_type)
+        with self.lock:
+            if not self._admit_(key):
+                return False
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='prefetch')
+        self.executor.submit(self._refresh_, resolver.spawn(), name,
+                             query_type, key)
+        return True
+
+    def _admit_(self, key):
+        # caller holds lock
+        if key in self.pending or self.workers <= 0:
+            return False
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return False
+        self.pending.add(key)
+        self.scheduled += 1
+        return True
+
+    def _refresh_(self, resolver, name, query_type, key):
+        try:
+            with resolver:
+                result = resolver.lookup(name, query_type)
+            failed = result in (resolver.NO_RESPONSE, resolver.NAME_NOT_FOUND)
+        except Exception:
+            failed = True
+        self._finish_(key, failed)
+
+    def _finish_(self, key, failed):
+        with self.lock:
+            self.pending.discard(key)
+            if failed:
+                self.failed += 1
+            else:
+                self.refreshed += 1
+
+    def close(self):
+        """
+        The method waits for started refreshes and stops workers,
+        new ones are started by the next schedule
+        :return: None
+        """
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def get_stats(self):
+        """
+        The method returns counters of prefetcher
+        :return: dict
+        """
+        with self.lock:
+            return {'scheduled': self.scheduled, 'refreshed': self.refreshed,
+                    'failed': self.failed, 'dropped': self.dropped,
+                    'pending': len(self.pending)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncPrefetcher(Prefetcher):
+    """
+    The class refreshes cache entries of AsyncResolver in tasks of its
+    event loop, at most workers refreshes run at once. Refresh is lookup
+    of the same resolver, so it shares its endpoint and limits.
+    """
+
+    def __init__(self, workers=DEFAULT_PREFETCH_WORKERS,
+                 min_hits=DEFAULT_MIN_HITS, fraction=DEFAULT_FRACTION,
+                 max_pending=DEFAULT_MAX_PENDING):
+        super().__init__(workers, min_hits, fraction, max_pending)
+        self.tasks = set()
+        self._slots_ = None
+
+    def schedule(self, resolver, name, query_type):
+        """
+        The method starts refresh of entry unless it is refreshed already,
+        it is called from event loop of resolver
+        :param resolver: AsyncResolver
+        :param name: str
+        :param query_type: int
+        :return: bool - True if refresh is started
+        """
+        key = resolver.cache.make_key(name, query_type)
+        with self.lock:
+            if not self._admit_(key):
+                return False
+        if self._slots_ is None:
+            self._slots_ = asyncio.Semaphore(self.workers)
+        task = asyncio.ensure_future(self._refresh_(resolver, name,
+                                                    query_type, key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def _refresh_(self, resolver, name, query_type, key):
+        async with self._slots_:
+            try:
+                result = await resolver.lookup(name, query_type)
+                failed = result in (resolver.NO_RESPONSE,
+                                    resolver.NAME_NOT_FOUND)
+            except Exception:
+                failed = True
+        self._finish_(key, failed)
+
+    async def close(self):
+        """
+        The method waits for started refreshes
+        :return: None
+        """
+        while self.tasks:
+            await asyncio.wait(set(self.tasks))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,225 @@
+"""
+The module limits queries to every upstream server: token bucket keeps
+rate of queries under qps with bursts up to burst queries and window
+keeps at most max_in_flight queries waiting for replies. Queries over
+limits wait in queue, time spent there is counted in stats.
+RateLimiter is for threads, AsyncRateLimiter is for asyncio.
+"""
+__author__ = 'Skipper'
+
+import asyncio
+import contextlib
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket which lends tokens in advance: reserve takes a token
+    and returns how long to wait until it is really available
+    """
+
+    def __init__(self, qps, burst=None, clock=time.monotonic):
+        self.qps = qps
+        self.burst = max(1, qps if burst is None else burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def reserve(self):
+        """
+        The method takes one token
+        :return: float - seconds to wait before query may be sent
+        """
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.qps)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.qps
+
+
+class ThrottleState:
+    """
+    Limits and counters of one server
+    """
+
+    def __init__(self, qps, burst, max_in_flight, clock):
+        self.bucket = None if qps is None else TokenBucket(qps, burst, clock)
+        self.max_in_flight = max_in_flight
+        self.window = None
+        self.queries = 0
+        self.throttled = 0
+        self.throttle_time = 0.0
+        self.queued = 0
+        self.max_queued = 0
+
+    def get_stats(self):
+        """
+        The method returns counters of server
+        :return: dict
+        """
+        return {'queries': self.queries, 'throttled': self.throttled,
+                'throttle_time': self.throttle_time, 'queued': self.queued,
+                'max_queued': self.max_queued}
+
+
+class RateLimiter:
+    """
+    Limits of servers for threads. qps or max_in_flight None means
+    no limit, limits of particular servers are changed by set_limit.
+    """
+
+    def __init__(self, qps=None, burst=None, max_in_flight=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.qps = qps
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.clock = clock
+        self.sleep = sleep
+        self.limits = {}
+        self.servers = {}
+        self.lock = threading.Lock()
+
+    def set_limit(self, server, qps=None, burst=None, max_in_flight=None):
+        """
+        The method sets limits of server
+        :param server: str
+        :param qps: float
+        :param burst: int
+        :param max_in_flight: int
+        :return: None
+        """
+        with self.lock:
+            self.limits[server] = (qps, burst, max_in_flight)
+            self.servers.pop(server, None)
+
+    def _state_(self, server):
+        state = self.servers.get(server)
+        if state is None:
+            qps, burst, max_in_flight = self.limits.get(
+                server, (self.qps, self.burst, self.max_in_flight))
+            state = self.servers[server] = ThrottleState(
+                qps, burst, max_in_flight, self.clock)
+            if max_in_flight is not None:
+                state.window = self._make_window_(max_in_flight)
+        return state
+
+    @staticmethod
+    def _make_window_(max_in_flight):
+        return threading.Semaphore(max_in_flight)
+
+    def _enter_queue_(self, state):
+        state.queued += 1
+        state.max_queued = max(state.max_queued, state.queued)
+        return self.clock()
+
+    def _leave_queue_(self, state, queued_at, waited):
+        state.queued -= 1
+        state.queries += 1
+        if waited:
+            state.throttled += 1
+            state.throttle_time += self.clock() - queued_at
+
+    def _reserve_(self, state):
+        return 0 if state.bucket is None else state.bucket.reserve()
+
+    @contextlib.contextmanager
+    def slot(self, server, blocking=True):
+        """
+        The method waits for place in window and for token of server,
+        place is freed when block is left. Without blocking full window
+        is not waited for: block gets False and query must not be sent,
+        so thread holding places of its queries does not wait for more.
+        :param server: str
+        :param blocking: bool
+        :return: context manager giving bool - place is taken
+        """
+        with self.lock:
+            state = self._state_(server)
+        acquired = False
+        if not blocking and state.window is not None:
+            if not state.window.acquire(False):
+                yield False
+                return
+            acquired = True
+        with self.lock:
+            queued_at = self._enter_queue_(state)
+        waited = False
+        delay = 0
+        try:
+            if state.window is not None and not acquired:
+                waited = not state.window.acquire(False)
+                if waited:
+                    state.window.acquire()
+                acquired = True
+            with self.lock:
+                delay = self._reserve_(state)
+            if delay > 0:
+                self.sleep(delay)
+        except BaseException:
+            if acquired:
+                state.window.release()
+            raise
+        finally:
+            with self.lock:
+                self._leave_queue_(state, queued_at, waited or delay > 0)
+        try:
+            yield True
+        finally:
+            if acquired:
+                state.window.release()
+
+    def get_stats(self):
+        """
+        The method returns counters of every server
+        :return: dict server -> dict
+        """
+        with self.lock:
+            return {server: state.get_stats()
+                    for server, state in self.servers.items()}
+
+
+class AsyncRateLimiter(RateLimiter):
+    """
+    Limits of servers for coroutines of one event loop
+    """
+
+    def __init__(self, qps=None, burst=None, max_in_flight=None,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        super().__init__(qps, burst, max_in_flight, clock, sleep)
+
+    @staticmethod
+    def _make_window_(max_in_flight):
+        return asyncio.Semaphore(max_in_flight)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, server):
+        """
+        The method waits for place in window and for token of server
+        :param server: str
+        :return: async context manager
+        """
+        state = self._state_(server)
+        queued_at = self._enter_queue_(state)
+        waited = acquired = False
+        delay = 0
+        try:
+            if state.window is not None:
+                waited = state.window.locked()
+                await state.window.acquire()
+                acquired = True
+            delay = self._reserve_(state)
+            if delay > 0:
+                await self.sleep(delay)
+        except BaseException:
+            if acquired:
+                state.window.release()
+            raise
+        finally:
+            self._leave_queue_(state, queued_at, waited or delay > 0)
+        try:
+            yield
+        finally:
+            if acquired:
+                state.window.release()
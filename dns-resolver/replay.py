@@ -0,0 +1,269 @@
+"""
+The module records traffic of Resolver to upstream servers and replays it.
+File is a sequence of records: header (length of server, kind,
+length of query, length of reply, latency) followed by server, query
+and reply bytes. Replayed servers answer from file with recorded
+latency or without delay, so lookups can be profiled without network.
+"""
+__author__ = 'Skipper'
+KIND_UDP = 0
+KIND_TCP = 1
+
+import socket
+import struct
+import threading
+import time
+from transport import SocketPool, TcpConnectionPool
+
+RECORD = struct.Struct('!BBHHf')
+
+
+class TrafficRecorder:
+    """
+    The class appends exchanges with servers to file.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        self.records = 0
+
+    def record(self, server, kind, query, reply, latency):
+        """
+        The method writes one exchange
+        :param server: str
+        :param kind: int
+        :param query: bytes
+        :param reply: bytes
+        :param latency: float - seconds
+        :return: None
+        """
+        server = server.encode()
+        with self.lock:
+            self.file.write(RECORD.pack(len(server), kind, len(query),
+                                        len(reply), latency))
+            self.file.write(server + query + reply)
+            self.records += 1
+
+    def close(self):
+        """
+        The method flushes and closes file
+        :return: None
+        """
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_records(path):
+    """
+    The function yields recorded exchanges
+    :param path: str
+    :return: generator of (server, kind, query, reply, latency)
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    view = memoryview(data)
+    pointer = 0
+    while pointer < len(data):
+        if pointer + RECORD.size > len(data):
+            raise Exception('Truncated record at {}'.format(pointer))
+        server_length, kind, query_length, reply_length, latency = \
+            RECORD.unpack_from(data, pointer)
+        pointer += RECORD.size
+        end = pointer + server_length + query_length + reply_length
+        if end > len(data):
+            raise Exception('Truncated record at {}'.format(pointer))
+        server = bytes(view[pointer:pointer+server_length]).decode()
+        pointer += server_length
+        query = bytes(view[pointer:pointer+query_length])
+        pointer += query_length
+        yield server, kind, query, bytes(view[pointer:end]), latency
+        pointer = end
+
+
+class TrafficReplay:
+    """
+    The class answers queries from recorded file.
+    Queries are matched by server, kind and everything except identifier,
+    identifier of reply is replaced by identifier of query.
+    Replies to repeated query are given in recorded order, the last one
+    is repeated. With timings=False replies come without delay.
+    """
+
+    def __init__(self, path, timings=True):
+        self.timings = timings
+        self.exchanges = {}
+        self.hits = 0
+        self.misses = 0
+        for server, kind, query, reply, latency in read_records(path):
+            self.exchanges.setdefault(self.make_key(server, kind, query),
+                                      []).append((reply, latency))
+
+    @staticmethod
+    def make_key(server, kind, query):
+        """
+        The method makes key of query
+        :param server: str
+        :param kind: int
+        :param query: bytes
+        :return: tuple
+        """
+        return server, kind, query[2:].lower()
+
+    def find(self, server, kind, query):
+        """
+        The method finds reply to query
+        :param server: str
+        :param kind: int
+        :param query: bytes
+        :return: (reply, delay) or None if query was not recorded
+        """
+        replies = self.exchanges.get(self.make_key(server, kind, query))
+        if not replies:
+            self.misses += 1
+            return None
+        self.hits += 1
+        reply, latency = replies.pop(0) if len(replies) > 1 else replies[0]
+        reply = query[0:2] + reply[2:]
+        return reply, latency if self.timings else 0
+
+    def get_stats(self):
+        """
+        The method returns counters of replay
+        :return: dict
+        """
+        return {'exchanges': sum(len(replies) for replies
+                                 in self.exchanges.values()),
+                'hits': self.hits, 'misses': self.misses}
+
+
+class ReplaySocket:
+    """
+    Replacement of connected UDP socket. Reply is written to one end
+    of socket pair after recorded latency, so select and timeouts work
+    as with network. Query which was not recorded is refused.
+    """
+
+    def __init__(self, replay, server):
+        self.replay = replay
+        self.server = server
+        self.sock, self.peer = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_DGRAM)
+
+    def send(self, packet):
+        """
+        The method "sends" packet and schedules reply
+        :param packet: bytes
+        :return: int
+        """
+        found = self.replay.find(self.server, KIND_UDP, packet)
+        if found is None:
+            self._deliver_(b'')
+        elif found[1] > 0:
+            threading.Timer(found[1], self._deliver_, (found[0],)).start()
+        else:
+            self._deliver_(found[0])
+        return len(packet)
+
+    def _deliver_(self, reply):
+        try:
+            self.peer.send(reply)
+        except OSError:
+            pass
+
+    def recv(self, size):
+        """
+        The method receives reply
+        :param size: int
+        :return: bytes
+        """
+        reply = self.sock.recv(size)
+        if not reply:
+            raise ConnectionRefusedError('Query was not recorded')
+        return reply
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+        self.peer.close()
+
+
+class ReplaySocketPool(SocketPool):
+    """
+    SocketPool of ReplaySockets
+    """
+
+    def __init__(self, replay):
+        super().__init__()
+        self.replay = replay
+
+    def _open_socket_(self, server, port):
+        return ReplaySocket(self.replay, server)
+
+
+class ReplayTcpConnection:
+    """
+    Replacement of TcpConnection answering from recorded file
+    """
+
+    def __init__(self, replay, server):
+        self.replay = replay
+        self.server = server
+        self.in_flight = 0
+
+    def send(self, packet):
+        """
+        The method "sends" query
+        :param packet: bytes
+        :return: None
+        """
+        self.in_flight += 1
+
+    def receive(self, packet, timeout):
+        """
+        The method returns recorded reply to packet
+        :param packet: bytes
+        :param timeout: float
+        :return: bytes
+        """
+        self.in_flight -= 1
+        found = self.replay.find(self.server, KIND_TCP, packet)
+        if found is None:
+            raise ConnectionResetError('Query was not recorded')
+        reply, delay = found
+        if delay > timeout:
+            time.sleep(timeout)
+            raise socket.timeout
+        time.sleep(delay)
+        return reply
+
+    def exchange(self, packets, timeout):
+        for packet in packets:
+            self.send(packet)
+        return [self.receive(packet, timeout) for packet in packets]
+
+    def close(self):
+        pass
+
+
+class ReplayTcpConnectionPool(TcpConnectionPool):
+    """
+    TcpConnectionPool of ReplayTcpConnections
+    """
+
+    def __init__(self, replay):
+        super().__init__()
+        self.replay = replay
+
+    def _connect_(self, server, port, timeout):
+        return ReplayTcpConnection(self.replay, server)
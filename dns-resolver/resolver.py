@@ -6,10 +6,32 @@ DEFAULT_PORT = 53
 DEFAULT_SERVER = '8.8.8.8'
 DEFAULT_TIMEOUT = 5
 DEFAULT_NUM_OF_RETRIES = 4
+DEFAULT_RACE_WIDTH = 1
+DEFAULT_RACE_STAGGER = 0.05
+DEFAULT_THREADS = 16
+MAX_DEPTH = 4
+RCODE_FORMAT_ERROR = 1
+RCODE_SERVER_FAILURE = 2
+RCODE_NOT_IMPLEMENTED = 4
+RCODE_REFUSED = 5
 
+import contextlib
+import select
 import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import ResolverCache
 from debugmode import Debugger
-from packet import QueryPacket, ReceivedPacket
+from instrument import Instrumentation
+from packet import CLASSIC_PAYLOAD, IDENTIFIER, TTL, QueryPacket,\
+    ReceivedPacket
+from ratelimit import RateLimiter
+from replay import KIND_TCP, KIND_UDP, ReplaySocketPool,\
+    ReplayTcpConnectionPool
+from serverstats import ServerStats
+from singleflight import SingleFlight
+from transport import IdentifierPool, SocketPool, TcpConnectionPool,\
+    matches_query
 
 
 class NoResponseException(Exception):
@@ -19,9 +41,113 @@ class NoResponseException(Exception):
     pass
 
 
+def parse_referral(address, packet):
+    """
+    The function takes delegated zone, names of its nameservers and their
+    glue addresses from referral. Referral to zone which is not
+    an ancestor of address is ignored.
+    :param address: str
+    :param packet: ReceivedPacket
+    :return: zone, list of names, dict name -> addresses, ttl or None
+    """
+    ns_records = [record for record in packet.authoritative_nameservers
+                  if record.record_type == QueryPacket.QU_NS]
+    if not ns_records:
+        return None
+    zone = ns_records[0].name.lower().rstrip('.')
+    if zone not in Resolver._zones_(address):
+        return None
+    names = []
+    for record in ns_records:
+        if record.name.lower().rstrip('.') == zone:
+            names.append(record.get_data().lower())
+    glue = {}
+    for record in packet.additional_records:
+        name = record.name.lower()
+        if record.record_type == QueryPacket.QU_A and name in names:
+            glue.setdefault(name, []).append(record.get_data())
+    return zone, names, glue, min(record.ttl for record in ns_records)
+
+
+def is_referral(packet):
+    """
+    The function checks that packet refers to nameservers of other zone
+    instead of answering
+    :param packet: ReceivedPacket
+    :return: bool
+    """
+    return not packet.answers and not packet.aa and any(
+        record.record_type == QueryPacket.QU_NS
+        for record in packet.authoritative_nameservers)
+
+
+def closest_servers(delegations, address, default):
+    """
+    The function finds servers of the deepest cached zone cut of address
+    :param delegations: ResolverCache - zone -> addresses of nameservers
+    :param address: str
+    :param default: str - server to begin with if no zone is cached
+    :return: list
+    """
+    for zone in Resolver._zones_(address):
+        entry = delegations.get(zone, QueryPacket.QU_NS)
+        if entry is not None:
+            return list(entry.records)
+    return [default]
+
+
+def address_records(records):
+    """
+    The function takes addresses from result of lookup
+    :param records: list - formatted records, NAME_NOT_FOUND or NO_RESPONSE
+    :return: list of str
+    """
+    return [record[1] for record in records
+            if record[0] == QueryPacket.QU_A]
+
+
+def nodata_ttl(packet, default):
+    """
+    The function finds how long empty answer may be cached: TTL of SOA
+    record of authority section limited by its minimum field (RFC 2308)
+    :param packet: ReceivedPacket
+    :param default: int - TTL when there is no SOA record
+    :return: int
+    """
+    for record in packet.authoritative_nameservers:
+        if record.record_type == QueryPacket.QU_SOA and record.length >= 22:
+            return min(record.ttl, TTL.unpack_from(record.raw_data,
+                                                   record.length - 4)[0])
+    return default
+
+
+def store_answers(cache, address, query_type, packet):
+    """
+    The function formats answers of packet and caches them for the minimal
+    TTL of records. Empty answer of authoritative server (NODATA) is
+    cached for its type too.
+    :param cache: ResolverCache
+    :param address: str
+    :param query_type: int
+    :param packet: ReceivedPacket
+    :return: list
+    """
+    answers = packet.get_answers()
+    result = Resolver._format_result_(answers)
+    if answers:
+        cache.put(address, query_type, result,
+                  min(record.ttl for record in answers))
+    elif packet.aa and not packet.rcode:
+        cache.put(address, query_type, result,
+                  nodata_ttl(packet, cache.negative_ttl))
+    return result
+
+
 class Resolver:
     """
-    The class works with network and parse data from packets
+    The class works with network and parse data from packets.
+    State of lookup is kept in its calls, so one resolver may be used
+    by several threads: every thread gets own UDP sockets.
     """
 
     NAME_NOT_FOUND = [(-1,)]
@@ -30,55 +156,349 @@ class Resolver:
 
     def __init__(self, server=DEFAULT_SERVER, debug_mode=False,
                  port=DEFAULT_PORT, num_of_retries=DEFAULT_NUM_OF_RETRIES,
-                 waiting=DEFAULT_TIMEOUT):
-        self.address = ''
-        self.identifier = 0
-        self.servers = [server]
+                 waiting=DEFAULT_TIMEOUT, cache=None,
+                 race_width=DEFAULT_RACE_WIDTH,
+                 race_stagger=DEFAULT_RACE_STAGGER, delegations=None,
+                 server_stats=None, edns_payload=None, recorder=None,
+                 replay=None, instrument=None, limiter=None,
+                 prefetcher=None, flights=None):
+        self.server = server
         self.port = port
         self.num_of_retries = num_of_retries
         self.timeout = waiting
-        self.visited_servers = []
-        self.debugger = Debugger(debug_mode)
+        # identifiers of queries in flight are unique and random
+        self.identifiers = IdentifierPool()
+        # events go to sinks of instrument, debug mode adds text sink
+        self.instrument = Instrumentation() if instrument is None\
+            else instrument
+        if debug_mode and not any(isinstance(sink, Debugger)
+                                  for sink in self.instrument.sinks):
+            self.instrument.add_sink(Debugger(True))
+        self.cache = ResolverCache() if cache is None else cache
+        # zone -> addresses of its nameservers, lives for TTL of NS records
+        self.delegations = ResolverCache() if delegations is None\
+            else delegations
+        # exchanges with servers are written to recorder (TrafficRecorder),
+        # with replay (TrafficReplay) servers are answered from file
+        self.recorder = recorder
+        self.replay = replay
+        if replay is None:
+            self.sockets = SocketPool()
+            self.tcp_connections = TcpConnectionPool()
+        else:
+            self.sockets = ReplaySocketPool(replay)
+            self.tcp_connections = ReplayTcpConnectionPool(replay)
+        # timeouts adapt to latency of servers, waiting is the upper bound
+        self.server_stats = ServerStats() if server_stats is None\
+            else server_stats
+        # delegated servers are asked race_width at a time,
+        # next one is started after race_stagger seconds of silence
+        # EDNS0 lets servers send up to edns_payload bytes over UDP
+        self.edns_payload = edns_payload
+        # rate and in-flight limits of servers, no limits by default
+        self.limiter = RateLimiter() if limiter is None else limiter
+        # hot answers are refreshed by prefetcher before they expire
+        self.prefetcher = prefetcher
+        # concurrent lookups of one name by resolvers sharing flights
+        # are done once
+        self.flights = SingleFlight() if flights is None else flights
+        self.race_width = max(1, race_width)
+        self.race_stagger = race_stagger
+        # threads of resolve_many live as long as resolver, so their
+        # sockets are reused by the next call
+        self.executor = None
+        self.executor_threads = 0
+
+    def close(self):
+        """
+        The method stops threads and closes sockets of resolver
+        :return: None
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.sockets.close()
+        self.tcp_connections.close()
+
+    def __enter__(self):
+        return self
 
-    def resolve(self, address):
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def resolve(self, address, query_type=QueryPacket.QU_A):
         """
         This shit resolve everything from address.
+        Answers and NXDOMAIN are taken from cache while they are alive.
+        If resolver spawned from the same one resolves address in other
+        thread, its result is waited for.
+        :param address: str
+        :param query_type: int
+        :return: tuple
+        """
+        self.instrument.lookup_started(address)
+        result = self._resolve_(address, query_type)
+        self.instrument.lookup_finished(address, result)
+        return result
+
+    def resolve_types(self, address, query_types):
+        """
+        The method resolves records of several types of address at once.
+        Delegations are followed only once with query of the first type,
+        queries of other types are sent together to server of the zone.
+        :param address: str
+        :param query_types: iterable of int, e.g. (QU_A, QU_AAAA, QU_MX)
+        :return: dict type -> list in the same format as resolve returns
+        """
+        query_types = list(dict.fromkeys(query_types))
+        self.instrument.lookup_started(address)
+        results = self._resolve_types_(address, query_types)
+        self.instrument.lookup_finished(address, next(
+            (result for result in results.values()
+             if result not in (self.NAME_NOT_FOUND, self.NO_RESPONSE)),
+            results[query_types[0]] if query_types else []))
+        return results
+
+    def resolve_many(self, names, query_type=QueryPacket.QU_A,
+                     threads=DEFAULT_THREADS):
+        """
+        The method resolves names on pool of threads sharing this resolver
+        :param names: iterable
+        :param query_type: int
+        :param threads: int
+        :return: list of results in order of names
+        """
+        executor = self._get_executor_(max(1, threads))
+        return list(executor.map(lambda name: self.resolve(
+            name, query_type), names))
+
+    def _get_executor_(self, threads):
+        if self.executor is not None and self.executor_threads != threads:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.sockets.release_finished()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                threads, thread_name_prefix='resolver')
+            self.executor_threads = threads
+        return self.executor
+
+    def lookup(self, address, query_type=QueryPacket.QU_A, depth=0):
+        """
+        The method resolves address without looking into cache,
+        answer is cached
         :param address: str
+        :param query_type: int
+        :param depth: int - number of lookups of nameservers this one
+        is nested in
         :return: tuple
         """
-        self.identifier += 1
-        packet = QueryPacket(self.identifier)
-        packet.add_question(address, QueryPacket.QU_A)
+        servers = closest_servers(self.delegations, address, self.server)
+        visited_servers = []
+        packet = QueryPacket(0)
+        packet.add_question(address, query_type)
+        packet.set_edns(self.edns_payload)
+        received_packet = None
+        failed = False
+        #  recursion, baby!
+        while servers:
+            servers = self.server_stats.order(servers)
+            candidates = servers[:self.race_width]
+            servers = servers[len(candidates):]
+            visited_servers.extend(candidates)
+            try:
+                received_packet = self._ask_(packet, candidates)
+            except ReceivedPacket.NotFoundException:
+                self.cache.put_negative(address, query_type)
+                return self.NAME_NOT_FOUND
+            except NoResponseException:
+                failed = True
+                if not servers and received_packet is None\
+                        and self.server not in visited_servers:
+                    # servers of cached zone cut are dead, begin from scratch
+                    servers = [self.server]
+                continue
+            failed = False
+            if len(received_packet.answers) > 0\
+                    or (received_packet.aa and not received_packet.rcode):
+                # empty answer of authoritative server is final too
+                break
+            referral = self._follow_referral_(address, received_packet,
+                                              visited_servers, depth)
+            if referral:
+                servers = referral
+            elif is_referral(received_packet):
+                # referral leads only to servers which did not answer
+                failed = True
+        if received_packet is None or failed:
+            return self.NO_RESPONSE
+        return store_answers(self.cache, address, query_type,
+                             received_packet)
+
+    def spawn(self):
+        """
+        The method makes resolver with the same settings which shares
+        caches, statistics and limits with this one
+        :return: Resolver
+        """
+        return Resolver(self.server, False, self.port, self.num_of_retries,
+                        self.timeout, self.cache, self.race_width,
+                        self.race_stagger, self.delegations,
+                        self.server_stats, self.edns_payload, self.recorder,
+                        self.replay, self.instrument, self.limiter,
+                        self.prefetcher, self.flights)
 
+    def _ask_(self, packet, servers):
+        """
+        The method races query to servers. Query with OPT record which
+        server rejects as malformed or unknown is repeated without it.
+        :param packet: QueryPacket
+        :param servers: list
+        :return: ReceivedPacket
+        """
+        packet.identifier = self.identifiers.allocate()
         try:
-            received_packet = self._send_packet_(packet.get_packet(),
-                                                 self.servers[0])
-        except ReceivedPacket.NotFoundException:
-            return self.NAME_NOT_FOUND
+            received_packet = self._race_packet_(packet.get_packet(),
+                                                 servers)
+            if not self._rejects_edns_(packet, received_packet):
+                return received_packet
+            self.identifiers.release(packet.identifier)
+            packet.identifier = self.identifiers.allocate()
+            packet.set_edns(None)
+            try:
+                return self._race_packet_(packet.get_packet(), servers)
+            finally:
+                packet.set_edns(self.edns_payload)
+        finally:
+            self.identifiers.release(packet.identifier)
+
+    @staticmethod
+    def _rejects_edns_(packet, reply):
+        # servers not knowing EDNS0 answer FORMERR or NOTIMP (RFC 6891)
+        return packet.edns_payload is not None\
+            and isinstance(reply, ReceivedPacket)\
+            and reply.rcode in (RCODE_FORMAT_ERROR, RCODE_NOT_IMPLEMENTED)
+
+    def _resolve_(self, address, query_type):
+        entry = self._cached_(address, query_type)
+        if entry is not None:
+            return self.NAME_NOT_FOUND if entry.negative else entry.records
+        return self.flights.do(self.cache.make_key(address, query_type),
+                               self.lookup, address, query_type)
+
+    def _cached_(self, address, query_type):
+        entry = self.cache.get(address, query_type)
+        if entry is None:
+            return None
+        self.instrument.cache_hit(address, entry.negative)
+        if self.prefetcher is not None\
+                and self.prefetcher.is_due(entry, self.cache.clock()):
+            self.prefetcher.schedule(self, address, query_type)
+        return entry
+
+    def _resolve_types_(self, address, query_types):
+        results = {}
+        packets = {}
+        for query_type in query_types:
+            entry = self._cached_(address, query_type)
+            if entry is not None:
+                results[query_type] = self.NAME_NOT_FOUND if entry.negative\
+                    else entry.records
+                continue
+            packet = QueryPacket(0)
+            packet.add_question(address, query_type)
+            packet.set_edns(self.edns_payload)
+            packets[query_type] = packet
+        received = {}
+        servers = closest_servers(self.delegations, address, self.server)\
+            if packets else []
+        visited_servers = []
+        failed = False
+        # referrals are followed with query of one type, queries of
+        # other types are sent when server of the zone is found
+        authoritative = False
+        while servers and packets:
+            servers = self.server_stats.order(servers)
+            server = servers.pop(0)
+            visited_servers.append(server)
+            asked = packets if authoritative\
+                else dict([next(iter(packets.items()))])
+            raw_packets = {}
+            for query_type, packet in asked.items():
+                packet.identifier = self.identifiers.allocate()
+                raw_packets[query_type] = packet.get_packet()
+            try:
+                replies = self._send_packets_(raw_packets, server)
+                replies.update(self._resend_plain_(asked, replies, server))
+            except NoResponseException:
+                failed = True
+                if not servers and not received\
+                        and self.server not in visited_servers:
+                    servers = [self.server]
+                continue
+            finally:
+                for packet in asked.values():
+                    self.identifiers.release(packet.identifier)
+            failed = False
+            referral_packet = None
+            for query_type, reply in replies.items():
+                if isinstance(reply, ReceivedPacket.NotFoundException):
+                    # name does not exist whatever type is asked
+                    for pending_type in packets:
+                        self.cache.put_negative(address, pending_type)
+                        results[pending_type] = self.NAME_NOT_FOUND
+                    packets.clear()
+                    break
+                elif reply.answers or (reply.aa and not reply.rcode):
+                    # empty answer of authoritative server is final too
+                    results[query_type] = store_answers(
+                        self.cache, address, query_type, reply)
+                    del packets[query_type]
+                    if not authoritative:
+                        authoritative = True
+                        servers.insert(0, server)
+                else:
+                    received[query_type] = reply
+                    referral_packet = reply
+            if referral_packet is not None and packets:
+                referral = self._follow_referral_(address, referral_packet,
+                                                  visited_servers)
+                if referral:
+                    servers = referral
+                elif is_referral(referral_packet):
+                    failed = True
+        for query_type in packets:
+            results[query_type] = self.NO_RESPONSE\
+                if failed or query_type not in received\
+                else store_answers(self.cache, address, query_type,
+                                   received[query_type])
+        return {query_type: results[query_type]
+                for query_type in query_types}
+
+    def _resend_plain_(self, packets, replies, server):
+        """
+        The method repeats queries rejected because of OPT record
+        without it
+        :param packets: dict type -> QueryPacket
+        :param replies: dict type -> ReceivedPacket or NotFoundException
+        :param server: str
+        :return: dict of new replies, empty if server does not answer
+        """
+        plain = {query_type: packet for query_type, packet in packets.items()
+                 if self._rejects_edns_(packet, replies.get(query_type))}
+        if not plain:
+            return {}
+        raw_packets = {}
+        for query_type, packet in plain.items():
+            self.identifiers.release(packet.identifier)
+            packet.identifier = self.identifiers.allocate()
+            packet.set_edns(None)
+            raw_packets[query_type] = packet.get_packet()
+            packet.set_edns(self.edns_payload)
+        try:
+            return self._send_packets_(raw_packets, server)
         except NoResponseException:
-            return self.NO_RESPONSE
-        #  recursion, baby!
-        if len(received_packet.answers) == 0:
-            self.servers = []
-            self._add_servers_(received_packet)
-            while (self.servers != []) and (len(received_packet.answers) == 0):
-                try:
-                    self.identifier += 1
-                    packet.increment_id()
-                    received_packet = self._send_packet_(packet.get_packet(),
-                                                         self.servers[0])
-                    self._add_servers_(received_packet)
-                except ReceivedPacket.NotFoundException:
-                    return self.NAME_NOT_FOUND
-                except NoResponseException:
-                    if len(self.servers) == 1:
-                        return self.NO_RESPONSE
-                finally:
-                    if len(self.servers) > 1:
-                        self.servers = self.servers[1:]
-                    else:
-                        self.servers = self.NAME_NOT_FOUND
-        return self._format_result_(received_packet.get_answers())
+            return {}
 
     @staticmethod
     def _format_result_(answers):
@@ -87,31 +507,400 @@ class Resolver:
             result.append((record.record_type, record.get_data()))
         return result
 
-    def _add_servers_(self, packet):
-        for record in packet.authoritative_nameservers:
-            if (record.record_type == QueryPacket.QU_A)\
-                    or (record.record_type == QueryPacket.QU_NS):
-                if record.get_data() not in self.visited_servers:
-                    self.servers.append(record.get_data())
+    @staticmethod
+    def _zones_(address):
+        labels = address.lower().rstrip('.').split('.')
+        for i in range(len(labels)):
+            yield '.'.join(labels[i:])
+
+    def _follow_referral_(self, address, packet, visited_servers, depth=0):
+        """
+        The method takes servers of delegated zone from referral
+        and caches them with the TTL of NS records
+        :param address: str
+        :param packet: ReceivedPacket
+        :param visited_servers: list - servers asked during lookup
+        :param depth: int - depth of lookup
+        :return: list of servers not visited yet
+        """
+        if not any(record.record_type == QueryPacket.QU_NS
+                   for record in packet.authoritative_nameservers):
+            return [record.get_data() for record
+                    in packet.authoritative_nameservers
+                    if record.record_type == QueryPacket.QU_A
+                    and record.get_data() not in visited_servers]
+        referral = parse_referral(address, packet)
+        if referral is None:
+            return []
+        zone, names, glue, ttl = referral
+        if not glue:
+            glue = self._resolve_nameservers_(names, depth)
+        servers = [server for name in names for server in glue.get(name, [])]
+        if servers:
+            self.delegations.put(zone, QueryPacket.QU_NS, servers, ttl)
+        return [server for server in servers
+                if server not in visited_servers]
+
+    def _resolve_nameservers_(self, names, depth):
+        """
+        The method finds addresses of nameservers without glue by lookups
+        of this resolver, so they go through its cache, limits and
+        recorder. Names are resolved concurrently and the first one with
+        addresses is taken, so dead nameserver does not hold the lookup;
+        others go on in background and fill cache. Lookups of nameservers
+        are nested at most MAX_DEPTH times, so zones whose nameservers
+        are in each other can not loop.
+        :param names: list
+        :param depth: int - depth of lookup which follows referral
+        :return: dict name -> list of addresses
+        """
+        addresses = {}
+        for name in names:
+            entry = self.cache.get(name, QueryPacket.QU_A)
+            if entry is not None and not entry.negative:
+                addresses[name] = address_records(entry.records)
+        if any(addresses.values()) or depth >= MAX_DEPTH:
+            return addresses
+        missing = [name for name in names if name not in addresses]
+        executor = ThreadPoolExecutor(len(missing),
+                                      thread_name_prefix='nameserver')
+        futures = {executor.submit(self.lookup, name, QueryPacket.QU_A,
+                                   depth + 1): name for name in missing}
+        try:
+            for future in as_completed(futures):
+                found = address_records(future.result())
+                if found:
+                    addresses[futures[future]] = found
+                    break
+        finally:
+            executor.shutdown(wait=False)
+        return addresses
+
+    def _record_(self, server, kind, packet, raw_received, latency):
+        if self.recorder is not None:
+            self.recorder.record(server, kind, packet, raw_received, latency)
+
+    def _race_packet_(self, packet, servers):
+        """
+        The method sends packet to several servers, staggered by
+        race_stagger, and returns the first valid reply
+        :param packet: bytes
+        :param servers: list
+        :return: ReceivedPacket
+        """
+        if len(servers) == 1:
+            return self._send_packet_(packet, servers[0])
+        senders = []
+        for server in servers:
+            try:
+                senders.append((server,
+                                self.sockets.get_socket(server, self.port)))
+            except OSError:
+                self.instrument.no_response(server)
+        for attempt in range(self.num_of_retries):
+            if not senders:
+                break
+            received_packet = self._race_round_(packet, senders, attempt)
+            if received_packet is not None:
+                return received_packet
+        for server, _ in senders:
+            self.instrument.no_response(server)
+        raise NoResponseException
+
+    def _race_round_(self, packet, senders, attempt):
+        waiting = list(senders)
+        # sender -> server, time of sending, place in window of server
+        started = {}
+        deadline = next_start = time.monotonic()
+        try:
+            while waiting or started:
+                now = time.monotonic()
+                if waiting and now >= next_start:
+                    server, sender = waiting.pop(0)
+                    slot = contextlib.ExitStack()
+                    # only the first query of round waits for window,
+                    # servers with full windows are skipped by others
+                    if not slot.enter_context(self.limiter.slot(
+                            server, blocking=not started)):
+                        slot.close()
+                        continue
+                    self.instrument.send_packet(
+                        server, IDENTIFIER.unpack_from(packet)[0], attempt)
+                    try:
+                        sender.send(packet)
+                        started[sender] = server, time.monotonic(), slot
+                    except OSError:
+                        slot.close()
+                        self._timeout_(server)
+                    next_start = now + self.race_stagger
+                    deadline = max(deadline, now + self.server_stats.timeout(
+                        server, attempt, self.timeout))
+                    continue
+                wait = deadline - now
+                if waiting:
+                    wait = min(wait, next_start - now)
+                elif wait <= 0:
+                    break
+                readable = select.select(list(started), [], [],
+                                         max(wait, 0))[0]
+                for sender in readable:
+                    server, sent, slot = started[sender]
+                    try:
+                        raw_received = sender.recv(self._receive_size_())
+                    except ConnectionRefusedError:
+                        self._timeout_(server)
+                        slot.close()
+                        del started[sender]
+                        continue
+                    if not matches_query(packet, raw_received):
+                        continue
+                    rtt = time.monotonic() - sent
+                    slot.close()
+                    del started[sender]
+                    self._record_(server, KIND_UDP, packet, raw_received,
+                                  rtt)
+                    if attempt == 0:
+                        self.server_stats.add_rtt(server, rtt)
+                    received_packet = self._parse_reply_(raw_received,
+                                                         server, rtt)
+                    if received_packet.rcode in (RCODE_SERVER_FAILURE,
+                                                 RCODE_REFUSED)\
+                            and (waiting or started):
+                        continue
+                    return self._check_truncation_(packet, received_packet,
+                                                   server)
+            for server, _, _ in started.values():
+                self._timeout_(server)
+            return None
+        finally:
+            for _, _, slot in started.values():
+                slot.close()
+
+    def _receive_size_(self):
+        return max(self.edns_payload or 0, CLASSIC_PAYLOAD)
+
+    def _timeout_(self, server):
+        self.server_stats.add_timeout(server)
+        self.instrument.timeout(server)
+
+    def _parse_reply_(self, raw_received, server, rtt):
+        try:
+            received_packet = ReceivedPacket(raw_received)
+        except ReceivedPacket.NotFoundException:
+            self.instrument.name_error(
+                server, IDENTIFIER.unpack_from(raw_received)[0], rtt)
+            raise
+        self.instrument.receive_packet(received_packet, server,
+                                       received_packet.identifier, rtt)
+        return received_packet
 
     def _send_packet_(self, packet, server):
-        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # udp yoba
-        sender.settimeout(self.timeout)
-        sender.connect((server, self.port))
-        self.debugger.send_packet(server, self.identifier)
+        try:
+            sender = self.sockets.get_socket(server, self.port)
+        except OSError:
+            self.instrument.no_response(server)
+            raise NoResponseException
+        # server in penalty box gets only one probe
+        retries = 1 if self.server_stats.is_penalized(server)\
+            else self.num_of_retries
         raw_received = None
         number_of_tries = 0
-        while raw_received is None and number_of_tries < self.num_of_retries:
+        while raw_received is None and number_of_tries < retries:
+            timeout = self.server_stats.timeout(server, number_of_tries,
+                                                self.timeout)
+            self.instrument.send_packet(
+                server, IDENTIFIER.unpack_from(packet)[0], number_of_tries)
             try:
                 number_of_tries += 1
-                sender.send(packet)
-                raw_received = sender.recv(512)
-            except socket.timeout:
-                self.debugger.timeout(server)
-        sender.close()
+                with self.limiter.slot(server):
+                    sent = time.monotonic()
+                    sender.send(packet)
+                    raw_received = self._receive_reply_(sender, packet,
+                                                        timeout)
+                rtt = time.monotonic() - sent
+                self._record_(server, KIND_UDP, packet, raw_received, rtt)
+                # rtt of retransmitted query is ambiguous (Karn's rule)
+                if number_of_tries == 1:
+                    self.server_stats.add_rtt(server, rtt)
+            except (socket.timeout, ConnectionRefusedError):
+                self._timeout_(server)
         if raw_received is None:
-            self.debugger.no_response(server)
+            self.instrument.no_response(server)
             raise NoResponseException
-        received_packet = ReceivedPacket(raw_received)
-        self.debugger.receive_packet(received_packet, server, self.identifier)
-        return received_packet
+        received_packet = self._parse_reply_(raw_received, server, rtt)
+        return self._check_truncation_(packet, received_packet, server)
+
+    def _send_packets_(self, packets, server):
+        """
+        The method sends several packets to server at once and waits
+        for replies to all of them, unanswered ones are retransmitted.
+        Truncated replies are asked again together over one TCP connection
+        :param packets: dict key -> bytes
+        :param server: str
+        :return: dict key -> ReceivedPacket or NotFoundException
+        """
+        try:
+            sender = self.sockets.get_socket(server, self.port)
+        except OSError:
+            self.instrument.no_response(server)
+            raise NoResponseException
+        retries = 1 if self.server_stats.is_penalized(server)\
+            else self.num_of_retries
+        replies = {}
+        truncated = {}
+        for attempt in range(retries):
+            waiting = [(key, packet) for key, packet in packets.items()
+                       if key not in replies]
+            if not waiting:
+                break
+            timeout = self.server_stats.timeout(server, attempt, self.timeout)
+            # key -> packet, time of sending, place in window of server
+            in_flight = {}
+            deadline = time.monotonic()
+            try:
+                while waiting or in_flight:
+                    # only the first query waits for window, others are
+                    # sent when replies free places
+                    while waiting:
+                        slot = contextlib.ExitStack()
+                        if not slot.enter_context(self.limiter.slot(
+                                server, blocking=not in_flight)):
+                            slot.close()
+                            break
+                        key, packet = waiting.pop(0)
+                        in_flight[key] = packet, time.monotonic(), slot
+                        self.instrument.send_packet(
+                            server, IDENTIFIER.unpack_from(packet)[0],
+                            attempt)
+                        sender.send(packet)
+                        deadline = time.monotonic() + timeout
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    sender.settimeout(remaining)
+                    raw_received = sender.recv(self._receive_size_())
+                    key = next((key for key, (packet, _, _)
+                                in in_flight.items()
+                                if matches_query(packet, raw_received)), None)
+                    if key is None:
+                        continue
+                    packet, sent, slot = in_flight.pop(key)
+                    slot.close()
+                    rtt = time.monotonic() - sent
+                    self._record_(server, KIND_UDP, packet, raw_received, rtt)
+                    if attempt == 0:
+                        self.server_stats.add_rtt(server, rtt)
+                    try:
+                        replies[key] = self._parse_reply_(raw_received,
+                                                          server, rtt)
+                    except ReceivedPacket.NotFoundException as error:
+                        replies[key] = error
+                        continue
+                    if replies[key].tc:
+                        self.instrument.truncated(server)
+                        truncated[key] = packet
+            except (socket.timeout, ConnectionRefusedError):
+                pass
+            finally:
+                for _, _, slot in in_flight.values():
+                    slot.close()
+            if waiting or in_flight:
+                self._timeout_(server)
+        if not replies:
+            self.instrument.no_response(server)
+            raise NoResponseException
+        if truncated:
+            # truncated replies are kept for queries unanswered over TCP
+            replies.update(self._send_tcp_packets_(truncated, server))
+        return replies
+
+    def _check_truncation_(self, packet, received_packet, server):
+        if not received_packet.tc:
+            return received_packet
+        self.instrument.truncated(server)
+        try:
+            return self._send_tcp_packet_(packet, server)
+        except NoResponseException:
+            return received_packet
+
+    def _send_tcp_packet_(self, packet, server):
+        """
+        The method sends packet over persistent TCP connection
+        :param packet: bytes
+        :param server: str
+        :return: ReceivedPacket
+        """
+        replies = self._send_tcp_packets_({0: packet}, server)
+        if not replies:
+            raise NoResponseException
+        if isinstance(replies[0], ReceivedPacket.NotFoundException):
+            raise replies[0]
+        return replies[0]
+
+    def _send_tcp_packets_(self, packets, server):
+        """
+        The method pipelines packets over one persistent TCP connection,
+        as many at once as window of server allows.
+        Connection closed by server while idle is reopened once.
+        :param packets: dict key -> bytes
+        :param server: str
+        :return: dict key -> ReceivedPacket or NotFoundException,
+        without keys of unanswered packets
+        """
+        replies = {}
+        waiting = list(packets)
+        reconnected = False
+        while waiting:
+            try:
+                connection = self.tcp_connections.get_connection(
+                    server, self.port, self.timeout)
+            except OSError:
+                break
+            with contextlib.ExitStack() as slots:
+                # only the first query waits for window
+                batch = []
+                for key in waiting:
+                    if not slots.enter_context(self.limiter.slot(
+                            server, blocking=not batch)):
+                        break
+                    batch.append(key)
+                for key in batch:
+                    self.instrument.send_packet(
+                        server, IDENTIFIER.unpack_from(packets[key])[0],
+                        tcp=True)
+                try:
+                    sent = time.monotonic()
+                    raw_replies = connection.exchange(
+                        [packets[key] for key in batch], self.timeout)
+                except OSError:
+                    self.tcp_connections.discard(server, self.port,
+                                                 connection)
+                    if reconnected:
+                        break
+                    reconnected = True
+                    continue
+            rtt = time.monotonic() - sent
+            for key, raw_received in zip(batch, raw_replies):
+                self._record_(server, KIND_TCP, packets[key], raw_received,
+                              rtt)
+                try:
+                    replies[key] = self._parse_reply_(raw_received, server,
+                                                      rtt)
+                except ReceivedPacket.NotFoundException as error:
+                    replies[key] = error
+            waiting = waiting[len(batch):]
+        if waiting:
+            self.instrument.no_response(server)
+        return replies
+
+    def _receive_reply_(self, sender, packet, timeout):
+        # late replies to previous queries and stray datagrams are dropped
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout
+            sender.settimeout(remaining)
+            raw_received = sender.recv(self._receive_size_())
+            if matches_query(packet, raw_received):
+                return raw_received
@@ -0,0 +1,130 @@
+"""
+The module measures latency of DNS servers and chooses timeouts for them.
+Smoothed RTT and its variation are computed like in RFC 6298.
+"""
+__author__ = 'Skipper'
+INITIAL_TIMEOUT = 1.0
+MIN_TIMEOUT = 0.2
+PENALTY_THRESHOLD = 3
+PENALTY_TIME = 30
+
+import threading
+import time
+
+
+class ServerState:
+    """
+    Latency statistics of one server
+    """
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0
+        self.penalty_until = 0
+
+
+class ServerStats:
+    """
+    The class keeps ServerState of every server resolver talked to
+    """
+
+    def __init__(self, initial_timeout=INITIAL_TIMEOUT,
+                 min_timeout=MIN_TIMEOUT,
+                 penalty_threshold=PENALTY_THRESHOLD,
+                 penalty_time=PENALTY_TIME, clock=time.monotonic):
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.penalty_threshold = penalty_threshold
+        self.penalty_time = penalty_time
+        self.clock = clock
+        self.servers = {}
+        # resolver shared by threads updates statistics from all of them
+        self.lock = threading.Lock()
+
+    def _state_(self, server):
+        state = self.servers.get(server)
+        if state is None:
+            state = self.servers.setdefault(server, ServerState())
+        return state
+
+    def add_rtt(self, server, rtt):
+        """
+        The method takes into account measured round trip time
+        :param server: str
+        :param rtt: float - seconds
+        :return: None
+        """
+        state = self._state_(server)
+        with self.lock:
+            if state.srtt is None:
+                state.srtt = rtt
+                state.rttvar = rtt / 2
+            else:
+                state.rttvar = 0.75 * state.rttvar\
+                    + 0.25 * abs(state.srtt - rtt)
+                state.srtt = 0.875 * state.srtt + 0.125 * rtt
+            state.failures = 0
+            state.penalty_until = 0
+
+    def add_timeout(self, server):
+        """
+        The method takes into account timeout of server.
+        Server which times out penalty_threshold times in a row
+        is penalized for penalty_time seconds.
+        :param server: str
+        :return: None
+        """
+        state = self._state_(server)
+        with self.lock:
+            state.failures += 1
+            if state.failures >= self.penalty_threshold:
+                state.penalty_until = self.clock() + self.penalty_time
+
+    def is_penalized(self, server):
+        """
+        The method tells whether server is in penalty box now
+        :param server: str
+        :return: bool
+        """
+        state = self.servers.get(server)
+        return state is not None and state.penalty_until > self.clock()
+
+    def timeout(self, server, attempt, max_timeout):
+        """
+        The method returns timeout of attempt, it is doubled every retry
+        :param server: str
+        :param attempt: int - number of attempt, starts from 0
+        :param max_timeout: float
+        :return: float
+        """
+        state = self.servers.get(server)
+        if state is None or state.srtt is None:
+            timeout = self.initial_timeout
+        else:
+            timeout = max(self.min_timeout, state.srtt + 4 * state.rttvar)
+        return min(timeout * (2 ** attempt), max_timeout)
+
+    def order(self, servers):
+        """
+        The method sorts servers: fastest first, penalized last.
+        Unknown servers go first to be measured.
+        :param servers: list
+        :return: list
+        """
+        def key(server):
+            state = self.servers.get(server)
+            if state is None or state.srtt is None:
+                return self.is_penalized(server), 0
+            return self.is_penalized(server), state.srtt
+        return sorted(servers, key=key)
+
+    def get_stats(self):
+        """
+        The method returns statistics of all servers
+        :return: dict
+        """
+        return {server: {'srtt': state.srtt, 'rttvar': state.rttvar,
+                         'failures': state.failures,
+                         'penalized': self.is_penalized(server)}
+                for server, state in list(self.servers.items())}
@@ -0,0 +1,183 @@
+"""
+The module keeps ResolverCache in shared memory, so worker processes
+serving one port share answers: name resolved by one worker is a cache
+hit for the others.
+Memory is split into fixed-size slots grouped into buckets of WAYS slots,
+entry may be kept only in the bucket given by hash of its key.
+Writers of a bucket take one of striped locks, readers take no lock:
+every slot has sequence number which is odd while slot is written,
+so reader retries if it changed during reading.
+"""
+__author__ = 'Skipper'
+DEFAULT_SLOTS = 65536
+DEFAULT_SLOT_SIZE = 512
+DEFAULT_STRIPES = 64
+WAYS = 4
+READ_RETRIES = 8
+
+import marshal
+import multiprocessing
+import struct
+import time
+import zlib
+from multiprocessing import shared_memory
+from cache import DEFAULT_CACHE_SIZE, DEFAULT_MAX_TTL, DEFAULT_NEGATIVE_TTL,\
+    CacheEntry, ResolverCache, intern_records
+
+# sequence, hash of name, expires, ttl, type, negative, length of name,
+# length of records; then name and marshalled records
+SLOT_HEADER = struct.Struct('=IIddHBBH')
+SEQUENCE = struct.Struct('=I')
+
+
+class SharedCache(ResolverCache):
+    """
+    ResolverCache with second level in shared memory. Entries which are
+    found in shared memory are copied to memory of process.
+    Cache must be created before worker processes are forked and
+    its clock must be common for processes, time.monotonic is.
+    """
+
+    def __init__(self, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE,
+                 stripes=DEFAULT_STRIPES, max_size=DEFAULT_CACHE_SIZE,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, max_ttl=DEFAULT_MAX_TTL,
+                 clock=time.monotonic):
+        super().__init__(max_size, negative_ttl, max_ttl, clock)
+        if slot_size <= SLOT_HEADER.size:
+            raise Exception('Too small slot size {}'.format(slot_size))
+        self.buckets = max(1, slots // WAYS)
+        self.slot_size = slot_size
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=self.buckets * WAYS * slot_size)
+        self.buffer = self.memory.buf
+        self.stripes = [multiprocessing.Lock() for _ in range(stripes)]
+        self.shared_hits = 0
+        self.oversized = 0
+        self.retries = 0
+
+    def _bucket_(self, encoded, query_type):
+        hashed = zlib.crc32(encoded)
+        return hashed, (hashed + query_type) % self.buckets
+
+    def _read_slot_(self, offset):
+        # returns header and body or None if slot is being written
+        buffer = self.buffer
+        for _ in range(READ_RETRIES):
+            sequence = SEQUENCE.unpack_from(buffer, offset)[0]
+            if not sequence & 1:
+                header = SLOT_HEADER.unpack_from(buffer, offset)
+                start = offset + SLOT_HEADER.size
+                body = bytes(buffer[start:start + header[6] + header[7]])
+                if SEQUENCE.unpack_from(buffer, offset)[0] == sequence:
+                    return header, body
+            self.retries += 1
+        return None
+
+    def _load_(self, key):
+        name, query_type = key
+        encoded = name.encode('utf8')
+        hashed, bucket = self._bucket_(encoded, query_type)
+        now = self.clock()
+        for way in range(WAYS):
+            slot = self._read_slot_((bucket * WAYS + way) * self.slot_size)
+            if slot is None:
+                continue
+            header, body = slot
+            (_, slot_hash, expires, ttl, slot_type, negative, name_length,
+             _) = header
+            if slot_hash != hashed or slot_type != query_type\
+                    or expires <= now or body[:name_length] != encoded:
+                continue
+            self.shared_hits += 1
+            if negative:
+                return CacheEntry(None, expires, negative=True, ttl=ttl)
+            return CacheEntry(intern_records(marshal.loads(
+                body[name_length:])), expires, ttl=ttl)
+        return None
+
+    def _store_(self, key, entry):
+        super()._store_(key, entry)
+        name, query_type = key
+        encoded = name.encode('utf8')
+        records = b'' if entry.negative else marshal.dumps(entry.records)
+        if len(encoded) > 255 or SLOT_HEADER.size + len(encoded)\
+                + len(records) > self.slot_size:
+            self.oversized += 1
+            return
+        hashed, bucket = self._bucket_(encoded, query_type)
+        buffer = self.buffer
+        with self.stripes[bucket % len(self.stripes)]:
+            offset = self._choose_slot_(bucket, hashed, query_type, encoded)
+            sequence = SEQUENCE.unpack_from(buffer, offset)[0]
+            SLOT_HEADER.pack_into(buffer, offset, sequence + 1, hashed,
+                                  entry.expires, entry.ttl or 0, query_type,
+                                  int(entry.negative), len(encoded),
+                                  len(records))
+            start = offset + SLOT_HEADER.size
+            buffer[start:start + len(encoded)] = encoded
+            start += len(encoded)
+            buffer[start:start + len(records)] = records
+            SEQUENCE.pack_into(buffer, offset, (sequence + 2) & 0xffffffff)
+
+    def _choose_slot_(self, bucket, hashed, query_type, encoded):
+        # slot of the same key, else free or expired one,
+        # else the one which expires first
+        now = self.clock()
+        chosen = None
+        chosen_expires = None
+        for way in range(WAYS):
+            offset = (bucket * WAYS + way) * self.slot_size
+            header = SLOT_HEADER.unpack_from(self.buffer, offset)
+            expires, name_length = header[2], header[6]
+            start = offset + SLOT_HEADER.size
+            if header[1] == hashed and header[4] == query_type\
+                    and self.buffer[start:start + name_length] == encoded:
+                return offset
+            if expires <= now:
+                expires = float('-inf')
+            if chosen is None or expires < chosen_expires:
+                chosen, chosen_expires = offset, expires
+        if chosen_expires != float('-inf'):
+            self.evictions += 1
+        return chosen
+
+    def clear(self):
+        """
+        The method drops every entry in memory of process and shared one
+        :return: None
+        """
+        super().clear()
+        for bucket in range(self.buckets):
+            with self.stripes[bucket % len(self.stripes)]:
+                for way in range(WAYS):
+                    offset = (bucket * WAYS + way) * self.slot_size
+                    sequence = SEQUENCE.unpack_from(self.buffer, offset)[0]
+                    SLOT_HEADER.pack_into(self.buffer, offset,
+                                          (sequence + 2) & 0xffffffff,
+                                          0, 0, 0, 0, 0, 0, 0)
+
+    def close(self):
+        """
+        The method detaches process from shared memory
+        :return: None
+        """
+        if self.buffer is not None:
+            self.buffer.release()
+            self.buffer = None
+            self.memory.close()
+
+    def unlink(self):
+        """
+        The method frees shared memory, it is called once by process
+        which created cache after workers are stopped
+        :return: None
+        """
+        self.close()
+        self.memory.unlink()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['shared_hits'] = self.shared_hits
+        stats['oversized'] = self.oversized
+        stats['retries'] = self.retries
+        return stats
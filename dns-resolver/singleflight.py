@@ -0,0 +1,119 @@
+"""
+The module coalesces concurrent identical lookups: the first caller of
+a key does the work, callers which come while it is running wait for
+its result or its exception.
+"""
+__author__ = 'Skipper'
+
+import asyncio
+import threading
+
+
+class Flight:
+    """
+    Running call, its result or exception when it is finished
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalescing of calls made from several threads
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, function, *args):
+        """
+        The method calls function unless call with the same key is
+        running, then result of that call is returned
+        :param key: hashable
+        :param function: callable
+        :param args: arguments of function
+        :return: result of function
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*args)
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def get_stats(self):
+        """
+        The method returns counters of calls
+        :return: dict
+        """
+        with self.lock:
+            return {'leaders': self.leaders, 'followers': self.followers,
+                    'running': len(self.flights)}
+
+    def __len__(self):
+        return len(self.flights)
+
+
+class AsyncSingleFlight:
+    """
+    Coalescing of coroutines of one event loop. Call goes on if its
+    first caller is cancelled, while others wait for it.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key, function, *args):
+        """
+        The method awaits function unless call with the same key is
+        running, then result of that call is returned
+        :param key: hashable
+        :param function: coroutine function
+        :param args: arguments of function
+        :return: result of function
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(function(*args))
+            self.flights[key] = flight
+            flight.add_done_callback(lambda _: self.flights.pop(key, None))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        return await asyncio.shield(flight)
+
+    def get_stats(self):
+        """
+        The method returns counters of calls
+        :return: dict
+        """
+        return {'leaders': self.leaders, 'followers': self.followers,
+                'running': len(self.flights)}
+
+    def __len__(self):
+        return len(self.flights)
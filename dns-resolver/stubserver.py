@@ -0,0 +1,295 @@
+"""
+The module runs resolver as local caching DNS server: clients on other
+processes send recursive queries over UDP or TCP and get answers found by
+AsyncResolver. Answers from cache are sent straight from datagram handler,
+only misses start lookups, so cached names are served at TARGET_QPS
+queries per second or more on one core (measured by
+"python bench_resolver.py --serve").
+Responses made from cache are kept in WireCache too, repeated queries
+are answered from it without parsing query.
+"""
+__author__ = 'Skipper'
+DEFAULT_LISTEN_ADDRESS = '127.0.0.1'
+DEFAULT_LISTEN_PORT = 5353
+TARGET_QPS = 5000
+RECEIVE_BUFFER = 4 * 1024 * 1024
+BIND_ATTEMPTS = 8
+
+import asyncio
+import math
+import socket
+from asyncresolver import AsyncResolver
+from packet import CLASSIC_PAYLOAD, QueryPacket, ResponsePacket
+from transport import LENGTH
+from wirecache import WireCache
+
+RCODE_FORMAT_ERROR = 1
+RCODE_SERVER_FAILURE = 2
+RCODE_NAME_ERROR = 3
+RCODE_NOT_IMPLEMENTED = 4
+
+
+class StubServer:
+    """
+    Server answering queries of clients with resolver and its cache.
+    Clients asking for the same name at once wait for one lookup of
+    resolver, which coalesces them. With reuse_port several servers, e.g. in
+    worker processes, may listen on one port and system spreads
+    clients over them.
+    """
+
+    def __init__(self, resolver=None, address=DEFAULT_LISTEN_ADDRESS,
+                 port=DEFAULT_LISTEN_PORT, reuse_port=False,
+                 wire_cache=None, instrument=None):
+        self.resolver = AsyncResolver() if resolver is None else resolver
+        # answers from cache are events of the same sinks as lookups
+        self.instrument = self.resolver.instrument if instrument is None\
+            else instrument
+        self.wire_cache = WireCache(clock=self.resolver.cache.clock)\
+            if wire_cache is None else wire_cache
+        self.address = address
+        self.port = port
+        self.reuse_port = reuse_port
+        self.transport = None
+        self.tcp_server = None
+        self.received = 0
+        self.tcp_received = 0
+        self.cached = 0
+        self.malformed = 0
+        self.failures = 0
+
+    async def start(self):
+        """
+        The method starts listening on (address, port), port 0 is
+        replaced by the one given by system
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        await self.resolver.open()
+        port = self.port
+        for attempt in range(BIND_ATTEMPTS):
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: StubDatagramProtocol(self),
+                local_addr=(self.address, port),
+                reuse_port=self.reuse_port)
+            # many clients may send queries at once
+            self.transport.get_extra_info('socket').setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+            self.port = self.transport.get_extra_info('sockname')[1]
+            try:
+                self.tcp_server = await asyncio.start_server(
+                    self._serve_tcp_, self.address, self.port,
+                    reuse_address=True, reuse_port=self.reuse_port)
+                return
+            except OSError:
+                self.transport.close()
+                self.transport = None
+                # port free for UDP may be taken for TCP by other
+                # process, system is asked for other one then
+                if port or attempt == BIND_ATTEMPTS - 1:
+                    raise
+
+    async def serve_forever(self):
+        """
+        The method starts server and answers queries until it is cancelled
+        :return: None
+        """
+        if self.transport is None:
+            await self.start()
+        try:
+            await self.tcp_server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        The method stops listening
+        :return: None
+        """
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+            self.tcp_server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def parse(self, raw_query):
+        """
+        The method parses query of client
+        :param raw_query: bytes
+        :return: QueryPacket or None if query is malformed
+        """
+        try:
+            return QueryPacket.query_packet_from_bytes(raw_query)
+        except Exception:
+            self.malformed += 1
+            return None
+
+    def answer_cached(self, query, max_size=None):
+        """
+        The method makes response which needs no lookup: from cache or
+        with error of query
+        :param query: QueryPacket
+        :param max_size: int - limit of UDP response
+        :return: bytes or None if lookup is needed
+        """
+        response = ResponsePacket(query)
+        response.ra = 1
+        if query.opcode != QueryPacket.OP_DIRECT:
+            response.rcode = RCODE_NOT_IMPLEMENTED
+        elif len(query.questions) != 1:
+            response.rcode = RCODE_FORMAT_ERROR
+        else:
+            question = query.questions[0]
+            cache = self.resolver.cache
+            entry = cache.get(question.query_name, question.query_type)
+            if entry is None:
+                return None
+            self.cached += 1
+            self.instrument.cache_hit(question.query_name, entry.negative)
+            self.resolver.prefetch(question.query_name,
+                                   question.query_type, entry)
+            return self._respond_(response, entry, max_size)
+        return response.get_packet(max_size)
+
+    async def answer(self, query, max_size=None):
+        """
+        The method makes response to query, resolving its question
+        if it is not cached
+        :param query: QueryPacket
+        :param max_size: int - limit of UDP response
+        :return: bytes
+        """
+        reply = self.answer_cached(query, max_size)
+        if reply is not None:
+            return reply
+        question = query.questions[0]
+        key = self.resolver.cache.make_key(question.query_name,
+                                           question.query_type)
+        try:
+            result = await self.resolver.resolve(*key)
+        except Exception:
+            result = self.resolver.NO_RESPONSE
+        response = ResponsePacket(query)
+        response.ra = 1
+        entry = self.resolver.cache.get(*key)
+        if entry is not None:
+            return self._respond_(response, entry, max_size)
+        elif result == self.resolver.NO_RESPONSE:
+            self.failures += 1
+            response.rcode = RCODE_SERVER_FAILURE
+        elif result == self.resolver.NAME_NOT_FOUND:
+            response.rcode = RCODE_NAME_ERROR
+        else:
+            # cache is disabled, clients must not keep answer either
+            self._add_records_(response, question, result, 0)
+        return response.get_packet(max_size)
+
+    def _respond_(self, response, entry, max_size):
+        # response to question of cached entry is kept in wire cache
+        remaining = entry.expires - self.resolver.cache.clock()
+        question = response.questions[0]
+        if entry.negative:
+            response.rcode = RCODE_NAME_ERROR
+        else:
+            self._add_records_(response, question, entry.records,
+                               max(0, math.ceil(remaining)))
+        packet = response.get_packet(max_size)
+        lifetime = remaining
+        prefetcher = self.resolver.prefetcher
+        if prefetcher is not None and entry.ttl is not None:
+            # queries bypass wire cache when entry may be refreshed,
+            # so hits of hot entries reach prefetcher
+            lifetime -= entry.ttl * prefetcher.fraction
+        if not packet[2] & 2:
+            self.wire_cache.put(question, response.edns_payload is not None,
+                                packet, response.ttl_offsets, lifetime)
+        return packet
+
+    @staticmethod
+    def _add_records_(response, question, records, ttl):
+        # records follow CNAME chain, so owner of next record
+        # is target of previous CNAME
+        owner = question.query_name
+        for record_type, data in records:
+            response.add_answer(owner, record_type, ttl, data)
+            if record_type == QueryPacket.QU_CNAME:
+                owner = data
+
+    async def _reply_udp_(self, query, max_size, addr):
+        reply = await self.answer(query, max_size)
+        if self.transport is not None:
+            self.transport.sendto(reply, addr)
+
+    async def _serve_tcp_(self, reader, writer):
+        try:
+            while True:
+                length = LENGTH.unpack(await reader.readexactly(2))[0]
+                raw_query = await reader.readexactly(length)
+                self.tcp_received += 1
+                reply = self.wire_cache.get(raw_query, udp=False)
+                if reply is not None:
+                    writer.write(LENGTH.pack(len(reply)) + reply)
+                    continue
+                query = self.parse(raw_query)
+                if query is None:
+                    break
+                asyncio.ensure_future(self._reply_tcp_(writer, query))
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        writer.close()
+
+    async def _reply_tcp_(self, writer, query):
+        reply = await self.answer(query)
+        if not writer.is_closing():
+            writer.write(LENGTH.pack(len(reply)) + reply)
+
+    def get_stats(self):
+        """
+        The method returns counters of server
+        :return: dict
+        """
+        return {'received': self.received, 'tcp_received': self.tcp_received,
+                'cached': self.cached, 'malformed': self.malformed,
+                'wire_hits': self.wire_cache.hits, 'failures': self.failures,
+                'lookups': len(self.resolver.flights)}
+
+
+class StubDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    UDP side of StubServer
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        server = self.server
+        server.received += 1
+        reply = server.wire_cache.get(data)
+        if reply is not None:
+            self.transport.sendto(reply, addr)
+            return
+        query = server.parse(data)
+        if query is None:
+            return
+        max_size = max(query.edns_payload or 0, CLASSIC_PAYLOAD)
+        reply = server.answer_cached(query, max_size)
+        if reply is not None:
+            self.transport.sendto(reply, addr)
+        else:
+            asyncio.ensure_future(server._reply_udp_(query, max_size, addr))
+
+    def error_received(self, exc):
+        pass
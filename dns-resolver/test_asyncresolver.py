@@ -0,0 +1,120 @@
+"""
+Unit test for "asyncresolver" module
+"""
+__author__ = 'Skipper'
+from asyncresolver import AsyncResolver
+import asyncio
+import random
+import unittest
+
+
+def make_reply(query, address):
+    """
+    The function answers the query with one A record or NXDOMAIN
+    """
+    reply = bytearray(query)
+    reply[2] |= 0x80
+    if address is None:
+        reply[3] = (reply[3] & 0xf0) | 3
+        return bytes(reply)
+    reply[6:8] = (0, 1)
+    reply.extend((0xc0, 12, 0, 1, 0, 1, 0, 0, 1, 0x2c, 0, 4))
+    reply.extend(address)
+    return bytes(reply)
+
+
+class LocalServer(asyncio.DatagramProtocol):
+    """
+    Server answers every name with address built from its length
+    and replies in random order
+    """
+    def __init__(self):
+        self.transport = None
+        self.received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        name = data[13:13 + data[12]].decode()
+        address = None if name.startswith('nx') else (10, 0, 0, len(name))
+        asyncio.get_running_loop().call_later(
+            random.random() / 50, self.transport.sendto,
+            make_reply(data, address), addr)
+
+
+class TestAsyncResolver(unittest.TestCase):
+    """
+    Test class for AsyncResolver
+    """
+    def _run_(self, coroutine_function):
+        async def runner():
+            loop = asyncio.get_running_loop()
+            transport, server = await loop.create_datagram_endpoint(
+                LocalServer, local_addr=('127.0.0.1', 0))
+            port = transport.get_extra_info('sockname')[1]
+            resolver = AsyncResolver('127.0.0.1', port, waiting=1)
+            try:
+                return await coroutine_function(resolver, server)
+            finally:
+                await resolver.close()
+                transport.close()
+        return asyncio.run(runner())
+
+    def testResolveMany(self):
+        names = ['host{}.example'.format(i) for i in range(500)]
+
+        async def check(resolver, server):
+            return await resolver.resolve_many(names)
+        results = self._run_(check)
+        for name, result in zip(names, results):
+            label = name.split('.')[0]
+            self.assertEqual([(1, '10.0.0.{}'.format(len(label)))], result)
+
+    def testResolveIter(self):
+        names = ['host{}.example'.format(i) for i in range(100)]
+
+        async def check(resolver, server, ordered):
+            return [name async for name, _ in resolver.resolve_iter(
+                iter(names), jobs=8, ordered=ordered)]
+        self.assertEqual(names, self._run_(
+            lambda resolver, server: check(resolver, server, True)))
+        self.assertEqual(sorted(names), sorted(self._run_(
+            lambda resolver, server: check(resolver, server, False))))
+
+    def testResolveAsyncIterable(self):
+        names = ['host{}.example'.format(i) for i in range(100)]
+
+        async def read():
+            for name in names:
+                # names come slowly, like lines of pipe
+                await asyncio.sleep(0.001)
+                yield name
+
+        async def check(resolver, server):
+            return [name async for name, _ in resolver.resolve_iter(
+                read(), jobs=8, ordered=True)]
+        self.assertEqual(names, self._run_(check))
+
+    def testNotFoundAndCache(self):
+        async def check(resolver, server):
+            first = await resolver.resolve_many(['nxname.example', 'eur.al'])
+            second = await resolver.resolve_many(['nxname.example', 'eur.al'])
+            return first, second, server.received
+        first, second, received = self._run_(check)
+        self.assertEqual([AsyncResolver.NAME_NOT_FOUND, [(1, '10.0.0.3')]],
+                         first)
+        self.assertEqual(first, second)
+        self.assertEqual(2, received)
+
+    def testNoResponse(self):
+        async def check(resolver, server):
+            resolver.port = 1
+            resolver.num_of_retries = 1
+            resolver.timeout = 0.1
+            return await resolver.resolve('eur.al')
+        self.assertEqual(AsyncResolver.NO_RESPONSE, self._run_(check))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+Unit test for "cache" module
+"""
+__author__ = 'Skipper'
+from cache import ResolverCache
+import sys
+import unittest
+
+
+class FakeClock:
+    """
+    Clock which is moved by hands
+    """
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResolverCache(unittest.TestCase):
+    """
+    Test class for ResolverCache
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResolverCache(max_size=2, negative_ttl=10,
+                                   clock=self.clock)
+
+    def testHitAndMiss(self):
+        self.assertIsNone(self.cache.get('eur.al', 1))
+        self.cache.put('eur.al', 1, [(1, '31.170.165.34')], 300)
+        entry = self.cache.get('EUR.al.', 1)
+        self.assertEqual([(1, '31.170.165.34')], entry.records)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def testExpiration(self):
+        self.cache.put('eur.al', 1, [(1, '31.170.165.34')], 300)
+        self.clock.now = 300
+        self.assertIsNone(self.cache.get('eur.al', 1))
+        self.assertEqual(1, self.cache.expirations)
+
+    def testNegative(self):
+        self.cache.put_negative('opsidjgsdkjf.paris', 1)
+        self.assertTrue(self.cache.get('opsidjgsdkjf.paris', 1).negative)
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get('opsidjgsdkjf.paris', 1))
+
+    def testEviction(self):
+        self.cache.put('a.ru', 1, [(1, '1.1.1.1')], 300)
+        self.cache.put('b.ru', 1, [(1, '2.2.2.2')], 300)
+        self.cache.get('a.ru', 1)
+        self.cache.put('c.ru', 1, [(1, '3.3.3.3')], 300)
+        self.assertIsNone(self.cache.get('b.ru', 1))
+        self.assertIsNotNone(self.cache.get('a.ru', 1))
+        self.assertEqual(1, self.cache.evictions)
+
+    def testZeroTTL(self):
+        self.cache.put('eur.al', 1, [(1, '31.170.165.34')], 0)
+        self.assertEqual(0, len(self.cache))
+
+    def testInterned(self):
+        target = ''.join(['mx.', 'eur.al'])
+        self.cache.put(''.join(['EUR.', 'al.']), 15, [(15, (10, target))],
+                       300)
+        entry = self.cache.get('eur.al', 15)
+        self.assertIs(sys.intern('mx.eur.al'), entry.records[0][1][1])
+        self.assertIs(sys.intern('eur.al'), next(iter(self.cache.entries))[0])
+        self.assertFalse(hasattr(entry, '__dict__'))
+
+if __name__ == "__main__":
+    unittest.main()
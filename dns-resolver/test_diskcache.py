@@ -0,0 +1,129 @@
+"""
+Unit test for "diskcache" module
+"""
+__author__ = 'Skipper'
+from asyncresolver import AsyncResolver
+from diskcache import PersistentCache
+from fakedns import make_hierarchy
+from resolver import Resolver
+from test_cache import FakeClock
+import asyncio
+import os
+import tempfile
+import unittest
+
+
+class TestPersistentCache(unittest.TestCase):
+    """
+    Test class for PersistentCache
+    """
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.clock = FakeClock()
+        self.wall_clock = FakeClock()
+        self.wall_clock.now = 1000000
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def make_cache(self, table='answers', **kwargs):
+        return PersistentCache(self.path, table, clock=self.clock,
+                               wall_clock=self.wall_clock, **kwargs)
+
+    def testRestart(self):
+        with self.make_cache() as cache:
+            cache.put('eur.al', 1, [(1, '31.170.165.34')], 100)
+            cache.put('eur.al', 15, [(15, (10, 'mail.eur.al'))], 100)
+            cache.put_negative('nope.al', 1)
+        # new process: another monotonic clock, 40 seconds later
+        self.clock.now = 5000
+        self.wall_clock.now += 40
+        with self.make_cache() as cache:
+            self.assertEqual(0, len(cache))
+            entry = cache.get('EUR.al.', 1)
+            self.assertEqual([(1, '31.170.165.34')], entry.records)
+            self.assertEqual(5060, entry.expires)
+            self.assertEqual([(15, (10, 'mail.eur.al'))],
+                             cache.get('eur.al', 15).records)
+            self.assertTrue(cache.get('nope.al', 1).negative)
+            self.assertIsNone(cache.get('other.al', 1))
+            self.assertEqual(3, cache.get_stats()['loaded'])
+            self.clock.now += 30
+            self.wall_clock.now += 30
+            self.assertIsNone(cache.get('nope.al', 1))
+
+    def testExpiredRowsAreDropped(self):
+        with self.make_cache() as cache:
+            cache.put('eur.al', 1, [(1, '31.170.165.34')], 100)
+        self.wall_clock.now += 100
+        with self.make_cache() as cache:
+            self.assertIsNone(cache.get('eur.al', 1))
+            self.assertEqual([], cache.connection.execute(
+                'SELECT * FROM answers').fetchall())
+
+    def testIncrementalCommits(self):
+        cache = self.make_cache(commit_every=2)
+        reader = self.make_cache()
+        cache.put('a.al', 1, [(1, '1.1.1.1')], 100)
+        self.assertIsNone(reader.get('a.al', 1))
+        cache.put('b.al', 1, [(1, '2.2.2.2')], 100)
+        self.assertIsNotNone(reader.get('a.al', 1))
+        cache.close()
+        reader.close()
+
+    def testTables(self):
+        with self.make_cache() as answers,\
+                self.make_cache('delegations') as delegations:
+            answers.put('al', 2, [(2, 'ns.al')], 100)
+            delegations.put('al', 2, ['127.0.0.2'], 100)
+            answers.clear()
+        with self.make_cache('delegations') as delegations:
+            self.assertEqual(['127.0.0.2'], delegations.get('al', 2).records)
+        with self.make_cache() as answers:
+            self.assertIsNone(answers.get('al', 2))
+        self.assertRaises(Exception, PersistentCache, self.path, 'a; b')
+
+    def testWarmResolver(self):
+        hierarchy, names = make_hierarchy(4, tlds=('al',), domains=1)
+        with hierarchy:
+            for expected_root_queries in (1, 0):
+                cache = PersistentCache(self.path)
+                delegations = PersistentCache(self.path, 'delegations')
+                with Resolver(hierarchy.root, port=hierarchy.port, waiting=1,
+                              cache=cache,
+                              delegations=delegations) as resolver:
+                    root = hierarchy.servers['127.0.0.1']
+                    root.received = 0
+                    self.assertEqual([(1, '0.0.0.0')],
+                                     resolver.resolve(names[0]))
+                    self.assertEqual(expected_root_queries, root.received)
+                cache.close()
+                delegations.close()
+            # the other name starts at cached zone cut
+            with PersistentCache(self.path, 'delegations') as delegations:
+                with Resolver(hierarchy.root, port=hierarchy.port, waiting=1,
+                              delegations=delegations) as resolver:
+                    self.assertEqual([(1, '0.0.0.1')],
+                                     resolver.resolve(names[1]))
+                    self.assertEqual(0, root.received)
+
+    def testWarmAsyncResolver(self):
+        hierarchy, names = make_hierarchy(2, tlds=('al',), domains=1)
+
+        async def resolve(name):
+            with PersistentCache(self.path, 'delegations') as delegations:
+                async with AsyncResolver(hierarchy.root, hierarchy.port,
+                                         waiting=1,
+                                         delegations=delegations) as resolver:
+                    return await resolver.resolve(name)
+        with hierarchy:
+            root = hierarchy.servers['127.0.0.1']
+            self.assertEqual([(1, '0.0.0.0')], asyncio.run(resolve(names[0])))
+            self.assertEqual(1, root.received)
+            # restarted resolver begins with zone cut kept in file
+            self.assertEqual([(1, '0.0.0.1')], asyncio.run(resolve(names[1])))
+            self.assertEqual(1, root.received)
+
+if __name__ == "__main__":
+    unittest.main()
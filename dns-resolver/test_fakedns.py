@@ -0,0 +1,395 @@
+"""
+Unit test of resolvers against "fakedns" hierarchy, works without internet
+"""
+__author__ = 'Skipper'
+from asyncresolver import AsyncResolver
+from cache import ResolverCache
+from fakedns import SOA_MINIMUM, FakeHierarchy, make_hierarchy
+from packet import QueryPacket
+from ratelimit import RateLimiter
+from resolver import Resolver
+import asyncio
+import contextlib
+import threading
+import time
+import unittest
+
+
+class TestFakeHierarchy(unittest.TestCase):
+    """
+    Test class for Resolver and AsyncResolver over FakeHierarchy
+    """
+    def setUp(self):
+        self.hierarchy = FakeHierarchy()
+        self.hierarchy.add_record('eur.al', QueryPacket.QU_A,
+                                  '31.170.165.34')
+        self.hierarchy.add_record('anytask.urgu.org', QueryPacket.QU_CNAME,
+                                  'dijkstra.urgu.org')
+        self.hierarchy.add_record('dijkstra.urgu.org', QueryPacket.QU_A,
+                                  '212.193.68.250')
+        self.hierarchy.add_zone('paris')
+        self.hierarchy.start()
+        self.resolver = Resolver(self.hierarchy.root,
+                                 port=self.hierarchy.port, waiting=1)
+
+    def tearDown(self):
+        self.resolver.close()
+        self.hierarchy.stop()
+
+    def testRecursion(self):
+        self.assertEqual([(1, '31.170.165.34')],
+                         self.resolver.resolve('eur.al'))
+        self.assertEqual(1, self.hierarchy.server_of('al').received)
+
+    def testCNameRecord(self):
+        self.assertEqual([(5, 'dijkstra.urgu.org'), (1, '212.193.68.250')],
+                         self.resolver.resolve('anytask.urgu.org'))
+
+    def testNotFound(self):
+        self.assertEqual(Resolver.NAME_NOT_FOUND,
+                         self.resolver.resolve('opsidjgsdkjf.paris'))
+
+    def testTruncation(self):
+        self.hierarchy.server_of('al').truncate = True
+        self.assertEqual([(1, '31.170.165.34')],
+                         self.resolver.resolve('eur.al'))
+        self.assertEqual(1, self.hierarchy.server_of('al').tcp_received)
+
+    def testLoss(self):
+        server = self.hierarchy.server_of('al')
+        server.loss = 0.5
+        self.resolver.timeout = 0.05
+        self.resolver.num_of_retries = 20
+        self.assertEqual([(1, '31.170.165.34')],
+                         self.resolver.resolve('eur.al'))
+
+    def testReferredServerSilent(self):
+        self.hierarchy.server_of('al').loss = 1.0
+        self.resolver.timeout = 0.1
+        self.resolver.num_of_retries = 1
+        self.assertEqual(Resolver.NO_RESPONSE, self.resolver.resolve('x.al'))
+        self.assertEqual({QueryPacket.QU_A: Resolver.NO_RESPONSE},
+                         self.resolver.resolve_types('y.al',
+                                                     [QueryPacket.QU_A]))
+        # zone cut of al is cached, lookup goes back to root and fails too
+        self.assertEqual(Resolver.NO_RESPONSE, self.resolver.resolve('z.al'))
+        self.assertIsNone(self.resolver.cache.get('x.al', QueryPacket.QU_A))
+
+    def testServerWithoutEdns(self):
+        self.hierarchy.server_of('al').edns = False
+        self.resolver.edns_payload = 1232
+        self.assertEqual([(1, '31.170.165.34')],
+                         self.resolver.resolve('eur.al'))
+        self.assertEqual({QueryPacket.QU_MX: []},
+                         self.resolver.resolve_types('eur.al',
+                                                     [QueryPacket.QU_MX]))
+        self.assertEqual(4, self.hierarchy.server_of('al').received)
+
+        async def check():
+            async with AsyncResolver(self.hierarchy.root, self.hierarchy.port,
+                                     waiting=1, edns_payload=1232) as resolver:
+                return await resolver.resolve('eur.al', QueryPacket.QU_AAAA)
+        self.assertEqual([], asyncio.run(check()))
+        self.assertEqual(6, self.hierarchy.server_of('al').received)
+
+    def testAsyncResolver(self):
+        async def check():
+            async with AsyncResolver(self.hierarchy.root, self.hierarchy.port,
+                                     waiting=1) as resolver:
+                return await resolver.resolve_many(
+                    ['eur.al', 'anytask.urgu.org', 'opsidjgsdkjf.paris'])
+        self.assertEqual([[(1, '31.170.165.34')],
+                          [(5, 'dijkstra.urgu.org'), (1, '212.193.68.250')],
+                          AsyncResolver.NAME_NOT_FOUND], asyncio.run(check()))
+
+
+    def testAsyncSharesDelegations(self):
+        self.resolver.resolve('eur.al')
+
+        async def check():
+            async with AsyncResolver(
+                    self.hierarchy.root, self.hierarchy.port, waiting=1,
+                    delegations=self.resolver.delegations,
+                    server_stats=self.resolver.server_stats) as resolver:
+                return [await resolver.resolve(name, query_type)
+                        for name, query_type in (
+                            ('eur.al', QueryPacket.QU_MX),
+                            ('anytask.urgu.org', QueryPacket.QU_A),
+                            ('dijkstra.urgu.org', QueryPacket.QU_MX))]
+        self.assertEqual([[], [(5, 'dijkstra.urgu.org'),
+                               (1, '212.193.68.250')], []],
+                         asyncio.run(check()))
+        # lookups begin with zone cuts cached by both resolvers
+        self.assertEqual(2, self.hierarchy.servers['127.0.0.1'].received)
+        self.assertEqual(1, self.hierarchy.server_of('org').received)
+        stats = self.resolver.server_stats.get_stats()
+        self.assertIsNotNone(stats[self.hierarchy.server_of('urgu.org')
+                                   .address]['srtt'])
+
+
+class PeakLimiter(RateLimiter):
+    """
+    RateLimiter remembering the most places held at once
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.held = 0
+        self.peak = 0
+
+    @contextlib.contextmanager
+    def slot(self, server, blocking=True):
+        with super().slot(server, blocking) as taken:
+            if taken:
+                with self.lock:
+                    self.held += 1
+                    self.peak = max(self.peak, self.held)
+            try:
+                yield taken
+            finally:
+                if taken:
+                    with self.lock:
+                        self.held -= 1
+
+
+class TestResolveTypes(unittest.TestCase):
+    """
+    Test of lookup of several types at once
+    """
+    def setUp(self):
+        self.hierarchy = FakeHierarchy(latency=0.1)
+        self.hierarchy.add_record('eur.al', QueryPacket.QU_A,
+                                  '31.170.165.34')
+        self.hierarchy.add_record('eur.al', QueryPacket.QU_MX,
+                                  (10, 'mail.eur.al'))
+        self.hierarchy.add_record('www.al', QueryPacket.QU_CNAME, 'eur.al')
+        self.hierarchy.start()
+        self.resolver = Resolver(self.hierarchy.root,
+                                 port=self.hierarchy.port, waiting=1)
+
+    def tearDown(self):
+        self.resolver.close()
+        self.hierarchy.stop()
+
+    def testTypes(self):
+        types = [QueryPacket.QU_A, QueryPacket.QU_AAAA, QueryPacket.QU_MX]
+        started = time.monotonic()
+        results = self.resolver.resolve_types('eur.al', types)
+        # referral and answer to A, then AAAA and MX together;
+        # serial lookups would take six round trips
+        self.assertLess(time.monotonic() - started, 0.45)
+        self.assertEqual({QueryPacket.QU_A: [(1, '31.170.165.34')],
+                          QueryPacket.QU_AAAA: [],
+                          QueryPacket.QU_MX: [(15, (10, 'mail.eur.al'))]},
+                         results)
+        self.assertEqual(types, list(results))
+        # only query of A follows delegations
+        self.assertEqual(1, self.hierarchy.servers['127.0.0.1'].received)
+        self.assertEqual(results[QueryPacket.QU_MX],
+                         self.resolver.resolve('eur.al', QueryPacket.QU_MX))
+        self.assertEqual(3, self.hierarchy.server_of('al').received)
+
+    def testDelegationsFollowedOnce(self):
+        hierarchy = FakeHierarchy()
+        hierarchy.add_zone('al')
+        hierarchy.add_zone('eur.al')
+        hierarchy.add_record('www.eur.al', QueryPacket.QU_A, '31.170.165.34')
+        hierarchy.add_record('www.eur.al', QueryPacket.QU_MX,
+                             (10, 'mail.eur.al'))
+        types = [QueryPacket.QU_A, QueryPacket.QU_AAAA, QueryPacket.QU_MX]
+
+        async def resolve_async():
+            async with AsyncResolver(hierarchy.root, hierarchy.port,
+                                     waiting=1) as resolver:
+                return await resolver.resolve_types('www.eur.al', types)
+        with hierarchy:
+            with Resolver(hierarchy.root, port=hierarchy.port,
+                          waiting=1) as resolver:
+                results = resolver.resolve_types('www.eur.al', types)
+            self.assertEqual(results, asyncio.run(resolve_async()))
+        self.assertEqual([(15, (10, 'mail.eur.al'))],
+                         results[QueryPacket.QU_MX])
+        # root and "al" are asked once, "eur.al" once per type
+        for resolvers, zone in ((2, ''), (2, 'al'), (6, 'eur.al')):
+            self.assertEqual(resolvers, hierarchy.server_of(zone).received)
+
+    def testWindow(self):
+        limiter = PeakLimiter(max_in_flight=1)
+        with Resolver(self.hierarchy.root, port=self.hierarchy.port,
+                      waiting=1, limiter=limiter) as resolver:
+            results = resolver.resolve_types(
+                'eur.al', [QueryPacket.QU_A, QueryPacket.QU_AAAA,
+                           QueryPacket.QU_MX])
+        self.assertEqual([(15, (10, 'mail.eur.al'))],
+                         results[QueryPacket.QU_MX])
+        # AAAA and MX are sent one after another
+        self.assertEqual(1, limiter.peak)
+        self.assertEqual(3, limiter.get_stats()['127.0.0.2']['queries'])
+
+    def testTruncatedTypes(self):
+        server = self.hierarchy.server_of('al')
+        server.truncate = True
+        types = [QueryPacket.QU_A, QueryPacket.QU_AAAA, QueryPacket.QU_MX,
+                 QueryPacket.QU_PTR]
+        started = time.monotonic()
+        results = self.resolver.resolve_types('eur.al', types)
+        # truncated AAAA, MX and PTR are asked again together over TCP;
+        # one by one they would take two more round trips
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual([(15, (10, 'mail.eur.al'))],
+                         results[QueryPacket.QU_MX])
+        self.assertEqual(4, server.tcp_received)
+        self.assertEqual(1, len(self.resolver.tcp_connections.connections[
+            server.address, self.hierarchy.port]))
+
+    def testAsyncTypes(self):
+        types = [QueryPacket.QU_A, QueryPacket.QU_MX]
+
+        async def resolve():
+            async with AsyncResolver(self.hierarchy.root,
+                                     self.hierarchy.port,
+                                     waiting=1) as resolver:
+                return [item async for item in resolver.resolve_iter(
+                    ['eur.al', 'nope.al'], ordered=True, query_types=types)]
+        started = time.monotonic()
+        results = asyncio.run(resolve())
+        # names are resolved concurrently, A follows delegations first
+        self.assertLess(time.monotonic() - started, 0.45)
+        self.assertEqual(
+            [('eur.al', {QueryPacket.QU_A: [(1, '31.170.165.34')],
+                         QueryPacket.QU_MX: [(15, (10, 'mail.eur.al'))]}),
+             ('nope.al', {QueryPacket.QU_A: AsyncResolver.NAME_NOT_FOUND,
+                          QueryPacket.QU_MX: AsyncResolver.NAME_NOT_FOUND})],
+            results)
+        self.assertEqual(types, list(results[0][1]))
+
+    def testNoData(self):
+        for _ in range(2):
+            self.assertEqual(
+                {QueryPacket.QU_AAAA: []},
+                self.resolver.resolve_types('eur.al', [QueryPacket.QU_AAAA]))
+        self.assertEqual([], self.resolver.resolve('eur.al',
+                                                   QueryPacket.QU_AAAA))
+        # the second call and resolve are answered from cache
+        self.assertEqual(1, self.hierarchy.server_of('al').received)
+        entry = self.resolver.cache.get('eur.al', QueryPacket.QU_AAAA)
+        self.assertEqual(SOA_MINIMUM, entry.ttl)
+
+    def testNotFoundAndCName(self):
+        self.assertEqual(
+            {QueryPacket.QU_A: Resolver.NAME_NOT_FOUND,
+             QueryPacket.QU_MX: Resolver.NAME_NOT_FOUND},
+            self.resolver.resolve_types('nope.al', [QueryPacket.QU_A,
+                                                    QueryPacket.QU_MX]))
+        self.assertEqual(
+            {QueryPacket.QU_A: [(5, 'eur.al'), (1, '31.170.165.34')]},
+            self.resolver.resolve_types('www.al', [QueryPacket.QU_A]))
+
+
+class TestGluelessDelegation(unittest.TestCase):
+    """
+    Test of zone whose nameservers are in other zones, so referral has
+    no glue; zone of the first nameserver does not answer
+    """
+    def setUp(self):
+        self.hierarchy = FakeHierarchy()
+        self.hierarchy.add_record('eur.al', QueryPacket.QU_A,
+                                  '31.170.165.34')
+        self.hierarchy.add_zone('org')
+        self.hierarchy.add_zone('dead')
+        zone = self.hierarchy.add_zone('urgu.org')
+        zone.add_record('dijkstra.urgu.org', QueryPacket.QU_A,
+                        '212.193.68.250')
+        address = self.hierarchy.server_of('urgu.org').address
+        self.hierarchy.zones['org'].delegate(
+            'urgu.org', [('ns.dead', None), ('ns1.al', None)])
+        self.hierarchy.add_record('ns.dead', QueryPacket.QU_A, address)
+        self.hierarchy.add_record('ns1.al', QueryPacket.QU_A, address)
+        self.hierarchy.server_of('dead').loss = 1.0
+        self.hierarchy.start()
+
+    def tearDown(self):
+        self.hierarchy.stop()
+
+    def testResolver(self):
+        resolver = Resolver(self.hierarchy.root, port=self.hierarchy.port,
+                            waiting=0.5, num_of_retries=2)
+        try:
+            started = time.monotonic()
+            self.assertEqual([(1, '212.193.68.250')],
+                             resolver.resolve('dijkstra.urgu.org'))
+            # silent nameserver is not waited for
+            self.assertLess(time.monotonic() - started, 0.5)
+            # nameserver is found by lookup of resolver and cached
+            self.assertEqual([(1, self.hierarchy.server_of('urgu.org')
+                               .address)],
+                             resolver.cache.get('ns1.al',
+                                                QueryPacket.QU_A).records)
+            self.assertEqual(1, self.hierarchy.server_of('al').received)
+        finally:
+            resolver.close()
+
+    def testAsyncResolver(self):
+        async def check():
+            async with AsyncResolver(self.hierarchy.root,
+                                     self.hierarchy.port, num_of_retries=2,
+                                     waiting=0.5) as resolver:
+                started = time.monotonic()
+                result = await resolver.resolve('dijkstra.urgu.org')
+                return result, time.monotonic() - started
+        result, elapsed = asyncio.run(check())
+        self.assertEqual([(1, '212.193.68.250')], result)
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(1, self.hierarchy.server_of('al').received)
+
+
+class TestMakeHierarchy(unittest.TestCase):
+    """
+    Test of generated hierarchy used by benchmark
+    """
+    def testResolveAll(self):
+        hierarchy, names = make_hierarchy(100, domains=10)
+        with hierarchy:
+            with Resolver(hierarchy.root, port=hierarchy.port, waiting=1,
+                          cache=ResolverCache(0)) as resolver:
+                for i, name in enumerate(names):
+                    self.assertEqual([(1, '0.0.0.{}'.format(i))],
+                                     resolver.resolve(name))
+            # root is asked once per TLD thanks to zone cuts
+            self.assertEqual(4, hierarchy.servers['127.0.0.1'].received)
+
+    def testSharedByThreads(self):
+        hierarchy, names = make_hierarchy(250, domains=10, latency=0.01)
+        with hierarchy:
+            with Resolver(hierarchy.root, port=hierarchy.port,
+                          waiting=1) as resolver:
+                started = time.monotonic()
+                results = resolver.resolve_many(names + names[:50],
+                                                threads=16)
+                elapsed = time.monotonic() - started
+                self.assertEqual(0, len(resolver.identifiers))
+        self.assertEqual([[(1, '0.0.0.{}'.format(i))] for i in range(250)]
+                         + results[:50], results)
+        # one thread would need at least 250 * 0.01 seconds
+        self.assertLess(elapsed, 1.5)
+
+    def testThreadsAreReused(self):
+        hierarchy, names = make_hierarchy(50, domains=5)
+        with hierarchy:
+            with Resolver(hierarchy.root, port=hierarchy.port, waiting=1,
+                          cache=ResolverCache(0)) as resolver:
+                for _ in range(5):
+                    resolver.resolve_many(names, threads=4)
+                # every thread keeps at most one socket per server
+                self.assertLessEqual(len(resolver.sockets),
+                                     4 * len(hierarchy.servers))
+                self.assertLessEqual(len({key[2] for key
+                                          in resolver.sockets.sockets}), 4)
+                # sockets of threads of the previous pool are closed
+                resolver.resolve_many(names, threads=2)
+                alive = {thread.ident for thread in threading.enumerate()}
+                self.assertTrue(all(key[2] in alive
+                                    for key in resolver.sockets.sockets))
+            self.assertEqual(0, len(resolver.sockets))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+Unit test for "instrument" module
+"""
+__author__ = 'Skipper'
+from asyncresolver import AsyncResolver
+from contextlib import redirect_stdout
+from debugmode import Debugger
+from fakedns import FakeHierarchy
+from instrument import Instrumentation, JsonLinesSink, MemorySink,\
+    MetricsSink
+from packet import QueryPacket
+from resolver import Resolver
+from stubserver import StubServer
+import asyncio
+import io
+import json
+import unittest
+
+
+class TestInstrumentation(unittest.TestCase):
+    """
+    Test class for Instrumentation and its sinks
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.hierarchy = FakeHierarchy()
+        cls.hierarchy.add_record('eur.al', QueryPacket.QU_A, '31.170.165.34')
+        cls.hierarchy.add_zone('paris')
+        cls.hierarchy.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.hierarchy.stop()
+
+    def resolve(self, instrument, *names, **kwargs):
+        with Resolver(self.hierarchy.root, port=self.hierarchy.port,
+                      waiting=1, instrument=instrument, **kwargs) as resolver:
+            return [resolver.resolve(name) for name in names]
+
+    def testMetrics(self):
+        metrics = MetricsSink()
+        self.resolve(Instrumentation([metrics]), 'eur.al', 'eur.al',
+                     'nope.paris')
+        self.assertEqual({'lookups': 3, 'cache_hits': 1, 'queries': 4,
+                          'retries': 0, 'tcp_queries': 0, 'replies': 4,
+                          'timeouts': 0, 'no_responses': 0, 'truncated': 0,
+                          'nxdomain': 1, 'failures': 0}, metrics.counters)
+        self.assertEqual(2, sum(metrics.histograms['127.0.0.1']))
+        self.assertLessEqual(metrics.percentile('127.0.0.1', 0.99), 5)
+        self.assertIsNone(metrics.percentile('10.0.0.1', 0.5))
+
+    def testTrace(self):
+        memory = MemorySink()
+        self.resolve(Instrumentation([memory]), 'eur.al', 'nope.paris')
+        first, second = memory.traces
+        self.assertEqual('answer', first['result'])
+        self.assertEqual([('127.0.0.1', 'referral'), ('127.0.0.2', 'answer')],
+                         [(hop['server'], hop['outcome'])
+                          for hop in first['hops']])
+        self.assertTrue(all(hop['rtt'] <= first['elapsed']
+                            for hop in first['hops']))
+        self.assertEqual('nxdomain', second['result'])
+        self.assertEqual('nxdomain', second['hops'][-1]['outcome'])
+        self.assertEqual('lookup_started', memory.events[0][0])
+
+    def testJsonLines(self):
+        stream = io.StringIO()
+        self.resolve(Instrumentation([JsonLinesSink(stream)]), 'eur.al')
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(['lookup_started', 'send', 'receive', 'send',
+                          'receive', 'lookup'],
+                         [event['event'] for event in events])
+        self.assertEqual(2, len(events[-1]['hops']))
+
+    def testDebuggerIsSink(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.resolve(None, 'eur.al', debug_mode=True)
+        self.assertIn('Response received from 127.0.0.2', output.getvalue())
+        self.assertIn('Hexdump:', output.getvalue())
+
+    def testWithoutSinks(self):
+        instrument = Instrumentation()
+        self.assertEqual([[(1, '31.170.165.34')]],
+                         self.resolve(instrument, 'eur.al'))
+        self.assertIsNone(instrument._trace_.get())
+
+    def testAsyncResolver(self):
+        memory = MemorySink()
+        metrics = MetricsSink()
+        instrument = Instrumentation([memory, metrics])
+
+        async def resolve():
+            async with AsyncResolver(self.hierarchy.root,
+                                     self.hierarchy.port, waiting=1,
+                                     instrument=instrument) as resolver:
+                await asyncio.gather(resolver.resolve('eur.al'),
+                                     resolver.resolve('nope.paris'))
+                query = QueryPacket(1)
+                query.add_question('eur.al', QueryPacket.QU_A)
+                return StubServer(resolver).answer_cached(query)
+        self.assertIsNotNone(asyncio.run(resolve()))
+        # concurrent lookups build their own traces
+        traces = {trace['name']: trace for trace in memory.traces}
+        self.assertEqual([('127.0.0.1', 'referral'), ('127.0.0.2', 'answer')],
+                         [(hop['server'], hop['outcome'])
+                          for hop in traces['eur.al']['hops']])
+        self.assertEqual([('127.0.0.1', 'referral'),
+                          (self.hierarchy.server_of('paris').address,
+                           'nxdomain')],
+                         [(hop['server'], hop['outcome'])
+                          for hop in traces['nope.paris']['hops']])
+        self.assertEqual('nxdomain', traces['nope.paris']['result'])
+        self.assertEqual((2, 1, 4, 1),
+                         tuple(metrics.counters[counter] for counter in (
+                             'lookups', 'cache_hits', 'queries',
+                             'nxdomain')))
+
+    def testHexdump(self):
+        output = io.StringIO()
+        packet = type('Packet', (), {'raw_packet': bytes(range(18))})
+        with redirect_stdout(output):
+            Debugger(True)._print_hexdump_(packet)
+        self.assertEqual('\t\tHexdump:\n'
+                         '\t\t\t00010203 04050607 08090a0b 0c0d0e0f\n'
+                         '\t\t\t1011\n', output.getvalue())
+
+if __name__ == "__main__":
+    unittest.main()
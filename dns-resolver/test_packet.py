@@ -0,0 +1,162 @@
+"""
+Unit test for "packet" module
+"""
+__author__ = 'Skipper'
+from bench_packet import make_response
+from packet import QueryPacket, ReceivedPacket, encode_question
+import struct
+import unittest
+
+
+class TestQueryPacket(unittest.TestCase):
+    """
+    Test class for QueryPacket
+    """
+    def testGetPacket(self):
+        packet = QueryPacket(258)
+        packet.add_question('eur.al.', QueryPacket.QU_AAAA)
+        self.assertEqual(b'\x01\x02\x01\x00\x00\x01\x00\x00\x00\x00'
+                         b'\x00\x00\x03eur\x02al\x00\x00\x1c\x00\x01',
+                         packet.get_packet())
+        packet.increment_id()
+        self.assertEqual(b'\x01\x03', packet.get_packet()[0:2])
+
+    def testEdns(self):
+        packet = QueryPacket(1)
+        packet.add_question('eur.al', QueryPacket.QU_A)
+        packet.set_edns(1232, dnssec_ok=True)
+        raw_packet = packet.get_packet()
+        self.assertEqual(b'\x00\x01', raw_packet[10:12])
+        self.assertEqual(b'\x00\x00\x29\x04\xd0\x00\x00\x80\x00\x00\x00',
+                         raw_packet[-11:])
+        reply = bytearray(raw_packet)
+        reply[2] |= 0x80
+        received = ReceivedPacket(reply)
+        self.assertEqual(1232, received.edns_payload)
+        self.assertEqual(0, received.edns_version)
+        self.assertEqual(1, received.dnssec_ok)
+        packet.set_edns(100)
+        self.assertEqual(512, packet.edns_payload)
+
+    def testQuestionCache(self):
+        encode_question.cache_clear()
+        for identifier in range(10):
+            packet = QueryPacket(identifier)
+            packet.add_question('eur.al', QueryPacket.QU_A)
+            packet.get_packet()
+        self.assertEqual(1, encode_question.cache_info().misses)
+        self.assertEqual(9, encode_question.cache_info().hits)
+
+
+class TestReceivedPacket(unittest.TestCase):
+    """
+    Test class for ReceivedPacket
+    """
+    def setUp(self):
+        self.packet = ReceivedPacket(make_response(512))
+
+    def testHeader(self):
+        self.assertEqual(1, self.packet.identifier)
+        self.assertEqual(1, self.packet.ra)
+        self.assertEqual(0, self.packet.tc)
+        self.assertEqual('example.com.', self.packet.queries[0].query_name)
+        self.assertEqual(QueryPacket.QU_A, self.packet.queries[0].query_type)
+
+    def testRecords(self):
+        a_record, aaaa_record = self.packet.answers[0:2]
+        self.assertEqual('example.com', a_record.name)
+        self.assertEqual(300, a_record.ttl)
+        self.assertEqual('192.0.2.0', a_record.get_data())
+        self.assertEqual('0001:0203:0405:0607:0809:0a0b:0c0d:0e0f',
+                         aaaa_record.get_data())
+        ns_record = self.packet.authoritative_nameservers[0]
+        self.assertEqual('com', ns_record.name)
+        self.assertEqual('ns1.com', ns_record.get_data())
+
+    def testLazyData(self):
+        record = self.packet.answers[0]
+        self.assertFalse(record._decoded_)
+        record.get_data()
+        self.assertTrue(record._decoded_)
+
+    def testCompactRecord(self):
+        record = self.packet.authoritative_nameservers[0]
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertIs(self.packet, record.packet)
+        record.get_data()
+        # decoded record keeps neither packet nor view of its bytes
+        self.assertIsNone(record.packet)
+        self.assertIsInstance(record.raw_data, bytes)
+        other = ReceivedPacket(make_response(512)).authoritative_nameservers
+        self.assertIs(record.name, other[1].name)
+        self.assertIs(record.get_data(), other[0].get_data())
+
+    def testMX(self):
+        raw_packet = bytearray(make_response(40)[:29])
+        raw_packet[7] = 1
+        data = struct.pack('!H', 10) + b'\x02mx\xc0\x0c'
+        raw_packet.extend(b'\xc0\x0c' + struct.pack('!HHIH', 15, 1, 60,
+                                                   len(data)) + data)
+        record = ReceivedPacket(raw_packet).answers[0]
+        self.assertEqual((10, 'mx.example.com'), record.get_data())
+
+    def testSharedSuffix(self):
+        for record in self.packet.authoritative_nameservers:
+            record.get_data()
+        # owner name of every NS record is the same pointer to "com"
+        self.assertEqual(('com', 5), self.packet._names_[20])
+        self.assertEqual(('ns1.com', 6),
+                         self.packet.get_string(
+                             self.packet.authoritative_nameservers[0]
+                             .data_offset))
+
+    def testCompressionLoop(self):
+        raw_packet = bytearray(make_response(40)[:29])
+        raw_packet[7] = 1
+        raw_packet.extend(b'\xc0\x1d' + struct.pack('!HHIH', 1, 1, 60, 4)
+                          + bytes(4))
+        with self.assertRaises(Exception):
+            ReceivedPacket(raw_packet)
+
+    def testTooLongCompressedName(self):
+        def make_chain(count):
+            # owner of every record is label and pointer to owner of
+            # previous one, so suffixes are taken from decoded names
+            raw_packet = bytearray(struct.pack('!HBBHHHH', 1, 0x81, 0x80,
+                                               1, count, 0, 0))
+            raw_packet.extend(b'\x01a\x00' + struct.pack('!HH', 1, 1))
+            previous = 12
+            for _ in range(count):
+                offset = len(raw_packet)
+                raw_packet.extend(b'\x3f' + b'x' * 63
+                                  + struct.pack('!H', 0xc000 | previous)
+                                  + struct.pack('!HHIH', 1, 1, 60, 4)
+                                  + bytes(4))
+                previous = offset
+            return bytes(raw_packet)
+        # 3 labels of 63 bytes and "a" take 195 bytes, 4 take 259
+        self.assertEqual(3 * 64 + 1,
+                         len(ReceivedPacket(make_chain(3)).answers[-1].name))
+        with self.assertRaises(Exception):
+            ReceivedPacket(make_chain(4))
+        with self.assertRaises(Exception):
+            ReceivedPacket(make_chain(9))
+
+    def testUncompressedName(self):
+        raw_packet = bytearray(make_response(40)[:29])
+        raw_packet[7] = 1
+        raw_packet.extend(b'\x02ns\x02ru\x00' + struct.pack('!HHIH', 1, 1,
+                                                              60, 4)
+                          + bytes((1, 2, 3, 4)))
+        record = ReceivedPacket(raw_packet).answers[0]
+        self.assertEqual('ns.ru', record.name)
+        self.assertEqual('1.2.3.4', record.get_data())
+
+    def testNotFound(self):
+        raw_packet = bytearray(make_response(40))
+        raw_packet[3] = 0x83
+        with self.assertRaises(ReceivedPacket.NotFoundException):
+            ReceivedPacket(raw_packet)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+"""
+Unit test for "prefetch" module
+"""
+__author__ = 'Skipper'
+from asyncresolver import AsyncResolver
+from cache import ResolverCache
+from fakedns import FakeHierarchy
+from packet import QueryPacket
+from prefetch import AsyncPrefetcher, Prefetcher
+from resolver import Resolver
+from stubserver import StubServer
+from test_cache import FakeClock
+import asyncio
+import time
+import unittest
+
+
+class TestPrefetcher(unittest.TestCase):
+    """
+    Test class for Prefetcher
+    """
+    def setUp(self):
+        self.hierarchy = FakeHierarchy(latency=0.1)
+        self.hierarchy.add_record('eur.al', QueryPacket.QU_A, '31.170.165.34')
+        self.hierarchy.add_record('cold.al', QueryPacket.QU_A, '10.0.0.1')
+        self.hierarchy.start()
+        self.clock = FakeClock()
+        self.prefetcher = Prefetcher(workers=2, min_hits=3)
+        self.resolver = Resolver(self.hierarchy.root,
+                                 port=self.hierarchy.port, waiting=1,
+                                 cache=ResolverCache(clock=self.clock),
+                                 prefetcher=self.prefetcher)
+
+    def tearDown(self):
+        self.prefetcher.close()
+        self.resolver.close()
+        self.hierarchy.stop()
+
+    def testHotEntryIsRefreshed(self):
+        server = self.hierarchy.server_of('al')
+        for _ in range(4):
+            self.resolver.resolve('eur.al')
+        self.resolver.resolve('cold.al')
+        self.assertEqual(2, server.received)
+        self.clock.now = 271
+        started = time.monotonic()
+        self.assertEqual([(1, '31.170.165.34')],
+                         self.resolver.resolve('eur.al'))
+        self.assertEqual([(1, '10.0.0.1')], self.resolver.resolve('cold.al'))
+        self.assertLess(time.monotonic() - started, 0.1)
+        # the second hit while refresh is running does not start another
+        self.resolver.resolve('eur.al')
+        self.prefetcher.close()
+        self.assertEqual(3, server.received)
+        self.assertEqual({'scheduled': 1, 'refreshed': 1, 'failed': 0,
+                          'dropped': 0, 'pending': 0},
+                         self.prefetcher.get_stats())
+        entry = self.resolver.cache.get('eur.al', QueryPacket.QU_A)
+        self.assertEqual(571, entry.expires)
+        self.clock.now = 310
+        self.assertIsNone(self.resolver.cache.get('cold.al', QueryPacket.QU_A))
+        self.assertEqual([(1, '31.170.165.34')],
+                         self.resolver.resolve('eur.al'))
+        self.assertEqual(3, server.received)
+
+    def testIsDue(self):
+        cache = ResolverCache(clock=self.clock)
+        cache.put('eur.al', 1, [(1, '31.170.165.34')], 100)
+        cache.put_negative('nope.al', 1)
+        for _ in range(3):
+            entry = cache.get('eur.al', 1)
+            negative = cache.get('nope.al', 1)
+        self.assertFalse(self.prefetcher.is_due(entry, 89))
+        self.assertTrue(self.prefetcher.is_due(entry, 90))
+        self.assertFalse(self.prefetcher.is_due(negative, 59))
+
+
+class TestAsyncPrefetcher(unittest.TestCase):
+    """
+    Test class for AsyncPrefetcher with AsyncResolver and StubServer
+    """
+    def setUp(self):
+        self.hierarchy = FakeHierarchy(latency=0.1)
+        self.hierarchy.add_record('eur.al', QueryPacket.QU_A, '31.170.165.34')
+        self.hierarchy.start()
+        self.clock = FakeClock()
+        self.prefetcher = AsyncPrefetcher(workers=2, min_hits=3)
+        self.resolver = AsyncResolver(self.hierarchy.root,
+                                      self.hierarchy.port, waiting=1,
+                                      cache=ResolverCache(clock=self.clock),
+                                      prefetcher=self.prefetcher)
+
+    def tearDown(self):
+        self.hierarchy.stop()
+
+    def testHotEntryIsRefreshed(self):
+        async def resolve():
+            async with self.resolver:
+                for _ in range(4):
+                    await self.resolver.resolve('eur.al')
+                self.clock.now = 271
+                started = time.monotonic()
+                result = await self.resolver.resolve('eur.al')
+                elapsed = time.monotonic() - started
+                await self.resolver.resolve('eur.al')
+                await self.prefetcher.close()
+                return result, elapsed
+        result, elapsed = asyncio.run(resolve())
+        self.assertEqual([(1, '31.170.165.34')], result)
+        self.assertLess(elapsed, 0.1)
+        self.assertEqual(2, self.hierarchy.server_of('al').received)
+        self.assertEqual({'scheduled': 1, 'refreshed': 1, 'failed': 0,
+                          'dropped': 0, 'pending': 0},
+                         self.prefetcher.get_stats())
+        entry = self.resolver.cache.get('eur.al', QueryPacket.QU_A)
+        self.assertEqual(571, entry.expires)
+
+    def testStubServer(self):
+        query = QueryPacket(1)
+        query.add_question('eur.al', QueryPacket.QU_A)
+        raw_query = query.get_packet()
+
+        async def serve():
+            async with self.resolver:
+                server = StubServer(self.resolver)
+                await self.resolver.resolve('eur.al')
+                for _ in range(3):
+                    server.answer_cached(query)
+                self.clock.now = 269
+                replies = [server.wire_cache.get(raw_query)]
+                # wire cache stops answering when entry may be refreshed
+                self.clock.now = 271
+                replies.append(server.wire_cache.get(raw_query))
+                replies.append(server.answer_cached(query))
+                await self.prefetcher.close()
+                return replies
+        wire_hit, wire_miss, reply = asyncio.run(serve())
+        self.assertIsNotNone(wire_hit)
+        self.assertIsNone(wire_miss)
+        self.assertIsNotNone(reply)
+        self.assertEqual(2, self.hierarchy.server_of('al').received)
+        entry = self.resolver.cache.get('eur.al', QueryPacket.QU_A)
+        self.assertEqual(571, entry.expires)
+
+if __name__ == "__main__":
+    unittest.main()
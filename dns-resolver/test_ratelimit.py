@@ -0,0 +1,112 @@
+"""
+Unit test for "ratelimit" module
+"""
+__author__ = 'Skipper'
+from asyncresolver import AsyncResolver
+from fakedns import FakeHierarchy
+from packet import QueryPacket
+from ratelimit import AsyncRateLimiter, RateLimiter, TokenBucket
+from test_cache import FakeClock
+import asyncio
+import unittest
+
+
+class TestRateLimiter(unittest.TestCase):
+    """
+    Test class for TokenBucket, RateLimiter and AsyncRateLimiter
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def sleep(self, delay):
+        self.clock.now += delay
+
+    def testTokenBucket(self):
+        bucket = TokenBucket(10, 2, clock=self.clock)
+        self.assertEqual([0, 0], [bucket.reserve(), bucket.reserve()])
+        self.assertAlmostEqual(0.1, bucket.reserve())
+        self.assertAlmostEqual(0.2, bucket.reserve())
+        self.clock.now = 1
+        self.assertEqual(0, bucket.reserve())
+
+    def testRate(self):
+        limiter = RateLimiter(qps=10, burst=2, clock=self.clock,
+                              sleep=self.sleep)
+        limiter.set_limit('fast', qps=1000)
+        for _ in range(5):
+            with limiter.slot('slow'):
+                pass
+            with limiter.slot('fast'):
+                pass
+        self.assertAlmostEqual(0.3, self.clock.now)
+        stats = limiter.get_stats()
+        self.assertEqual(5, stats['slow']['queries'])
+        self.assertEqual(3, stats['slow']['throttled'])
+        self.assertAlmostEqual(0.3, stats['slow']['throttle_time'])
+        self.assertEqual(0, stats['fast']['throttled'])
+
+    def testNonBlockingSlot(self):
+        limiter = RateLimiter(max_in_flight=1)
+        with limiter.slot('server') as first:
+            with limiter.slot('server', blocking=False) as second:
+                self.assertEqual((True, False), (first, second))
+        with limiter.slot('server', blocking=False) as third:
+            self.assertTrue(third)
+        self.assertEqual(2, limiter.get_stats()['server']['queries'])
+
+    def testWindow(self):
+        limiter = AsyncRateLimiter(max_in_flight=2)
+        in_flight = []
+        seen = []
+
+        async def query():
+            async with limiter.slot('server'):
+                in_flight.append(None)
+                seen.append(len(in_flight))
+                await asyncio.sleep(0.01)
+                in_flight.pop()
+
+        async def run():
+            await asyncio.gather(*(query() for _ in range(5)))
+        asyncio.run(run())
+        self.assertEqual(2, max(seen))
+        self.assertEqual({'queries': 5, 'throttled': 3, 'queued': 0,
+                          'max_queued': 3},
+                         {key: value for key, value
+                          in limiter.get_stats()['server'].items()
+                          if key != 'throttle_time'})
+
+    def testBulkResolution(self):
+        # names of root zone, so every query goes to root server
+        hierarchy = FakeHierarchy()
+        names = ['host{}'.format(i) for i in range(40)]
+        for i, name in enumerate(names):
+            hierarchy.add_record(name, QueryPacket.QU_A, '10.0.0.{}'.format(i))
+
+        async def sleep(delay):
+            self.clock.now += delay
+            await asyncio.sleep(0)
+
+        async def resolve(limiter):
+            async with AsyncResolver(hierarchy.root, hierarchy.port, 4, 1,
+                                     limiter=limiter) as resolver:
+                return await resolver.resolve_many(names)
+        with hierarchy:
+            free = AsyncRateLimiter(clock=self.clock, sleep=sleep)
+            asyncio.run(resolve(free))
+            limiter = AsyncRateLimiter(qps=50, burst=1, clock=self.clock,
+                                       sleep=sleep)
+            results = asyncio.run(resolve(limiter))
+        self.assertEqual([[(1, '10.0.0.{}'.format(i))] for i in range(40)],
+                         results)
+        self.assertEqual({'queries': 40, 'throttled': 0},
+                         {key: free.get_stats()['127.0.0.1'][key]
+                          for key in ('queries', 'throttled')})
+        # queries are sent one by one with 1 / qps seconds between them
+        stats = limiter.get_stats()['127.0.0.1']
+        self.assertEqual((40, 39, 0), (stats['queries'], stats['throttled'],
+                                       stats['queued']))
+        self.assertAlmostEqual(39 / 50, self.clock.now)
+
+if __name__ == "__main__":
+    unittest.main()
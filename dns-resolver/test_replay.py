@@ -0,0 +1,81 @@
+"""
+Unit test for "replay" module
+"""
+__author__ = 'Skipper'
+from fakedns import FakeHierarchy
+from packet import QueryPacket
+from replay import KIND_UDP, TrafficRecorder, TrafficReplay, read_records
+from resolver import Resolver
+import os
+import tempfile
+import time
+import unittest
+
+
+class TestReplay(unittest.TestCase):
+    """
+    Test class for TrafficRecorder and TrafficReplay
+    """
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testReadRecords(self):
+        with TrafficRecorder(self.path) as recorder:
+            recorder.record('127.0.0.1', KIND_UDP, b'\x00\x01query',
+                            b'\x00\x01reply', 0.25)
+        self.assertEqual(
+            [('127.0.0.1', KIND_UDP, b'\x00\x01query', b'\x00\x01reply', 0.25)],
+            list(read_records(self.path)))
+        replay = TrafficReplay(self.path)
+        self.assertEqual((b'\x00\x07reply', 0.25),
+                         replay.find('127.0.0.1', KIND_UDP, b'\x00\x07QUERY'))
+        self.assertIsNone(replay.find('127.0.0.2', KIND_UDP, b'\x00\x01query'))
+        self.assertEqual({'exchanges': 1, 'hits': 1, 'misses': 1},
+                         replay.get_stats())
+
+    def testRecordAndReplay(self):
+        names = ['eur.al', 'anytask.urgu.org', 'opsidjgsdkjf.urgu.org']
+        hierarchy = FakeHierarchy(latency=0.05)
+        hierarchy.add_record('eur.al', QueryPacket.QU_A, '31.170.165.34')
+        hierarchy.add_record('anytask.urgu.org', QueryPacket.QU_CNAME,
+                             'dijkstra.urgu.org')
+        hierarchy.add_record('dijkstra.urgu.org', QueryPacket.QU_A,
+                             '212.193.68.250')
+        hierarchy.server_of('al').truncate = True
+        with hierarchy:
+            with TrafficRecorder(self.path) as recorder:
+                with Resolver(hierarchy.root, port=hierarchy.port, waiting=1,
+                              recorder=recorder) as resolver:
+                    recorded = [resolver.resolve(name) for name in names]
+        self.assertEqual([(1, '31.170.165.34')], recorded[0])
+        self.assertEqual(Resolver.NAME_NOT_FOUND, recorded[2])
+
+        replay = TrafficReplay(self.path, timings=False)
+        started = time.monotonic()
+        with Resolver(hierarchy.root, port=hierarchy.port, waiting=1,
+                      replay=replay) as resolver:
+            self.assertEqual(recorded,
+                             [resolver.resolve(name) for name in names])
+        self.assertLess(time.monotonic() - started, 0.2)
+        self.assertEqual(0, replay.misses)
+
+        replay = TrafficReplay(self.path)
+        started = time.monotonic()
+        with Resolver(hierarchy.root, port=hierarchy.port, waiting=1,
+                      replay=replay) as resolver:
+            self.assertEqual(recorded[0], resolver.resolve(names[0]))
+        # root, al over UDP and al over TCP
+        self.assertGreater(time.monotonic() - started, 0.15)
+
+    def testNotRecorded(self):
+        TrafficRecorder(self.path).close()
+        with Resolver('127.0.0.1', waiting=1,
+                      replay=TrafficReplay(self.path)) as resolver:
+            self.assertEqual(Resolver.NO_RESPONSE, resolver.resolve('eur.al'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,7 +2,14 @@
 Unit test for "resolver" module
 """
 __author__ = 'Skipper'
-from resolver import Resolver
+from cache import ResolverCache
+from resolver import NoResponseException, Resolver
+from test_asyncresolver import make_reply
+from test_transport import ThreadedServer
+from packet import QueryPacket
+import socket
+import struct
+import time
 import unittest
 
 
@@ -41,5 +48,86 @@ class TestResolver(unittest.TestCase):
         test_a_record = self.resolver.resolve('eur.al')
         self.assertEqual(reference_a_record, test_a_record)
 
+
+class TestRacing(unittest.TestCase):
+    """
+    Test of racing delegated servers, works without internet
+    """
+    def setUp(self):
+        self.server = ThreadedServer('127.0.0.1')
+        self.server.start()
+        # silent server listens on the same port and never answers
+        self.silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.silent.bind(('127.0.0.2', self.server.port))
+        self.resolver = Resolver('127.0.0.1', port=self.server.port,
+                                 waiting=2, cache=ResolverCache(0),
+                                 race_width=2, race_stagger=0.05)
+        packet = QueryPacket(1)
+        packet.add_question('eur.al', QueryPacket.QU_A)
+        self.packet = packet.get_packet()
+
+    def tearDown(self):
+        self.resolver.close()
+        self.server.stop()
+        self.silent.close()
+
+    def testDeadServerIsSkipped(self):
+        started = time.monotonic()
+        received = self.resolver._race_packet_(self.packet,
+                                               ['127.0.0.2', '127.0.0.1'])
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual('10.0.0.1', received.answers[0].get_data())
+
+    def testAllSilent(self):
+        self.resolver.timeout = 0.1
+        self.resolver.num_of_retries = 2
+        self.server.stop()
+        with self.assertRaises(NoResponseException):
+            self.resolver._race_packet_(self.packet,
+                                        ['127.0.0.2', '127.0.0.1'])
+
+def make_referral(query, zone, glue):
+    """
+    The function refers query to nameserver ns.<zone> with glue address
+    """
+    reply = bytearray(query)
+    reply[2] |= 0x80
+    reply[8:12] = (0, 1, 0, 1)
+    labels = b''.join(bytes((len(label),)) + label.encode()
+                      for label in zone.split('.')) + b'\x00'
+    ns_name = b'\x02ns' + labels
+    reply.extend(labels + struct.pack('!HHIH', 2, 1, 3600, len(ns_name))
+                 + ns_name)
+    reply.extend(ns_name + struct.pack('!HHIH', 1, 1, 3600, 4) + glue)
+    return bytes(reply)
+
+
+class TestDelegationCache(unittest.TestCase):
+    """
+    Test of zone cut cache, works without internet
+    """
+    def setUp(self):
+        self.root = ThreadedServer('127.0.0.1', handler=lambda data: [
+            make_referral(data, 'al', bytes((127, 0, 0, 2)))])
+        self.root.start()
+        self.authoritative = ThreadedServer(
+            '127.0.0.2', self.root.port,
+            handler=lambda data: [make_reply(data, (10, 0, 0, 1))])
+        self.authoritative.start()
+        self.resolver = Resolver('127.0.0.1', port=self.root.port, waiting=1)
+
+    def tearDown(self):
+        self.resolver.close()
+        self.root.stop()
+        self.authoritative.stop()
+
+    def testStartsFromClosestZone(self):
+        self.assertEqual([(1, '10.0.0.1')], self.resolver.resolve('eur.al'))
+        self.assertEqual([(1, '10.0.0.1')], self.resolver.resolve('www.al'))
+        self.assertEqual(1, self.root.received)
+        self.assertEqual(2, self.authoritative.received)
+        self.assertEqual(['127.0.0.2'],
+                         self.resolver.delegations.get('al', 2).records)
+
 if __name__ == "__main__":
     unittest.main()
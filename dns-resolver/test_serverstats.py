@@ -0,0 +1,48 @@
+"""
+Unit test for "serverstats" module
+"""
+__author__ = 'Skipper'
+from serverstats import ServerStats
+from test_cache import FakeClock
+import unittest
+
+
+class TestServerStats(unittest.TestCase):
+    """
+    Test class for ServerStats
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.stats = ServerStats(initial_timeout=1, min_timeout=0.2,
+                                 penalty_threshold=2, penalty_time=30,
+                                 clock=self.clock)
+
+    def testUnknownServer(self):
+        self.assertEqual(1, self.stats.timeout('a', 0, 5))
+        self.assertEqual(4, self.stats.timeout('a', 2, 5))
+        self.assertEqual(5, self.stats.timeout('a', 3, 5))
+
+    def testAdaptiveTimeout(self):
+        for _ in range(20):
+            self.stats.add_rtt('a', 0.1)
+        self.assertAlmostEqual(0.1, self.stats.servers['a'].srtt, places=2)
+        self.assertEqual(0.2, self.stats.timeout('a', 0, 5))
+        self.stats.add_rtt('b', 0.5)
+        self.assertAlmostEqual(1.5, self.stats.timeout('b', 0, 5))
+
+    def testPenaltyAndOrder(self):
+        self.stats.add_rtt('slow', 0.5)
+        self.stats.add_rtt('fast', 0.01)
+        self.stats.add_timeout('fast')
+        self.assertFalse(self.stats.is_penalized('fast'))
+        self.stats.add_timeout('fast')
+        self.assertTrue(self.stats.is_penalized('fast'))
+        self.assertEqual(['new', 'slow', 'fast'],
+                         self.stats.order(['fast', 'slow', 'new']))
+        self.clock.now = 30
+        self.assertFalse(self.stats.is_penalized('fast'))
+        self.assertEqual(['fast', 'slow'],
+                         self.stats.order(['slow', 'fast']))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Unit test for "sharedcache" module
+"""
+__author__ = 'Skipper'
+from sharedcache import SharedCache
+from test_cache import FakeClock
+import multiprocessing
+import unittest
+
+
+def fill(cache):
+    """
+    The function stores entries in worker process
+    """
+    cache.put('eur.al', 15, [(15, (10, 'mail.eur.al'))], 100)
+    cache.put_negative('nope.al', 1)
+
+
+class TestSharedCache(unittest.TestCase):
+    """
+    Test class for SharedCache
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_cache(self, **kwargs):
+        cache = SharedCache(clock=self.clock, negative_ttl=10, **kwargs)
+        self.addCleanup(cache.unlink)
+        return cache
+
+    def testSharedBetweenProcesses(self):
+        cache = self.make_cache(slots=64)
+        worker = multiprocessing.get_context('fork').Process(
+            target=fill, args=(cache,))
+        worker.start()
+        worker.join()
+        self.assertEqual(0, len(cache))
+        entry = cache.get('EUR.al.', 15)
+        self.assertEqual([(15, (10, 'mail.eur.al'))], entry.records)
+        self.assertEqual((100, 100), (entry.expires, entry.ttl))
+        self.assertTrue(cache.get('nope.al', 1).negative)
+        self.assertIsNone(cache.get('eur.al', 1))
+        self.assertEqual(2, cache.get_stats()['shared_hits'])
+        self.clock.now = 10
+        cache.entries.clear()
+        self.assertIsNone(cache.get('nope.al', 1))
+
+    def testBucketEviction(self):
+        cache = self.make_cache(slots=4)
+        for i in range(5):
+            cache.put('host{}.al'.format(i), 1, [(1, '10.0.0.{}'.format(i))],
+                      100 - i)
+        cache.put('host1.al', 1, [(1, '10.0.0.10')], 100)
+        cache.entries.clear()
+        # host3.al would expire first of the full bucket
+        self.assertIsNone(cache.get('host3.al', 1))
+        self.assertEqual([(1, '10.0.0.10')], cache.get('host1.al', 1).records)
+        self.assertEqual([(1, '10.0.0.4')], cache.get('host4.al', 1).records)
+        self.assertEqual(1, cache.get_stats()['evictions'])
+        cache.clear()
+        self.assertIsNone(cache.get('host0.al', 1))
+
+    def testOversized(self):
+        cache = self.make_cache(slots=4, slot_size=64)
+        records = [(1, '10.0.0.{}'.format(i)) for i in range(10)]
+        cache.put('big.al', 1, records, 100)
+        self.assertEqual(records, cache.get('big.al', 1).records)
+        cache.entries.clear()
+        self.assertIsNone(cache.get('big.al', 1))
+        self.assertEqual(1, cache.get_stats()['oversized'])
+        self.assertRaises(Exception, SharedCache, slot_size=16)
+
+if __name__ == "__main__":
+    unittest.main()
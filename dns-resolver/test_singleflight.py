@@ -0,0 +1,112 @@
+"""
+Unit test for "singleflight" module
+"""
+__author__ = 'Skipper'
+from asyncresolver import AsyncResolver
+from fakedns import FakeHierarchy
+from packet import QueryPacket
+from resolver import Resolver
+from singleflight import AsyncSingleFlight, SingleFlight
+import asyncio
+import threading
+import time
+import unittest
+
+
+class TestSingleFlight(unittest.TestCase):
+    """
+    Test class for SingleFlight, AsyncSingleFlight and resolvers using them
+    """
+    def setUp(self):
+        self.calls = 0
+
+    def slow(self, value):
+        self.calls += 1
+        time.sleep(0.1)
+        if value is None:
+            raise Exception('Lookup failed')
+        return [value]
+
+    def run_threads(self, flights, key, value):
+        results = []
+
+        def call():
+            try:
+                results.append(flights.do(key, self.slow, value))
+            except Exception as error:
+                results.append(error)
+        threads = [threading.Thread(target=call) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def testThreads(self):
+        flights = SingleFlight()
+        results = self.run_threads(flights, 'eur.al', 1)
+        self.assertEqual(1, self.calls)
+        self.assertEqual([[1]] * 10, results)
+        self.assertTrue(all(result is results[0] for result in results))
+        errors = self.run_threads(flights, 'eur.al', None)
+        self.assertEqual(2, self.calls)
+        self.assertTrue(all(error is errors[0] for error in errors))
+        self.assertEqual({'leaders': 2, 'followers': 18, 'running': 0},
+                         flights.get_stats())
+
+    def testCoroutines(self):
+        flights = AsyncSingleFlight()
+
+        async def slow(value):
+            self.calls += 1
+            await asyncio.sleep(0.05)
+            return [value]
+
+        async def run():
+            first = asyncio.ensure_future(flights.do('eur.al', slow, 1))
+            await asyncio.sleep(0)
+            # cancelled first caller does not cancel the others
+            first.cancel()
+            results = await asyncio.gather(
+                *(flights.do('eur.al', slow, 1) for _ in range(5)),
+                flights.do('paris', slow, 2))
+            return results
+        results = asyncio.run(run())
+        self.assertEqual([[1]] * 5 + [[2]], results)
+        self.assertEqual(2, self.calls)
+        self.assertEqual({'leaders': 2, 'followers': 5, 'running': 0},
+                         flights.get_stats())
+
+    def testResolvers(self):
+        hierarchy = FakeHierarchy(latency=0.05)
+        hierarchy.add_record('eur.al', QueryPacket.QU_A, '31.170.165.34')
+        with hierarchy:
+            server = hierarchy.server_of('al')
+            with Resolver(hierarchy.root, port=hierarchy.port,
+                          waiting=1) as resolver:
+                results = []
+
+                def resolve():
+                    with resolver.spawn() as spawned:
+                        results.append(spawned.resolve('EUR.al'))
+                threads = [threading.Thread(target=resolve)
+                           for _ in range(10)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual([[(1, '31.170.165.34')]] * 10, results)
+            self.assertEqual(1, server.received)
+
+            async def resolve_many():
+                async with AsyncResolver(hierarchy.root, hierarchy.port,
+                                         waiting=1) as resolver:
+                    return await resolver.resolve_many(['eur.al'] * 50
+                                                       + ['nope.al'] * 50)
+            results = asyncio.run(resolve_many())
+            self.assertEqual([[(1, '31.170.165.34')]] * 50
+                             + [Resolver.NAME_NOT_FOUND] * 50, results)
+            self.assertEqual(3, server.received)
+
+if __name__ == "__main__":
+    unittest.main()
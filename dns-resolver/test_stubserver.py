@@ -0,0 +1,164 @@
+"""
+Unit test for "stubserver" module
+"""
+__author__ = 'Skipper'
+from asyncresolver import AsyncResolver
+from cache import ResolverCache
+from fakedns import FakeHierarchy
+from packet import QueryPacket, ReceivedPacket
+from resolver import Resolver
+from sharedcache import SharedCache
+from stubserver import StubServer
+from test_cache import FakeClock
+from transport import LENGTH
+import asyncio
+import socket
+import threading
+import unittest
+
+
+class TestStubServer(unittest.TestCase):
+    """
+    Test class for StubServer, clients are Resolver and plain sockets
+    """
+    def setUp(self):
+        self.hierarchy = FakeHierarchy(latency=0.05)
+        self.hierarchy.add_record('eur.al', QueryPacket.QU_A,
+                                  '31.170.165.34')
+        self.hierarchy.add_record('www.al', QueryPacket.QU_CNAME, 'eur.al')
+        self.hierarchy.start()
+        self.clock = FakeClock()
+        resolver = AsyncResolver(self.hierarchy.root, self.hierarchy.port,
+                                 waiting=1,
+                                 cache=ResolverCache(clock=self.clock))
+        self.server = StubServer(resolver, port=0)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.start(),
+                                         self.loop).result()
+        self.client = Resolver(self.server.address, port=self.server.port,
+                               waiting=1)
+
+    def tearDown(self):
+        self.client.close()
+
+        async def close():
+            self.server.close()
+            await self.server.resolver.close()
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.hierarchy.stop()
+
+    def ask(self, name, identifier, tcp=False, server=None):
+        query = QueryPacket(identifier)
+        query.add_question(name, QueryPacket.QU_A)
+        server = self.server if server is None else server
+        address = (server.address, server.port)
+        if tcp:
+            with socket.create_connection(address, 1) as sock:
+                sock.sendall(LENGTH.pack(len(query.get_packet()))
+                             + query.get_packet())
+                length = LENGTH.unpack(sock.recv(2))[0]
+                return ReceivedPacket(sock.recv(length))
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(1)
+            sock.sendto(query.get_packet(), address)
+            return ReceivedPacket(sock.recv(512))
+
+    def testAnswers(self):
+        self.assertEqual([(1, '31.170.165.34')], self.client.resolve('eur.al'))
+        self.assertEqual([(5, 'eur.al'), (1, '31.170.165.34')],
+                         self.client.resolve('www.al'))
+        self.assertEqual(Resolver.NAME_NOT_FOUND,
+                         self.client.resolve('nope.al'))
+        self.assertEqual({'received': 3, 'tcp_received': 0, 'cached': 0,
+                          'malformed': 0, 'wire_hits': 0, 'failures': 0,
+                          'lookups': 0},
+                         self.server.get_stats())
+
+    def testCachedTtl(self):
+        reply = self.ask('www.al', 1)
+        self.assertEqual([('www.al', 300), ('eur.al', 300)],
+                         [(record.name, record.ttl)
+                          for record in reply.answers])
+        self.clock.now = 100.5
+        reply = self.ask('WWW.al', 2, tcp=True)
+        self.assertEqual(2, reply.identifier)
+        self.assertEqual([200, 200], [record.ttl for record in reply.answers])
+        self.assertEqual(1, self.hierarchy.server_of('al').received)
+        self.assertEqual(1, self.server.wire_cache.hits)
+
+    def testSharedLookup(self):
+        replies = [None] * 10
+
+        def ask(i):
+            replies[i] = self.ask('eur.al', i)
+        threads = [threading.Thread(target=ask, args=(i,))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(range(10)),
+                         [reply.identifier for reply in replies])
+        self.assertEqual(1, self.hierarchy.server_of('al').received)
+
+    def testServerFailure(self):
+        self.hierarchy.server_of('al').loss = 1
+        self.server.resolver.timeout = 0.05
+        reply = self.ask('eur.al', 1)
+        self.assertEqual(2, reply.rcode)
+        self.assertEqual(1, self.server.failures)
+
+    def testTcpPortTaken(self):
+        with socket.socket() as sock:
+            sock.bind((self.server.address, 0))
+            sock.listen()
+            port = sock.getsockname()[1]
+            server = StubServer(self.server.resolver, port=port)
+            with self.assertRaises(OSError):
+                asyncio.run_coroutine_threadsafe(server.start(),
+                                                 self.loop).result()
+        # datagram endpoint is not left open
+        self.assertIsNone(server.transport)
+
+    def testReusePort(self):
+        cache = SharedCache(slots=64)
+        self.addCleanup(cache.unlink)
+        servers = []
+
+        async def start():
+            port = 0
+            for _ in range(2):
+                resolver = AsyncResolver(self.hierarchy.root,
+                                         self.hierarchy.port, waiting=1,
+                                         cache=cache)
+                server = StubServer(resolver, port=port, reuse_port=True)
+                await server.start()
+                port = server.port
+                servers.append(server)
+            await servers[0].resolver.resolve('eur.al')
+
+        async def stop():
+            for server in servers:
+                server.close()
+                await server.resolver.close()
+        try:
+            asyncio.run_coroutine_threadsafe(start(), self.loop).result()
+            self.assertEqual(servers[0].port, servers[1].port)
+            for i in range(10):
+                reply = self.ask('eur.al', i, server=servers[0])
+                self.assertEqual(1, len(reply.answers))
+            # the name resolved by the first server is cached for both
+            self.assertEqual(10, sum(server.cached + server.wire_cache.hits
+                                     for server in servers))
+            self.assertEqual(1, self.hierarchy.server_of('al').received)
+        finally:
+            asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
+
+if __name__ == "__main__":
+    unittest.main()
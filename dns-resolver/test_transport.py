@@ -0,0 +1,252 @@
+"""
+Unit test for "transport" module
+"""
+__author__ = 'Skipper'
+from cache import ResolverCache
+from resolver import Resolver
+from test_asyncresolver import make_reply
+from transport import LENGTH, IdentifierPool, TcpConnection,\
+    matches_query
+from asyncresolver import AsyncResolver
+from packet import QueryPacket
+import asyncio
+import socket
+import struct
+import threading
+import unittest
+
+
+def stray_and_reply(data):
+    """
+    The function answers with stray datagram and then with correct reply
+    """
+    stray = bytearray(data)
+    stray[0] ^= 0xff
+    return [make_reply(stray, (6, 6, 6, 6)), make_reply(data, (10, 0, 0, 1))]
+
+
+class ThreadedServer(threading.Thread):
+    """
+    Server sends datagrams made by handler in reply to every query
+    """
+    def __init__(self, host='127.0.0.1', port=0, handler=stray_and_reply):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.handler = handler
+        self.clients = set()
+        self.received = 0
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            try:
+                data, addr = self.sock.recvfrom(512)
+                self.clients.add(addr)
+                self.received += 1
+                for reply in self.handler(data):
+                    if self.stopped:
+                        return
+                    self.sock.sendto(reply, addr)
+            except OSError:
+                # socket is closed by stop
+                return
+
+    def stop(self):
+        self.stopped = True
+        self.sock.close()
+
+
+def truncated(data):
+    """
+    The function answers with empty truncated reply
+    """
+    reply = bytearray(make_reply(data, None))
+    reply[2] |= 0x02
+    reply[3] &= 0xf0
+    return [bytes(reply)]
+
+
+class ThreadedTcpServer(threading.Thread):
+    """
+    TCP server reads batch of pipelined queries and answers them
+    in reverse order
+    """
+    def __init__(self, host='127.0.0.1', port=0, batch=1):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.batch = batch
+        self.accepted = 0
+
+    def run(self):
+        while True:
+            try:
+                connection = self.sock.accept()[0]
+            except OSError:
+                return
+            self.accepted += 1
+            threading.Thread(target=self._serve_, args=(connection,),
+                             daemon=True).start()
+
+    def _serve_(self, connection):
+        stream = connection.makefile('rb')
+        try:
+            while True:
+                queries = []
+                for _ in range(self.batch):
+                    length = LENGTH.unpack(stream.read(2))[0]
+                    queries.append(stream.read(length))
+                for query in reversed(queries):
+                    reply = make_reply(query, (10, 0, 0, query[1]))
+                    connection.sendall(LENGTH.pack(len(reply)) + reply)
+        except (OSError, struct.error):
+            connection.close()
+
+    def stop(self):
+        self.sock.close()
+
+
+class TestTransport(unittest.TestCase):
+    """
+    Test class for SocketPool and reply validation
+    """
+    def testMatchesQuery(self):
+        query = bytes([0, 7, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0,
+                       3, 101, 117, 114, 2, 97, 108, 0, 0, 1, 0, 1])
+        reply = bytearray(make_reply(query, (1, 2, 3, 4)))
+        self.assertTrue(matches_query(query, reply))
+        reply[13] = ord('E')
+        self.assertTrue(matches_query(query, reply))
+        reply[1] = 8
+        self.assertFalse(matches_query(query, reply))
+
+    def testMatchesEdnsQuery(self):
+        packet = QueryPacket(7)
+        packet.add_question('eur.al', QueryPacket.QU_A)
+        packet.set_edns(4096)
+        query = packet.get_packet()
+        self.assertTrue(matches_query(query, make_reply(query[:-11],
+                                                        (1, 2, 3, 4))))
+
+    def testPooledSocket(self):
+        server = ThreadedServer()
+        server.start()
+        try:
+            with Resolver('127.0.0.1', port=server.port, waiting=1,
+                          cache=ResolverCache(0)) as resolver:
+                for _ in range(3):
+                    self.assertEqual([(1, '10.0.0.1')],
+                                     resolver.resolve('eur.al'))
+                self.assertEqual(1, len(resolver.sockets))
+            self.assertEqual(1, len(server.clients))
+        finally:
+            server.stop()
+
+    def testPipelining(self):
+        server = ThreadedTcpServer(batch=3)
+        server.start()
+        packets = []
+        for identifier in range(1, 4):
+            packet = QueryPacket(identifier)
+            packet.add_question('eur.al', QueryPacket.QU_A)
+            packets.append(packet.get_packet())
+        connection = TcpConnection('127.0.0.1', server.port, 1)
+        try:
+            replies = connection.exchange(packets, 1)
+            self.assertEqual([1, 2, 3], [reply[-1] for reply in replies])
+        finally:
+            connection.close()
+            server.stop()
+
+    def testSharedConnection(self):
+        server = ThreadedTcpServer(batch=3)
+        server.start()
+        connection = TcpConnection('127.0.0.1', server.port, 1)
+        replies = {}
+
+        def exchange(identifier):
+            packet = QueryPacket(identifier)
+            packet.add_question('eur.al', QueryPacket.QU_A)
+            connection.send(packet.get_packet())
+            replies[identifier] = connection.receive(packet.get_packet(), 1)
+        threads = [threading.Thread(target=exchange, args=(identifier,))
+                   for identifier in range(1, 4)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual({1: 1, 2: 2, 3: 3},
+                             {identifier: reply[-1]
+                              for identifier, reply in replies.items()})
+            self.assertEqual(0, connection.in_flight)
+        finally:
+            connection.close()
+            server.stop()
+
+    def testLateReplyDropped(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        connection = TcpConnection('127.0.0.1', listener.getsockname()[1], 1)
+        peer = listener.accept()[0]
+        packets = []
+        for identifier in range(1, 3):
+            packet = QueryPacket(identifier)
+            packet.add_question('eur.al', QueryPacket.QU_A)
+            packets.append(packet.get_packet())
+        try:
+            connection.send(packets[0])
+            self.assertRaises(socket.timeout, connection.receive,
+                              packets[0], 0.1)
+            self.assertEqual(0, connection.in_flight)
+            connection.send(packets[1])
+            for packet in packets:
+                reply = make_reply(packet, (10, 0, 0, packet[1]))
+                peer.sendall(LENGTH.pack(len(reply)) + reply)
+            self.assertEqual(2, connection.receive(packets[1], 1)[-1])
+            self.assertEqual(0, connection.in_flight)
+            self.assertEqual({}, connection.replies)
+        finally:
+            connection.close()
+            peer.close()
+            listener.close()
+
+    def testIdentifierPool(self):
+        identifiers = IdentifierPool()
+        taken = {identifiers.allocate() for _ in range(65536)}
+        self.assertEqual(65536, len(taken))
+        self.assertRaises(Exception, identifiers.allocate)
+        identifiers.release(7)
+        self.assertEqual(7, identifiers.allocate())
+
+    def testTruncatedFallback(self):
+        server = ThreadedServer(handler=truncated)
+        server.start()
+        tcp_server = ThreadedTcpServer(port=server.port)
+        tcp_server.start()
+        try:
+            with Resolver('127.0.0.1', port=server.port, waiting=1,
+                          cache=ResolverCache(0)) as resolver:
+                for _ in range(2):
+                    received = resolver.resolve('eur.al')
+                    self.assertEqual(1, len(received))
+
+            async def check():
+                async with AsyncResolver('127.0.0.1', server.port, waiting=1,
+                                         cache=ResolverCache(0)) as resolver:
+                    return await resolver.resolve_many(['eur.al'] * 3)
+            for received in asyncio.run(check()):
+                self.assertEqual(1, len(received))
+            self.assertEqual(2, tcp_server.accepted)
+        finally:
+            server.stop()
+            tcp_server.stop()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Unit test for "wirecache" module
+"""
+__author__ = 'Skipper'
+from packet import QueryPacket, ReceivedPacket, ResponsePacket
+from test_cache import FakeClock
+from wirecache import WireCache, parse_question
+import unittest
+
+
+class TestWireCache(unittest.TestCase):
+    """
+    Test class for WireCache
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = WireCache(clock=self.clock)
+
+    def make_query(self, name, identifier=1, query_type=QueryPacket.QU_A,
+                   edns=None):
+        query = QueryPacket(identifier)
+        query.add_question(name, query_type)
+        query.set_edns(edns)
+        return query
+
+    def store(self, query, records, lifetime=300):
+        parsed = QueryPacket.query_packet_from_bytes(query.get_packet())
+        response = ResponsePacket(parsed)
+        for owner, record_type, data in records:
+            response.add_answer(owner, record_type, lifetime, data)
+        packet = response.get_packet()
+        self.cache.put(parsed.questions[0], parsed.edns_payload is not None,
+                       packet, response.ttl_offsets, lifetime)
+        return packet
+
+    def testParseQuestion(self):
+        key, end, max_size = parse_question(
+            self.make_query('EUR.al', query_type=65, edns=1232).get_packet())
+        self.assertEqual(b'\x03eur\x02al\x00\x00\x41\x00\x01\x01', key)
+        self.assertEqual((24, 1232), (end, max_size))
+        self.assertEqual(512, parse_question(
+            self.make_query('eur.al').get_packet())[2])
+        self.assertIsNone(parse_question(b'\x00' * 11))
+        query = self.make_query('eur.al')
+        query.add_question('www.eur.al', QueryPacket.QU_A)
+        self.assertIsNone(parse_question(query.get_packet()))
+
+    def testHit(self):
+        stored = self.store(self.make_query('www.al'),
+                            [('www.al', QueryPacket.QU_CNAME, 'eur.al'),
+                             ('eur.al', QueryPacket.QU_A, '31.170.165.34')])
+        query = self.make_query('WWW.Al', 77)
+        self.assertEqual(stored[2:12],
+                         self.cache.get(query.get_packet())[2:12])
+        self.clock.now = 100.5
+        reply = ReceivedPacket(self.cache.get(query.get_packet()))
+        self.assertEqual(77, reply.identifier)
+        self.assertEqual('WWW.Al.', reply.queries[0].query_name)
+        # names compressed into question take case of query
+        self.assertEqual([(5, 'eur.Al', 200), (1, '31.170.165.34', 200)],
+                         [(record.record_type, record.data, record.ttl)
+                          for record in reply.answers])
+        self.assertIsNone(self.cache.get(self.make_query(
+            'www.al', edns=1232).get_packet()))
+        self.assertIsNone(self.cache.get(self.make_query(
+            'www.al', query_type=QueryPacket.QU_AAAA).get_packet()))
+        self.clock.now = 300
+        self.assertIsNone(self.cache.get(query.get_packet()))
+        self.assertEqual({'size': 0, 'hits': 2, 'misses': 3, 'evictions': 0,
+                          'expirations': 1}, self.cache.get_stats())
+
+    def testUdpSize(self):
+        records = [('big.al', QueryPacket.QU_A, '10.0.0.{}'.format(i))
+                   for i in range(40)]
+        self.store(self.make_query('big.al'), records)
+        raw_query = self.make_query('big.al').get_packet()
+        self.assertIsNone(self.cache.get(raw_query))
+        self.assertEqual(40, len(ReceivedPacket(
+            self.cache.get(raw_query, udp=False)).answers))
+
+if __name__ == "__main__":
+    unittest.main()
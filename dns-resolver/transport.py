@@ -0,0 +1,350 @@
+"""
+The module keeps network connections to DNS servers.
+"""
+__author__ = 'Skipper'
+DEFAULT_TCP_CONNECTIONS = 2
+DEFAULT_PIPELINE = 16
+
+import random
+import socket
+import struct
+import threading
+import time
+
+LENGTH = struct.Struct('!H')
+
+
+def question_end(packet):
+    """
+    The function finds the end of question section of query
+    :param packet: bytes
+    :return: int
+    """
+    pointer = 12
+    for _ in range((packet[4] << 8) + packet[5]):
+        while packet[pointer] != 0:
+            pointer += packet[pointer] + 1
+        pointer += 5
+    return pointer
+
+
+def matches_query(query, reply):
+    """
+    The function checks that reply answers the query:
+    identifiers and questions must be equal (case of names is ignored)
+    :param query: bytes
+    :param reply: bytes
+    :return: bool
+    """
+    if reply[0:2] != query[0:2] or reply[4:6] != query[4:6]:
+        return False
+    end = question_end(query)
+    if len(reply) < end:
+        return False
+    return reply[12:end].lower() == query[12:end].lower()
+
+
+class IdentifierPool:
+    """
+    The class hands out random identifiers of queries,
+    identifier is not given again until it is released
+    """
+
+    def __init__(self):
+        self.used = set()
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        """
+        The method takes random identifier which is not in use
+        :return: int
+        """
+        with self.lock:
+            if len(self.used) >= 65536:
+                raise Exception('All identifiers are in use')
+            identifier = random.randrange(65536)
+            while identifier in self.used:
+                identifier = random.randrange(65536)
+            self.used.add(identifier)
+            return identifier
+
+    def release(self, identifier):
+        """
+        The method gives identifier back
+        :param identifier: int
+        :return: None
+        """
+        with self.lock:
+            self.used.discard(identifier)
+
+    def __len__(self):
+        return len(self.used)
+
+
+class SocketPool:
+    """
+    The class keeps one connected UDP socket per (server, port) for
+    every thread, so replies to one thread are not read by another.
+    Sockets of finished threads are closed when new socket is opened.
+    """
+
+    def __init__(self):
+        self.sockets = {}
+        self.lock = threading.Lock()
+
+    def get_socket(self, server, port):
+        """
+        The method returns socket connected to server, creates it if needed
+        :param server: str
+        :param port: int
+        :return: socket
+        """
+        key = (server, port, threading.get_ident())
+        sender = self.sockets.get(key)
+        if sender is None:
+            self.release_finished()
+            sender = self._open_socket_(server, port)
+            with self.lock:
+                self.sockets[key] = sender
+        return sender
+
+    def _open_socket_(self, server, port):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sender.connect((server, port))
+        except OSError:
+            sender.close()
+            raise
+        return sender
+
+    def discard(self, server, port):
+        """
+        The method closes socket of server
+        :param server: str
+        :param port: int
+        :return: None
+        """
+        with self.lock:
+            sender = self.sockets.pop((server, port, threading.get_ident()),
+                                      None)
+        if sender is not None:
+            sender.close()
+
+    def release_finished(self):
+        """
+        The method closes sockets of threads which have finished
+        :return: None
+        """
+        alive = {thread.ident for thread in threading.enumerate()}
+        with self.lock:
+            finished = [key for key in self.sockets if key[2] not in alive]
+            senders = [self.sockets.pop(key) for key in finished]
+        for sender in senders:
+            sender.close()
+
+    def close(self):
+        """
+        The method closes all sockets
+        :return: None
+        """
+        with self.lock:
+            for sender in self.sockets.values():
+                sender.close()
+            self.sockets.clear()
+
+    def __len__(self):
+        return len(self.sockets)
+
+
+class TcpConnection:
+    """
+    Persistent TCP connection to DNS server.
+    Several length-prefixed queries may be sent before replies are read,
+    replies are matched to queries by identifier and question.
+    Queries may be sent from several threads: one of them reads
+    replies while others wait for the reader to hand them their ones.
+    Replies coming after their query timed out are dropped.
+    """
+
+    def __init__(self, server, port, timeout):
+        self.sock = socket.create_connection((server, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        self.replies = {}
+        # identifier -> number of sent queries waiting for it
+        self.pending = {}
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.reading = False
+        self.sending = threading.Lock()
+
+    def send(self, packet):
+        """
+        The method sends query without waiting for reply
+        :param packet: bytes
+        :return: None
+        """
+        identifier = packet[0:2]
+        with self.condition:
+            self.in_flight += 1
+            self.pending[identifier] = self.pending.get(identifier, 0) + 1
+        try:
+            with self.sending:
+                self.sock.sendall(LENGTH.pack(len(packet)) + packet)
+        except OSError:
+            with self.condition:
+                self._forget_(packet)
+            raise
+
+    def receive(self, packet, timeout):
+        """
+        The method waits reply to sent packet, replies to other
+        queries of this connection are kept until they are asked for
+        :param packet: bytes
+        :param timeout: float
+        :return: bytes
+        """
+        try:
+            return self._wait_reply_(packet, time.monotonic() + timeout)
+        finally:
+            with self.condition:
+                self._forget_(packet)
+
+    def exchange(self, packets, timeout):
+        """
+        The method pipelines packets and returns replies in their order
+        :param packets: list
+        :param timeout: float - time for all replies
+        :return: list
+        """
+        deadline = time.monotonic() + timeout
+        sent = []
+        try:
+            for packet in packets:
+                self.send(packet)
+                sent.append(packet)
+            return [self._wait_reply_(packet, deadline) for packet in sent]
+        finally:
+            with self.condition:
+                for packet in sent:
+                    self._forget_(packet)
+
+    def _forget_(self, packet):
+        # called with condition held when query is answered or given up
+        identifier = packet[0:2]
+        self.in_flight -= 1
+        count = self.pending.pop(identifier) - 1
+        if count:
+            self.pending[identifier] = count
+        else:
+            self.replies.pop(identifier, None)
+
+    def _wait_reply_(self, packet, deadline):
+        with self.condition:
+            while True:
+                reply = self.replies.pop(packet[0:2], None)
+                if reply is not None and matches_query(packet, reply):
+                    return reply
+                if self.reading:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout
+                    self.condition.wait(remaining)
+                    continue
+                self.reading = True
+                self.condition.release()
+                try:
+                    reply = self._read_message_(deadline)
+                finally:
+                    self.condition.acquire()
+                    self.reading = False
+                    self.condition.notify_all()
+                if reply[0:2] in self.pending:
+                    self.replies[reply[0:2]] = reply
+
+    def _read_message_(self, deadline):
+        while True:
+            if len(self.buffer) >= 2:
+                length = LENGTH.unpack_from(self.buffer)[0]
+                if len(self.buffer) >= length + 2:
+                    message = bytes(self.buffer[2:length+2])
+                    del self.buffer[:length+2]
+                    return message
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout
+            self.sock.settimeout(remaining)
+            chunk = self.sock.recv(65537)
+            if not chunk:
+                raise ConnectionResetError('Connection closed by server')
+            self.buffer.extend(chunk)
+
+    def close(self):
+        """
+        The method closes connection
+        :return: None
+        """
+        self.sock.close()
+
+
+class TcpConnectionPool:
+    """
+    The class keeps up to max_connections persistent TCP connections
+    per (server, port). A query goes to the least loaded connection,
+    new connection is opened when all have max_pipeline queries in flight.
+    """
+
+    def __init__(self, max_connections=DEFAULT_TCP_CONNECTIONS,
+                 max_pipeline=DEFAULT_PIPELINE):
+        self.max_connections = max_connections
+        self.max_pipeline = max_pipeline
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get_connection(self, server, port, timeout):
+        """
+        The method returns connection to server, connects if needed
+        :param server: str
+        :param port: int
+        :param timeout: float - timeout of connecting
+        :return: TcpConnection
+        """
+        with self.lock:
+            connections = self.connections.setdefault((server, port), [])
+            if connections:
+                connection = min(connections,
+                                 key=lambda item: item.in_flight)
+                if connection.in_flight < self.max_pipeline\
+                        or len(connections) >= self.max_connections:
+                    return connection
+            connection = self._connect_(server, port, timeout)
+            connections.append(connection)
+            return connection
+
+    def _connect_(self, server, port, timeout):
+        return TcpConnection(server, port, timeout)
+
+    def discard(self, server, port, connection):
+        """
+        The method closes broken connection
+        :param server: str
+        :param port: int
+        :param connection: TcpConnection
+        :return: None
+        """
+        with self.lock:
+            connections = self.connections.get((server, port), [])
+            if connection in connections:
+                connections.remove(connection)
+        connection.close()
+
+    def close(self):
+        """
+        The method closes all connections
+        :return: None
+        """
+        with self.lock:
+            for connections in self.connections.values():
+                for connection in connections:
+                    connection.close()
+            self.connections.clear()
@@ -0,0 +1,158 @@
+"""
+The module keeps complete responses in wire format, so repeated query is
+answered without parsing it into objects and encoding records again:
+stored bytes are copied, id and question of query are put in and
+TTL fields, whose offsets are found when response is formed,
+are decreased by time spent in cache.
+"""
+__author__ = 'Skipper'
+
+import time
+from collections import OrderedDict
+from cache import DEFAULT_CACHE_SIZE
+from packet import CLASSIC_PAYLOAD, IDENTIFIER, TTL, QueryPacket,\
+    encode_question
+
+OPT_TYPE = IDENTIFIER.pack(QueryPacket.QU_OPT)
+
+
+def parse_question(raw_query):
+    """
+    The function finds question of query which may be answered from cache
+    :param raw_query: bytes
+    :return: key, offset of the end of question, maximal size of UDP
+    response; or None if query is not a plain query with one question
+    """
+    if len(raw_query) < 17 or raw_query[2] & 0xf8\
+            or raw_query[4:6] != b'\x00\x01':
+        return None
+    pointer = 12
+    length = raw_query[pointer]
+    while length:
+        if length > 63:
+            return None
+        pointer += length + 1
+        if pointer >= len(raw_query):
+            return None
+        length = raw_query[pointer]
+    end = pointer + 5
+    if end > len(raw_query):
+        return None
+    max_size = CLASSIC_PAYLOAD
+    edns = raw_query[end] == 0 and raw_query[end+1:end+3] == OPT_TYPE\
+        if len(raw_query) >= end + 11 else False
+    if edns:
+        max_size = max(IDENTIFIER.unpack_from(raw_query, end + 3)[0],
+                       CLASSIC_PAYLOAD)
+    # only name is lower cased, type may look like a letter
+    key = bytes(raw_query[12:pointer]).lower()\
+        + bytes(raw_query[pointer:end]) + (b'\x01' if edns else b'\x00')
+    return key, end, max_size
+
+
+class WireEntry:
+    """
+    Response bytes with offsets and original values of its TTL fields
+    """
+
+    def __init__(self, packet, ttl_offsets, stored, expires):
+        self.packet = packet
+        self.ttl_offsets = ttl_offsets
+        self.ttls = [TTL.unpack_from(packet, offset)[0]
+                     for offset in ttl_offsets]
+        self.stored = stored
+        self.expires = expires
+
+
+class WireCache:
+    """
+    Bounded LRU cache of responses keyed by question and presence of EDNS0
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, clock=time.monotonic):
+        self.max_size = max_size
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, raw_query, udp=True):
+        """
+        The method answers query from cache
+        :param raw_query: bytes
+        :param udp: bool - response must fit into payload size of query
+        :return: bytes or None
+        """
+        question = parse_question(raw_query)
+        entry = None
+        if question is not None:
+            key, end, max_size = question
+            entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = self.clock()
+        if entry.expires <= now:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        if udp and len(entry.packet) > max_size:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        reply = bytearray(entry.packet)
+        reply[0:2] = raw_query[0:2]
+        reply[2] = (reply[2] & 0xfe) | (raw_query[2] & 1)
+        # question is copied as it was asked, with case of letters
+        reply[12:end] = raw_query[12:end]
+        elapsed = int(now - entry.stored)
+        if elapsed:
+            for offset, ttl in zip(entry.ttl_offsets, entry.ttls):
+                TTL.pack_into(reply, offset, max(0, ttl - elapsed))
+        return bytes(reply)
+
+    def put(self, question, edns, packet, ttl_offsets, lifetime):
+        """
+        The method caches response to question
+        :param question: Query
+        :param edns: bool - query has OPT record
+        :param packet: bytes - response without TC flag
+        :param ttl_offsets: list - offsets of TTL fields in packet
+        :param lifetime: float - seconds while response is valid
+        :return: None
+        """
+        if self.max_size <= 0 or lifetime <= 0:
+            return
+        key = encode_question(question.query_name.lower(),
+                              question.query_type, question.query_class)\
+            + (b'\x01' if edns else b'\x00')
+        now = self.clock()
+        self.entries[key] = WireEntry(packet, ttl_offsets, now,
+                                      now + lifetime)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        The method drops every entry
+        :return: None
+        """
+        self.entries.clear()
+
+    def get_stats(self):
+        """
+        The method returns counters of cache
+        :return: dict
+        """
+        return {'size': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations}
+
+    def __len__(self):
+        return len(self.entries)